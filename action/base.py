@@ -1,6 +1,8 @@
 from abc import abstractmethod
 from enum import Enum, auto
-from typing import Any, List, NamedTuple, Optional, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from models.budget import approximate_tokens
 
 ######
 # BASE TYPES
@@ -21,6 +23,7 @@ class Action:
         reasoning: Optional[List[str | Any] | str] = None,
         coords: Optional[Tuple[float, float]] = None,
         key: Optional[str] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
     ):
         if coords and key:
             raise ValueError("Coords and Key are mutually exclusive")
@@ -31,6 +34,7 @@ class Action:
         self.reasoning = reasoning  # optional
         self.coords = coords  # optional
         self.key = key  # optional
+        self.bbox = bbox  # optional, (x1, y1, x2, y2) of the grounded element
 
     def __str__(self):
         return f"""
@@ -39,6 +43,13 @@ Model Reasoning: {self.reasoning}
 Provided action: {self.action} {self.action_target} {self.key if self.key else self.coords if self.coords else ""}
 """
 
+    def summary(self) -> str:
+        """
+        One line description of the action, without the reasoning
+        """
+        location = self.key if self.key else self.coords if self.coords else ""
+        return " ".join(str(part) for part in (self.action, self.action_target, location) if part)
+
     def to_str_extended(self):
         return f"""
 Prompt: {self.prompt}
@@ -67,22 +78,40 @@ class ActionExecution(NamedTuple):
 
 class History:
     """
-    Stores past actions for an ongoing task execution and its corresponding results
+    Stores past actions for an ongoing task execution and its corresponding results.
+
+    The rendering of every step is computed once, when it is appended or its result is set, and so are its token
+    counts for every counting function it is rendered with, so building a prompt does not go through the whole
+    transcript again.
     """
 
     def __init__(
         self,
-        actions: List[Action] = [],
-        results: List[ActionExecution] = [],
+        actions: Optional[List[Action]] = None,
+        results: Optional[List[ActionExecution]] = None,
     ):
-        self.actions = actions
-        self.results = results
+        self.actions: List[Action] = []
+        self.results: List[ActionExecution] = []
+        # Full and one line renderings of every step, in the same order as results
+        self._rendered: List[str] = []
+        self._summaries: List[str] = []
+        # Token counts of both renderings of every step, per counting function, filled when first rendered in a budget
+        self._rendered_tokens: List[Dict[Callable[[str], int], int]] = []
+        self._summary_tokens: List[Dict[Callable[[str], int], int]] = []
+
+        for action in actions or []:
+            self.actions.append(action)
+        for action, result in results or []:
+            self._record(action, result)
 
     def __iter__(self):
-        return self.results
+        return iter(self.results)
+
+    def __len__(self) -> int:
+        return len(self.results)
 
     def __str__(self):
-        return "\n".join([f"Executed {action} with result {result}" for action, result in self.results])
+        return "\n".join(self._rendered)
 
     @property
     def last_result(self):
@@ -91,7 +120,87 @@ class History:
 
     def append(self, action: Action, result: ActionResult):
         self.actions.append(action)
+        self._record(action, result)
+
+    def set_result(self, result: ActionResult, step: int = -1) -> None:
+        """
+        Updates the result of a recorded step, such as one appended as PENDING, along with its rendering
+
+        @param result: The new result of the step
+        @param step: Index of the step, the last one by default
+        """
+        action = self.results[step].action
+        self.results[step] = ActionExecution(action, result)
+        self._rendered[step] = self._render(action, result)
+        self._summaries[step] = self._summarize(action, result)
+        self._rendered_tokens[step] = {}
+        self._summary_tokens[step] = {}
+
+    def render(
+        self,
+        history_len: int = 0,
+        max_tokens: Optional[int] = None,
+        count_tokens: Callable[[str], int] = approximate_tokens,
+    ) -> str:
+        """
+        Prompt view of the history. The most recent steps are rendered in full, older ones with a single line each
+
+        @param history_len: Number of recent steps rendered in full, every step if 0
+        @param max_tokens: Token budget of the rendering, the oldest steps are dropped once even their one line
+        summaries do not fit
+        @param count_tokens: Function counting the tokens of a text
+
+        @returns rendered history
+        """
+        full_from = max(len(self.results) - history_len, 0) if history_len > 0 else 0
+        lines = [self._rendered[i] if i >= full_from else self._summaries[i] for i in range(len(self.results))]
+        if max_tokens is None:
+            return "\n".join(lines)
+
+        # Older steps are summarized first, then dropped, until the rendering fits. Every line costs its newline too
+        costs = [self._tokens(i, i >= full_from, count_tokens) + 1 for i in range(len(lines))]
+        total = sum(costs)
+        for i in range(full_from, len(lines)):
+            if total <= max_tokens:
+                break
+            lines[i] = self._summaries[i]
+            total -= costs[i]
+            costs[i] = self._tokens(i, False, count_tokens) + 1
+            total += costs[i]
+        if total <= max_tokens:
+            return "\n".join(lines)
+
+        # The line standing for the dropped steps counts against the budget as well, sized for the most digits
+        omitted_cost = count_tokens(f"({len(lines)} earlier steps omitted)") + 1
+        dropped = 0
+        while dropped < len(lines) and total + omitted_cost > max_tokens:
+            total -= costs[dropped]
+            dropped += 1
+        return "\n".join([f"({dropped} earlier steps omitted)", *lines[dropped:]])
+
+    def _tokens(self, step: int, full: bool, count_tokens: Callable[[str], int]) -> int:
+        """
+        Token count of the full or one line rendering of a step, counted once per counting function
+        """
+        counts = self._rendered_tokens[step] if full else self._summary_tokens[step]
+        if count_tokens not in counts:
+            counts[count_tokens] = count_tokens(self._rendered[step] if full else self._summaries[step])
+        return counts[count_tokens]
+
+    def _record(self, action: Action, result: ActionResult) -> None:
         self.results.append(ActionExecution(action, result))
+        self._rendered.append(self._render(action, result))
+        self._summaries.append(self._summarize(action, result))
+        self._rendered_tokens.append({})
+        self._summary_tokens.append({})
+
+    @staticmethod
+    def _render(action: Action, result: ActionResult) -> str:
+        return f"Executed {action} with result {result}"
+
+    @staticmethod
+    def _summarize(action: Action, result: ActionResult) -> str:
+        return f"Executed {action.summary()} with result {result}"
 
 
 ######
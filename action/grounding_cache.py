@@ -0,0 +1,130 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from models.images import ImageInput, open_image
+
+
+def perceptual_hash(image: ImageInput, hash_size: int = 16) -> int:
+    """
+    Difference hash of an image. Small local changes such as the cursor or the clock only flip a few bits
+
+    @param image: Path, url or in-memory image
+    @param hash_size: Side of the grid the image is reduced to, the hash has hash_size**2 bits
+
+    @returns hash as an integer
+    """
+    from PIL import Image
+
+    img = open_image(image)
+    pixels = list(img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR).getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def normalize_target(target: str) -> str:
+    return " ".join(target.lower().split()).strip(" .\"'")
+
+
+class GroundingCache:
+    """
+    Remembers where targets were grounded on previously seen screens.
+
+    Entries are keyed by the normalized target description and a perceptual hash of the screenshot, a lookup hits
+    when the same target was grounded on a screenshot whose hash is within max_distance bits of the given one.
+    """
+
+    def __init__(self, max_distance: int = 8, max_entries: int = 1024, hash_size: int = 16):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.hash_size = hash_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Models holding the cache are pickled to worker processes, the lock is created again there
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def screen_hash(self, image: ImageInput) -> int:
+        """
+        Perceptual hash of a screenshot as used in the keys, to be computed once and given to lookup and store
+        """
+        return perceptual_hash(image, self.hash_size)
+
+    def get(self, image: ImageInput, target: str) -> Optional[Tuple[float, float]]:
+        """
+        @returns coords grounded for the target on a similar screenshot, or None on a miss
+        """
+        return self.lookup(self.screen_hash(image), target)
+
+    def put(self, image: ImageInput, target: str, coords: Tuple[float, float]) -> None:
+        self.store(self.screen_hash(image), target, coords)
+
+    def lookup(self, phash: int, target: str) -> Optional[Tuple[float, float]]:
+        """
+        Same as get, for a screenshot already hashed with screen_hash
+        """
+        key = self._find(normalize_target(target), phash)
+        with self._lock:
+            if key is None or key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def store(self, phash: int, target: str, coords: Tuple[float, float]) -> None:
+        """
+        Same as put, for a screenshot already hashed with screen_hash
+        """
+        key = (normalize_target(target), phash)
+        with self._lock:
+            self._entries[key] = coords
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, image: Optional[ImageInput] = None, target: Optional[str] = None) -> int:
+        """
+        Drops the entries matching the target, the screenshot or both. Everything is dropped if neither is given
+
+        @returns number of entries dropped
+        """
+        phash = self.screen_hash(image) if image is not None else None
+        normalized = normalize_target(target) if target is not None else None
+
+        def matches(key: Tuple[str, int]) -> bool:
+            if normalized is not None and key[0] != normalized:
+                return False
+            return phash is None or bin(key[1] ^ phash).count("1") <= self.max_distance
+
+        with self._lock:
+            stale = [key for key in self._entries if matches(key)]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def _find(self, target: str, phash: int) -> Optional[Tuple[str, int]]:
+        with self._lock:
+            candidates = [(bin(key[1] ^ phash).count("1"), key) for key in self._entries if key[0] == target]
+        matches = [c for c in candidates if c[0] <= self.max_distance]
+        return min(matches)[1] if matches else None
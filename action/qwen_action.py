@@ -1,10 +1,104 @@
+import asyncio
+import logging
+import math
 import re
-from typing import Tuple
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
-import jax.numpy as jnp
+from pydantic import PrivateAttr
 
 from action.base import Action, ActionInterface
-from models.models import QwenVLModel
+from action.grounding_cache import GroundingCache
+from action.roi import Region, iou, is_inside, roi_region, tile_regions
+from models.images import ImageInput, image_size, open_image
+from models.models import GenerationRequest, QwenVLModel
+from models.recording import recorded_parse
+from models.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+ACTION_END = "<|action_end|>"
+
+
+class TargetStreamParser:
+    """
+    Incrementally extracts the bracketed target that follows the action of the middleman
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.target: Optional[str] = None
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """
+        @param chunk: New piece of generated text
+
+        @returns the target once its closing bracket has been generated, None before that
+        """
+        self.text += chunk
+        if self.target is not None:
+            return self.target
+
+        match = re.search(re.escape(ACTION_END) + r"[^\[\n]*\[([^\]]*)\]", self.text)
+        if match:
+            self.target = match.group(1).strip()
+        return self.target
+
+
+class RegionCrop(NamedTuple):
+    image: Any
+    region: Region
+    # Size of the whole screenshot
+    size: Tuple[int, int]
+
+
+class TileTiming(NamedTuple):
+    region: Region
+    image_tokens: int
+    # Time taken to build the messages of the tile
+    prepare_seconds: float
+    # Share of the batched generation, all tiles are generated together
+    generation_seconds: float
+    parse_seconds: float
+    # Whether the element was found well inside the tile
+    found: bool
+
+
+class TileGrounding(NamedTuple):
+    # Grounding in coordinates of the whole screenshot
+    action: Action
+    tile: RegionCrop
+    # Whether the element was found well inside the tile
+    inside: bool
+    # Mean log probability of the output of the tile, None when unknown such as for cached outputs
+    confidence: Optional[float]
+
+
+def _prompt_image(messages: List[Dict[str, Any]]) -> Optional[ImageInput]:
+    """
+    First image of the prompt messages, None for text only prompts
+    """
+    for message in messages:
+        if isinstance(message["content"], list):
+            for element in message["content"]:
+                if "image" in element:
+                    return element["image"]
+    return None
+
+
+def _chain(source: Future, target: Future) -> None:
+    """
+    Resolves the target future with the outcome of the source one
+    """
+
+    def copy(done: Future) -> None:
+        if done.exception() is not None:
+            target.set_exception(done.exception())  # type: ignore[arg-type]
+        else:
+            target.set_result(done.result())
+
+    source.add_done_callback(copy)
 
 
 class QwenVLActionModel(ActionInterface, QwenVLModel):
@@ -12,7 +106,17 @@ class QwenVLActionModel(ActionInterface, QwenVLModel):
     ActionModel implentation for QwenVL based models. It also supports derivatives such as OSAtlas
     """
 
+    role: Optional[str] = "middleman"
     capabilities: list[str] = ["image", "text"]
+    # parse_action needs the reasoning and the action line, which ends with its target. The stop pattern ends the
+    # generation there, the budget is kept as before so that a long context analysis is never cut
+    max_new_tokens: int = 512
+    stop_pattern: Optional[str] = r"<\|action_end\|>[^\n]*\n"
+    # Recent steps are given in full, older ones summarized in a line, so the prompt stops growing with the task
+    history_len: int = 5
+    history_max_tokens: Optional[int] = 2048
+    # Deciding on the next action does not need full resolution, about 1036x582 pixels or 768 image tokens
+    max_pixels: Optional[int] = 768 * 28 * 28
 
     def __init__(self, model_name: str, *args, **kwargs):
         super().__init__(model_name, *args, **kwargs)
@@ -27,6 +131,73 @@ class QwenVLActionModel(ActionInterface, QwenVLModel):
 
         return self.parse_action(messages, processed_output_text)
 
+    def submit_action(
+        self,
+        sys_prompt,
+        user_prompt,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs,
+    ) -> Future:
+        """
+        Starts creating an action without waiting for the model
+
+        @param sys_prompt: The system prompt to give to the model
+        @param user_prompt: User textual prompt for the model
+
+        @returns future resolved with the Action object
+        """
+        messages = self.build_messages(sys_prompt, user_prompt, **kwargs)
+        generation = self.submit([self.generation_request(messages, max_tokens, stop)])
+        action: Future = Future()
+
+        def parse(_: Future) -> None:
+            try:
+                output = next(iter(generation.result()), None)
+                if not output:
+                    raise RuntimeError(
+                        "Something went wrong while generating the action and no output was given by the model"
+                    )
+                action.set_result(self.parse_action(messages, output))
+            except Exception as e:
+                action.set_exception(e)
+
+        generation.add_done_callback(parse)
+        return action
+
+    async def aaction(self, sys_prompt, user_prompt, *args, **kwargs) -> Action:
+        """
+        Async version of action, the event loop is not blocked while the model generates
+        """
+        messages, outputs = await self._acall(sys_prompt, user_prompt, *args, **kwargs)
+
+        processed_output_text: Optional[str] = next(iter(outputs), None)
+
+        if not processed_output_text:
+            raise RuntimeError("Something went wrong while generating the action and no output was given by the model")
+
+        return self.parse_action(messages, processed_output_text)
+
+    def batch_action(self, requests: List[Tuple[Optional[str], str, Any]], *args, **kwargs) -> List[Action]:
+        """
+        Creates several actions in a single batched inference
+
+        @param requests: (sys_prompt, user_prompt, image) for every action, image may be None
+
+        @returns Action objects in the same order as the requests
+        """
+        actions: List[Action] = []
+        for messages, processed_output_text in self.batch_call(requests, *args, **kwargs):
+            output = next(iter(processed_output_text), None)
+            if not output:
+                raise RuntimeError(
+                    "Something went wrong while generating the action and no output was given by the model"
+                )
+            actions.append(self.parse_action(messages, output))
+        return actions
+
+    @traced("parse.action")
+    @recorded_parse
     def parse_action(self, prompt: list[dict[str, str]], model_response: str) -> Action:
         reasoning_pattern = r"<\|context_analysis_begin\|>(.*?)<\|context_analysis_end\|>"
         action_name_pattern = r"<\|action_begin\|>(.*?)<\|action_end\|>"
@@ -55,6 +226,337 @@ class QwenVLActionModel(ActionInterface, QwenVLModel):
 
 
 class AtlasActionmodel(QwenVLActionModel, QwenVLModel):
+    role: Optional[str] = "grounding"
+    # Grounding outputs a short reference to the element and its bbox
+    max_new_tokens: int = 96
+    stop_pattern: Optional[str] = r"<\|box_end\|>"
+    # Grounding precision depends on the resolution, screenshots are kept at the default bounds
+    max_pixels: Optional[int] = None
+    # Boxes are given in coordinates normalized to [0, coords_scale) along each side of the image
+    coords_scale: int = 1000
+    # Coords grounded on similar screens are reused instead of running the model again
+    grounding_cache: Optional[GroundingCache] = None
+    # Minimum size of the crop grounded on when a region of interest is given, in pixels of the screenshot
+    roi_size: Tuple[int, int] = (768, 768)
+    # Screenshots larger than a tile, such as 4K or multi-monitor captures, are grounded as overlapping tiles of this
+    # size in a single batch. Disabled if None, (1280, 1280) keeps small elements legible on 4K captures
+    tile_size: Optional[Tuple[int, int]] = None
+    tile_overlap: float = 0.25
+    _tile_timings: List[TileTiming] = PrivateAttr(default_factory=list)
+
+    def action(
+        self,
+        sys_prompt,
+        user_prompt,
+        *args,
+        action_target: Optional[str] = None,
+        roi: Optional[Sequence[float]] = None,
+        **kwargs,
+    ):
+        """
+        Grounds the element described in the prompt, going through the grounding cache when there is one
+
+        @param action_target: Description of the element used as cache key, defaults to the user prompt
+        @param roi: Box (x1, y1, x2, y2) or point (x, y) of the screenshot the element is expected to be in or near,
+        such as the active window or the last click. The element is grounded on a crop around it first, and on the
+        whole screenshot if it is not found there
+        """
+        cached, phash = self._cached(sys_prompt, user_prompt, action_target, **kwargs)
+        if cached is not None:
+            return cached
+
+        crop = self._crop(kwargs.get("image"), roi)
+        if crop is not None:
+            found = self._from_crop(
+                super().action(sys_prompt, user_prompt, *args, **{**kwargs, "image": crop.image}), crop
+            )
+            if found is not None:
+                return self._remember(found, action_target or user_prompt, phash)
+
+        tiles = self._tiles(kwargs.get("image"))
+        if tiles is not None:
+            grounding = self._submit_tiled(sys_prompt, user_prompt, tiles, **kwargs).result()
+        else:
+            grounding = super().action(sys_prompt, user_prompt, *args, **kwargs)
+        return self._remember(grounding, action_target or user_prompt, phash)
+
+    def submit_action(
+        self,
+        sys_prompt,
+        user_prompt,
+        *args,
+        action_target: Optional[str] = None,
+        roi: Optional[Sequence[float]] = None,
+        **kwargs,
+    ) -> Future:
+        """
+        Starts grounding without waiting for the model, going through the grounding cache and the region of interest
+        as well. Cancelling the returned future drops a speculative grounding, its result is then neither delivered
+        nor remembered in the grounding cache even if the model is still running
+        """
+        cached, phash = self._cached(sys_prompt, user_prompt, action_target, **kwargs)
+        if cached is not None:
+            future: Future = Future()
+            future.set_result(cached)
+            return future
+
+        submit = super().submit_action
+
+        def submit_full() -> Future:
+            tiles = self._tiles(kwargs.get("image"))
+            if tiles is not None:
+                return self._submit_tiled(sys_prompt, user_prompt, tiles, **kwargs)
+            return submit(sys_prompt, user_prompt, *args, **kwargs)
+
+        crop = self._crop(kwargs.get("image"), roi)
+        if crop is None:
+            future = submit_full()
+        else:
+            future = Future()
+
+            def fallback(attempt: Future) -> None:
+                try:
+                    grounding = self._from_crop(attempt.result(), crop)
+                except Exception as e:
+                    future.set_exception(e)
+                    return
+                if grounding is not None:
+                    future.set_result(grounding)
+                else:
+                    _chain(submit_full(), future)
+
+            submit(sys_prompt, user_prompt, *args, **{**kwargs, "image": crop.image}).add_done_callback(fallback)
+
+        result: Future = Future()
+
+        def deliver(done: Future) -> None:
+            # Fails when the caller cancelled the grounding, and prevents cancelling it from now on otherwise
+            if not result.set_running_or_notify_cancel():
+                return
+            if done.exception() is not None:
+                result.set_exception(done.exception())
+            else:
+                result.set_result(self._remember(done.result(), action_target or user_prompt, phash))
+
+        future.add_done_callback(deliver)
+        return result
+
+    async def aaction(
+        self,
+        sys_prompt,
+        user_prompt,
+        *args,
+        action_target: Optional[str] = None,
+        roi: Optional[Sequence[float]] = None,
+        **kwargs,
+    ):
+        """
+        Async version of action, going through the grounding cache and the region of interest as well
+        """
+        cached, phash = self._cached(sys_prompt, user_prompt, action_target, **kwargs)
+        if cached is not None:
+            return cached
+
+        crop = self._crop(kwargs.get("image"), roi)
+        if crop is not None:
+            attempt: Action = await super().aaction(sys_prompt, user_prompt, *args, **{**kwargs, "image": crop.image})
+            found = self._from_crop(attempt, crop)
+            if found is not None:
+                return self._remember(found, action_target or user_prompt, phash)
+
+        tiles = self._tiles(kwargs.get("image"))
+        if tiles is not None:
+            grounding = await asyncio.wrap_future(self._submit_tiled(sys_prompt, user_prompt, tiles, **kwargs))
+        else:
+            grounding = await super().aaction(sys_prompt, user_prompt, *args, **kwargs)
+        return self._remember(grounding, action_target or user_prompt, phash)
+
+    def _crop(self, image: Optional[ImageInput], roi: Optional[Sequence[float]]) -> Optional[RegionCrop]:
+        if image is None or roi is None:
+            return None
+
+        screenshot = open_image(image)
+        region = roi_region(screenshot.width, screenshot.height, roi, self.roi_size)
+        if region is None:
+            return None
+        return RegionCrop(screenshot.crop(region), region, screenshot.size)
+
+    def _from_crop(self, grounding: Action, crop: RegionCrop) -> Optional[Action]:
+        """
+        Moves a grounding done on a crop to the coordinates of the whole screenshot
+
+        @returns the moved grounding, or None if the element was not found well inside the crop
+        """
+        if grounding.coords is None or not is_inside(grounding.coords, crop.region, *crop.size):
+            return None
+        return self._translate(grounding, crop.region)
+
+    def _translate(self, grounding: Action, region: Region) -> Action:
+        left, top = region[:2]
+        if grounding.coords is not None:
+            grounding.coords = (grounding.coords[0] + left, grounding.coords[1] + top)
+        if grounding.bbox is not None:
+            x1, y1, x2, y2 = grounding.bbox
+            grounding.bbox = (x1 + left, y1 + top, x2 + left, y2 + top)
+        return grounding
+
+    def _tiles(self, image: Optional[ImageInput]) -> Optional[List[RegionCrop]]:
+        if image is None or self.tile_size is None:
+            return None
+
+        screenshot = open_image(image)
+        regions = tile_regions(screenshot.width, screenshot.height, self.tile_size, self.tile_overlap)
+        if len(regions) <= 1:
+            return None
+        return [RegionCrop(screenshot.crop(region), region, screenshot.size) for region in regions]
+
+    def _submit_tiled(self, sys_prompt, user_prompt, tiles: List[RegionCrop], **kwargs) -> Future:
+        """
+        Grounds on every tile in a single batch and keeps the element found by the most tiles
+
+        @returns future resolved with the grounding in coordinates of the whole screenshot
+        """
+        requests: List[GenerationRequest] = []
+        crop_seconds: List[float] = []
+        for tile in tiles:
+            start = time.perf_counter()
+            messages = self.build_messages(sys_prompt, user_prompt, **{**kwargs, "image": tile.image})
+            # Scored so that tiles disagreeing on the element are settled by the confidence of the model
+            requests.append(self.generation_request(messages)._replace(scores=True))
+            crop_seconds.append(time.perf_counter() - start)
+
+        submitted = time.perf_counter()
+        grounding: Future = Future()
+
+        def reconcile(done: Future) -> None:
+            try:
+                generation_seconds = time.perf_counter() - submitted
+                found: List[TileGrounding] = []
+                timings: List[TileTiming] = []
+                for request, output, tile, crop in zip(requests, done.result(), tiles, crop_seconds):
+                    start = time.perf_counter()
+                    tile_grounding = self.parse_action(request.messages, output)
+                    inside = tile_grounding.coords is not None and is_inside(
+                        tile_grounding.coords, tile.region, *tile.size
+                    )
+                    found.append(
+                        TileGrounding(
+                            self._translate(tile_grounding, tile.region),
+                            tile,
+                            inside,
+                            getattr(output, "logprob", None),
+                        )
+                    )
+                    timings.append(
+                        TileTiming(
+                            tile.region,
+                            self.image_tokens(tile.image),
+                            crop,
+                            generation_seconds / len(tiles),
+                            time.perf_counter() - start,
+                            inside,
+                        )
+                    )
+                    logger.info("Tile %s: %s", tile.region, timings[-1])
+
+                self._tile_timings = timings
+                grounding.set_result(self._best_grounding(found))
+            except Exception as e:
+                grounding.set_exception(e)
+
+        self.submit(requests).add_done_callback(reconcile)
+        return grounding
+
+    def _best_grounding(self, found: List[TileGrounding]) -> Action:
+        """
+        Groups the groundings of the tiles that point to the same element, in the overlaps, and picks the group with
+        the most confidence, each tile weighing the probability of its output or 1 when unknown. The grounding of the
+        group is averaged over its tiles with the same weights, ties go to the group closest to the center of its tiles
+        """
+        candidates = [tile for tile in found if tile.inside]
+        if not candidates:
+            # Nothing well inside a tile, the element is probably cut by the tiles, any box is better than none
+            candidates = [tile for tile in found if tile.action.coords is not None] or found[:1]
+
+        def box(action: Action) -> Optional[Tuple[float, ...]]:
+            if action.bbox is not None:
+                return action.bbox
+            if action.coords is None:
+                return None
+            x, y = action.coords
+            return x, y, x, y
+
+        def weight(tile: TileGrounding) -> float:
+            return math.exp(tile.confidence) if tile.confidence is not None else 1.0
+
+        def off_center(tile: TileGrounding) -> float:
+            if tile.action.coords is None:
+                return float("inf")
+            left, top, right, bottom = tile.tile.region
+            x, y = tile.action.coords
+            return abs(x - (left + right) / 2) / (right - left) + abs(y - (top + bottom) / 2) / (bottom - top)
+
+        def same_element(group: List[TileGrounding], tile: TileGrounding) -> bool:
+            first, other = box(group[0].action), box(tile.action)
+            return first is not None and other is not None and iou(first, other) >= 0.5
+
+        groups: List[List[TileGrounding]] = []
+        for tile in candidates:
+            group = next((g for g in groups if same_element(g, tile)), None)
+            if group is None:
+                groups.append([tile])
+            else:
+                group.append(tile)
+
+        best_group = max(groups, key=lambda g: (sum(map(weight, g)), -min(map(off_center, g))))
+        best = max(best_group, key=lambda tile: (weight(tile), -off_center(tile))).action
+
+        def average(values: Sequence[Tuple[Sequence[float], float]]) -> List[float]:
+            total = sum(w for _, w in values)
+            return [sum(v[i] * w for v, w in values) / total for i in range(len(values[0][0]))]
+
+        points = [(tile.action.coords, weight(tile)) for tile in best_group if tile.action.coords is not None]
+        boxes = [(tile.action.bbox, weight(tile)) for tile in best_group if tile.action.bbox is not None]
+        if points:
+            x, y = average(points)
+            best.coords = (x, y)
+        if boxes:
+            x1, y1, x2, y2 = average(boxes)
+            best.bbox = (x1, y1, x2, y2)
+        return best
+
+    @property
+    def tile_timings(self) -> List[TileTiming]:
+        """
+        Timings of the tiles of the last tiled grounding
+        """
+        return self._tile_timings
+
+    def _cached(
+        self, sys_prompt, user_prompt, action_target: Optional[str], **kwargs
+    ) -> Tuple[Optional[Action], Optional[int]]:
+        """
+        @returns grounding cached for the target on a similar screenshot if any, and the hash of the screenshot to
+        remember the grounding with on a miss
+        """
+        image = kwargs.get("image")
+        if self.grounding_cache is None or image is None:
+            return None, None
+
+        target = action_target or user_prompt
+        phash = self.grounding_cache.screen_hash(image)
+        coords = self.grounding_cache.lookup(phash, target)
+        if coords is None:
+            return None, phash
+        return Action(self.build_messages(sys_prompt, user_prompt, **kwargs), target, "", coords=coords), phash
+
+    def _remember(self, grounding: Action, target: Optional[str], phash: Optional[int]) -> Action:
+        if self.grounding_cache is not None and phash is not None and target and grounding.coords is not None:
+            self.grounding_cache.store(phash, target, grounding.coords)
+        return grounding
+
+    @traced("parse.grounding")
+    @recorded_parse
     def parse_action(self, prompt: list[dict[str, str]], model_response: str):
         object_ref_pattern = r"<\|object_ref_start\|>(.*?)<\|object_ref_end\|>"
         box_pattern = r"<\|box_start\|>(.*?)<\|box_end\|>"
@@ -64,11 +566,28 @@ class AtlasActionmodel(QwenVLActionModel, QwenVLModel):
 
         object_ref_content = object_ref_match.group(1).strip() if object_ref_match else None
         box_content = box_match.group(1).strip() if box_match else None
-        coords: Tuple[float, float]
+        coords: Optional[Tuple[float, float]] = None
+        bbox: Optional[Tuple[float, float, float, float]] = None
         if box_content:
             num_pattern = r"(\d+).*?(\d+)"  # Number then closest number to it
-            nums = re.findall(num_pattern, box_content)
-            element_bbox = jnp.asarray([(int(x), int(y)) for x, y in nums])
-            coords = tuple(jnp.mean(element_bbox, axis=0).tolist())
+            points = [(int(x), int(y)) for x, y in re.findall(num_pattern, box_content)]
+            if points:
+                coords = (sum(x for x, _ in points) / len(points), sum(y for _, y in points) / len(points))
+            if len(points) >= 2:
+                bbox = (points[0][0], points[0][1], points[1][0], points[1][1])
+
+        image = _prompt_image(prompt)
+        if image is not None:
+            if coords is not None:
+                coords = self.to_pixels(coords, image)
+            if bbox is not None:
+                bbox = (*self.to_pixels(bbox[:2], image), *self.to_pixels(bbox[2:], image))
+
+        return Action(prompt, object_ref_content, model_response, coords=coords, bbox=bbox)
 
-        return Action(prompt, object_ref_content, model_response, coords=coords)
+    def to_pixels(self, coords: Tuple[float, float], image: ImageInput) -> Tuple[float, float]:
+        """
+        Maps normalized coords given by the model to pixels of the original image, whatever it was resized to
+        """
+        width, height = image_size(image)
+        return coords[0] * width / self.coords_scale, coords[1] * height / self.coords_scale
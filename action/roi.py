@@ -0,0 +1,92 @@
+from typing import List, Optional, Sequence, Tuple
+
+Region = Tuple[int, int, int, int]
+
+
+def roi_region(width: int, height: int, hint: Sequence[float], size: Tuple[int, int]) -> Optional[Region]:
+    """
+    Region of the screenshot to ground on, covering the hint and grown to at least the given size
+
+    @param width: Width of the screenshot
+    @param height: Height of the screenshot
+    @param hint: Box (x1, y1, x2, y2) or point (x, y) the target is expected to be in or near, in pixels
+    @param size: Minimum width and height of the region
+
+    @returns (left, top, right, bottom) of the region, or None if it would cover the whole screenshot anyway
+    """
+    x1, y1, x2, y2 = (hint[0], hint[1], hint[2], hint[3]) if len(hint) == 4 else (hint[0], hint[1], hint[0], hint[1])
+
+    def span(low: float, high: float, minimum: int, limit: int) -> Tuple[int, int]:
+        length = min(max(int(high - low), minimum), limit)
+        start = int((low + high) / 2 - length / 2)
+        # Shifted rather than clipped so the region keeps its size next to the borders
+        start = min(max(start, 0), limit - length)
+        return start, start + length
+
+    left, right = span(x1, x2, size[0], width)
+    top, bottom = span(y1, y2, size[1], height)
+    if (left, top, right, bottom) == (0, 0, width, height):
+        return None
+    return left, top, right, bottom
+
+
+def is_inside(point: Tuple[float, float], region: Region, width: int, height: int, margin: float = 0.02) -> bool:
+    """
+    Whether a point grounded on a crop is well inside it. Points close to a border of the crop that is not a border
+    of the screenshot are likely the model pointing towards a target outside of the crop
+
+    @param point: Coords in pixels of the crop
+    @param region: Region of the screenshot the crop was taken from
+    @param width: Width of the screenshot
+    @param height: Height of the screenshot
+    @param margin: Fraction of the crop side treated as its border
+    """
+    left, top, right, bottom = region
+    x, y = point
+    # Margins only apply to the sides of the crop inside the screenshot, its borders are reachable up to the edge
+    low_x = (right - left) * margin if left > 0 else 0
+    low_y = (bottom - top) * margin if top > 0 else 0
+    high_x = (right - left) * (1 - margin) if right < width else right - left
+    high_y = (bottom - top) * (1 - margin) if bottom < height else bottom - top
+    return low_x <= x <= high_x and low_y <= y <= high_y
+
+
+def tile_regions(width: int, height: int, tile: Tuple[int, int], overlap: float = 0.25) -> List[Region]:
+    """
+    Overlapping tiles covering the whole screenshot, the last tile of each row and column is aligned to the border
+
+    @param width: Width of the screenshot
+    @param height: Height of the screenshot
+    @param tile: Width and height of the tiles, clipped to the screenshot
+    @param overlap: Fraction of the tile side shared by neighbouring tiles
+
+    @returns (left, top, right, bottom) of every tile, row by row
+    """
+
+    def starts(length: int, limit: int) -> List[int]:
+        length = min(length, limit)
+        step = max(int(length * (1 - overlap)), 1)
+        positions = list(range(0, limit - length + 1, step))
+        if positions[-1] != limit - length:
+            positions.append(limit - length)
+        return positions
+
+    tile_width, tile_height = min(tile[0], width), min(tile[1], height)
+    return [
+        (left, top, left + tile_width, top + tile_height)
+        for top in starts(tile_height, height)
+        for left in starts(tile_width, width)
+    ]
+
+
+def iou(a: Sequence[float], b: Sequence[float]) -> float:
+    """
+    Intersection over union of two (x1, y1, x2, y2) boxes
+    """
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
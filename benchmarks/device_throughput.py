@@ -0,0 +1,95 @@
+"""
+Generation throughput of QwenVLModel per device and precision.
+
+Every mode loads the checkpoint in the current process and generates from the same screenshot and prompt, the
+reported tokens per second is the best of the measured runs. A tiny random checkpoint keeps the comparison quick, the
+relative cost of the modes is what matters.
+
+    python benchmarks/device_throughput.py --image .resources/A_720p.png --threads 8
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.models import QwenVLModel  # noqa: E402
+from models.registry import REGISTRY  # noqa: E402
+
+# (device, dtype, cpu_precision) of every mode
+MODES = [
+    ("cuda", "float16", "fp32"),
+    ("cpu", "auto", "fp32"),
+    ("cpu", "auto", "bf16"),
+    ("cpu", "auto", "int8"),
+]
+
+
+def measure(model: QwenVLModel, image: str, max_tokens: int, runs: int) -> Dict[str, Any]:
+    """
+    Generates a few times from the same prompt
+
+    @returns mode of the model, generated tokens and best tokens per second
+    """
+    messages = model.build_messages(None, "Describe this screen.", image=image)
+    request = model.generation_request(messages, max_tokens)
+    model.dispatch([request])
+
+    best = 0.0
+    tokens = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = model.dispatch([request])[0]
+        elapsed = time.perf_counter() - start
+        tokens = model.count_tokens(output)
+        best = max(best, tokens / elapsed)
+    return {
+        "device": model.device,
+        "dtype": model.dtype,
+        "cpu_precision": model.cpu_precision,
+        "tokens": tokens,
+        "tokens_per_second": best,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--model", default="hf-internal-testing/tiny-random-Qwen2VLForConditionalGeneration", help="Checkpoint"
+    )
+    parser.add_argument("--image", required=True, help="Screenshot given with the prompt")
+    parser.add_argument("--max-tokens", type=int, default=64, help="Tokens generated per run")
+    parser.add_argument("--runs", type=int, default=3, help="Measured runs per mode, after a warmup run")
+    parser.add_argument("--threads", type=int, default=None, help="Threads used by torch on the CPU")
+    args = parser.parse_args()
+
+    import torch
+
+    results: List[Dict[str, Any]] = []
+    for device, dtype, cpu_precision in MODES:
+        if device == "cuda" and not torch.cuda.is_available():
+            continue
+        threads: Optional[int] = args.threads if device == "cpu" else None
+        model = QwenVLModel(
+            args.model,
+            execution_mode="inline",
+            device=device,
+            dtype=dtype,
+            cpu_precision=cpu_precision,
+            num_threads=threads,
+            prefix_caching=False,
+        )
+        results.append(measure(model, args.image, args.max_tokens, args.runs))
+        # Frees the model before loading the next mode
+        REGISTRY.evict(model.registry_key)
+
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Import time benchmark guarding the startup of the CLI and of the worker processes.
+
+Each module is imported in a fresh interpreter, which reports its wall time and whether any of the heavy libraries
+that must only be loaded on the first inference got imported. Exits with a non zero status on a regression.
+
+    python benchmarks/import_time.py --max-seconds 2
+"""
+
+import argparse
+import json
+import os
+import subprocess  # nosec B404
+import sys
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported by the CLI entry point and by the worker processes
+ENTRY_POINTS = ["prompting", "models.worker"]
+# Libraries that must not be imported until an inference runs
+HEAVY_MODULES = ["jax", "torch", "transformers", "qwen_vl_utils", "langchain_community"]
+
+PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "heavy": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def measure(module: str, repeat: int) -> Dict[str, Any]:
+    """
+    Imports the module in fresh interpreters and keeps the best wall time
+    """
+    runs: List[Dict[str, Any]] = []
+    for _ in range(repeat):
+        out = subprocess.run(  # nosec B603
+            [sys.executable, "-c", PROBE, module, *HEAVY_MODULES],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {"module": module, "seconds": min(r["seconds"] for r in runs), "heavy": runs[0]["heavy"]}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-seconds", type=float, default=2.0, help="Maximum import time of each entry point")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per entry point")
+    args = parser.parse_args()
+
+    results = [measure(module, args.repeat) for module in ENTRY_POINTS]
+    print(json.dumps(results, indent=2))
+
+    failed = [r for r in results if r["heavy"] or r["seconds"] > args.max_seconds]
+    for result in failed:
+        print(f"{result['module']}: {result['seconds']:.2f}s, heavy imports: {result['heavy']}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Checks that unloading a model gives its memory back, on the CPU.
+
+A checkpoint is loaded in the current process, used for an inference and evicted from the registry a few times. The
+resident memory after every eviction must come back to the baseline taken after the first cycle, which has paid for
+the imports and the allocator warmup. Then the same checkpoint is leased under two precisions with a budget that only
+fits one, the first must be unloaded before the second is loaded.
+
+    python benchmarks/memory_release.py --cycles 5 --tolerance-mb 64
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.memory import release_memory, rss_mb  # noqa: E402
+from models.models import QwenVLModel  # noqa: E402
+from models.registry import REGISTRY  # noqa: E402
+
+
+def cycle(model: QwenVLModel, image: Any, max_tokens: int) -> Dict[str, float]:
+    """
+    Loads the model, runs an inference and evicts it
+
+    @returns resident memory while loaded and after the eviction, and the activations seen by the registry
+    """
+    messages = model.build_messages(None, "Describe this screen.", image=image)
+    model.dispatch([model.generation_request(messages, max_tokens)])
+    loaded_mb = rss_mb()
+    stats = REGISTRY.stats()[model.registry_key]
+    if not REGISTRY.evict(model.registry_key):
+        raise RuntimeError("Model still in use after the inference")
+    return {"loaded_mb": loaded_mb, "evicted_mb": rss_mb(), "activation_mb": stats["activation_mb"]}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--model", default="hf-internal-testing/tiny-random-Qwen2VLForConditionalGeneration", help="Checkpoint"
+    )
+    parser.add_argument("--cycles", type=int, default=5, help="Load, inference and eviction cycles")
+    parser.add_argument("--max-tokens", type=int, default=16, help="Tokens generated per inference")
+    parser.add_argument("--tolerance-mb", type=float, default=64, help="Allowed RSS above the baseline")
+    args = parser.parse_args()
+
+    from PIL import Image
+
+    image = Image.new("RGB", (640, 480), "white")
+    model = QwenVLModel(args.model, execution_mode="inline", device="cpu", cpu_precision="fp32", prefix_caching=False)
+
+    cycles: List[Dict[str, float]] = [cycle(model, image, args.max_tokens)]
+    release_memory()
+    baseline_mb = rss_mb()
+    for _ in range(args.cycles):
+        cycles.append(cycle(model, image, args.max_tokens))
+    leaked_mb = max(c["evicted_mb"] for c in cycles[1:]) - baseline_mb
+
+    # Two registry entries of the same checkpoint, with a budget fitting only one of them
+    first = QwenVLModel(args.model, execution_mode="inline", device="cpu", cpu_precision="fp32")
+    second = first.model_copy(update={"cpu_precision": "bf16"})
+    with first.lease():
+        size_mb = REGISTRY.stats()[first.registry_key]["size_mb"]
+    REGISTRY.memory_budget_mb = size_mb * 1.5
+    with second.lease():
+        resident = list(REGISTRY.stats())
+    REGISTRY.memory_budget_mb = None
+    REGISTRY.clear()
+    budget_respected = resident == [second.registry_key]
+
+    results = {
+        "baseline_mb": baseline_mb,
+        "leaked_mb": leaked_mb,
+        "cycles": cycles,
+        "budget_respected": budget_respected,
+        "memory": {**REGISTRY.memory(), "models": {}},
+    }
+    print(json.dumps(results, indent=2))
+
+    if leaked_mb > args.tolerance_mb:
+        print(f"Resident memory stayed {leaked_mb:.0f}MB above the baseline after eviction", file=sys.stderr)
+        return 1
+    if not budget_respected:
+        print(f"Expected only the second model to be resident, found {resident}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Records plan_task and take_action flows to a trace, then replays them offline.
+
+record runs the flows against the scripted models, or a checkpoint on the CPU, and appends every call and parsed
+result to the trace. replay runs the same flows with every model served from the trace, checks that every parsed
+result matches the recorded one and reports the throughput.
+
+    python benchmarks/replay_flows.py record --trace flows.jsonl --iterations 5
+    python benchmarks/replay_flows.py replay --trace flows.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripted_model import (  # noqa: E402
+    ACTION_OUTPUT,
+    GROUNDING_OUTPUT,
+    PLAN_OUTPUT,
+    ScriptedModel,
+)
+from stages import CONTEXT, TASK, TASK_DESCRIPTION, screenshot  # noqa: E402
+
+from action.base import History  # noqa: E402
+from action.qwen_action import AtlasActionmodel, QwenVLActionModel  # noqa: E402
+from models.models import ModelInterface  # noqa: E402
+from models.recording import TraceRecorder, read_trace  # noqa: E402
+from models.replay import ReplayModel  # noqa: E402
+from planner.qwen_planner import QwenVLPlanner  # noqa: E402
+from prompting import plan_task, take_action  # noqa: E402
+
+
+def build_models(
+    backends: Dict[str, Optional[ModelInterface]], recorder: TraceRecorder, checkpoint: Optional[str]
+) -> Tuple[QwenVLPlanner, QwenVLActionModel, AtlasActionmodel]:
+    settings: Dict[str, Any] = {"recorder": recorder}
+    if checkpoint is not None:
+        settings.update(execution_mode="inline", device="cpu")
+    name = checkpoint or "scripted"
+    return (
+        QwenVLPlanner(name, backend=backends["planner"], **settings),
+        QwenVLActionModel(name, backend=backends["middleman"], **settings),
+        AtlasActionmodel(name, backend=backends["grounding"], **settings),
+    )
+
+
+def run_flows(models: Tuple[QwenVLPlanner, QwenVLActionModel, AtlasActionmodel], iterations: int) -> float:
+    """
+    Plans the task and takes the first step of the plan, on the same screenshot every iteration
+
+    @returns seconds taken by all the iterations
+    """
+    planner, middle_model, action_model = models
+    image = screenshot(1280, 720)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        plan = plan_task(TASK, image, CONTEXT, TASK_DESCRIPTION, planner=planner)
+        take_action(
+            plan.steps[0],
+            History(),
+            image,
+            TASK,
+            plan,
+            CONTEXT,
+            TASK_DESCRIPTION,
+            middle_model=middle_model,
+            action_model=action_model,
+        )
+    return time.perf_counter() - start
+
+
+def parses(path: str) -> Dict[str, List[Tuple[str, Any]]]:
+    """
+    Parsed results of every role in order. Grounding overlaps the middleman, so only the order within a role is fixed
+    """
+    by_role: Dict[str, List[Tuple[str, Any]]] = defaultdict(list)
+    for record in read_trace(path):
+        if record["type"] == "parse":
+            by_role[record["role"]].append((record["prompt"], record["result"]))
+    return by_role
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--trace", required=True, help="Trace file written by record and read by replay")
+    parser.add_argument("--iterations", type=int, default=5, help="Flows recorded")
+    parser.add_argument("--checkpoint", help="Checkpoint run on the CPU to record, the scripted models if None")
+    parser.add_argument("--time-scale", type=float, default=0.0, help="Fraction of the recorded latency replayed")
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        backends: Dict[str, Optional[ModelInterface]] = {"planner": None, "middleman": None, "grounding": None}
+        if args.checkpoint is None:
+            backends = {
+                "planner": ScriptedModel(PLAN_OUTPUT, decode_seconds_per_token=0.001),
+                "middleman": ScriptedModel(ACTION_OUTPUT, decode_seconds_per_token=0.001),
+                "grounding": ScriptedModel(GROUNDING_OUTPUT, decode_seconds_per_token=0.001),
+            }
+        recorder = TraceRecorder(args.trace)
+        seconds = run_flows(build_models(backends, recorder, args.checkpoint), args.iterations)
+        recorder.close()
+        print(json.dumps({"mode": "record", "flows": args.iterations, "seconds": seconds}, indent=2))
+        return 0
+
+    calls = [r for r in read_trace(args.trace) if r["type"] == "call"]
+    iterations = sum(r["role"] == "planner" for r in calls)
+    backends = {
+        role: ReplayModel(args.trace, role=role, time_scale=args.time_scale)
+        for role in ("planner", "middleman", "grounding")
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        replayed_path = os.path.join(tmp, "replayed.jsonl")
+        recorder = TraceRecorder(replayed_path)
+        seconds = run_flows(build_models(backends, recorder, None), iterations)
+        recorder.close()
+        expected, actual = parses(args.trace), parses(replayed_path)
+
+    mismatches = 0
+    for role in expected.keys() | actual.keys():
+        recorded, replayed = expected.get(role, []), actual.get(role, [])
+        mismatches += sum(e != a for e, a in zip(recorded, replayed)) + abs(len(recorded) - len(replayed))
+    results = {
+        "mode": "replay",
+        "flows": iterations,
+        "calls": len(calls),
+        "seconds": seconds,
+        "flows_per_second": iterations / seconds if seconds else None,
+        "recorded_seconds": sum(r["seconds"] for r in calls),
+        "parse_mismatches": mismatches,
+    }
+    print(json.dumps(results, indent=2))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
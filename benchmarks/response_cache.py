@@ -0,0 +1,96 @@
+"""
+Flows served from the persistent response cache, and the cache shared by concurrent processes.
+
+flows runs plan_task and take_action twice against scripted models sharing a cache, the second pass is answered from
+the cache. processes writes and reads the same cache from several processes at once under a size bound small enough
+to evict, then checks that the entries expire after their TTL.
+
+    python benchmarks/response_cache.py --iterations 5 --processes 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+from typing import Any, Dict, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replay_flows import run_flows  # noqa: E402
+from scripted_model import (  # noqa: E402
+    ACTION_OUTPUT,
+    GROUNDING_OUTPUT,
+    PLAN_OUTPUT,
+    ScriptedModel,
+)
+
+from action.qwen_action import AtlasActionmodel, QwenVLActionModel  # noqa: E402
+from models.response_cache import ResponseCache  # noqa: E402
+from planner.qwen_planner import QwenVLPlanner  # noqa: E402
+
+
+def flows(cache: ResponseCache, iterations: int) -> Dict[str, Any]:
+    """
+    @returns seconds of the first and second pass over the flows and the stats of the cache
+    """
+
+    def models() -> Tuple[QwenVLPlanner, QwenVLActionModel, AtlasActionmodel]:
+        return (
+            QwenVLPlanner("scripted", backend=ScriptedModel(PLAN_OUTPUT), response_cache=cache),
+            QwenVLActionModel("scripted", backend=ScriptedModel(ACTION_OUTPUT), response_cache=cache),
+            AtlasActionmodel("scripted", backend=ScriptedModel(GROUNDING_OUTPUT), response_cache=cache),
+        )
+
+    first = run_flows(models(), iterations)
+    second = run_flows(models(), iterations)
+    return {"first_seconds": first, "cached_seconds": second, "speedup": first / second, **cache.stats()}
+
+
+def hammer(args: Tuple[str, int, int]) -> Dict[str, Any]:
+    path, worker, entries = args
+    cache = ResponseCache(path, max_bytes=entries * 512)
+    for i in range(entries):
+        cache.put(f"{worker}-{i}", "x" * 1024)
+        cache.get(f"{(worker + 1) % 2}-{i}")
+    return cache.stats()
+
+
+def processes(path: str, count: int, entries: int) -> Dict[str, Any]:
+    """
+    @returns stats of every process, and whether the cache stayed within its bound and expired its entries
+    """
+    with Pool(count) as pool:
+        stats = pool.map(hammer, [(path, worker, entries) for worker in range(count)])
+    cache = ResponseCache(path, max_bytes=entries * 512, ttl_seconds=0.05)
+    within_bound = cache.stats()["bytes"] <= cache.max_bytes
+    cache.put("fresh", "output")
+    time.sleep(0.1)
+    return {
+        "processes": stats,
+        "within_bound": within_bound,
+        "expired": cache.get("fresh") is None,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5, help="Flows run in each pass")
+    parser.add_argument("--processes", type=int, default=4, help="Processes sharing the cache")
+    parser.add_argument("--entries", type=int, default=200, help="Entries written by every process")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {
+            "flows": flows(ResponseCache(os.path.join(tmp, "flows.sqlite")), args.iterations),
+            "concurrency": processes(os.path.join(tmp, "shared.sqlite"), args.processes, args.entries),
+        }
+    print(json.dumps(results, indent=2))
+    concurrency = results["concurrency"]
+    return 0 if results["flows"]["hits"] and concurrency["within_bound"] and concurrency["expired"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Throughput of concurrent sessions with and without the inference scheduler.
+
+Every session runs take_action in a loop from its own thread, against scripted models sharing one device. Without a
+scheduler their generations run one after the other, with it the requests of each role are batched across sessions.
+
+    python benchmarks/scheduler_throughput.py --sessions 1 4 16 --steps 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripted_model import (  # noqa: E402
+    ACTION_OUTPUT,
+    GROUNDING_OUTPUT,
+    PLAN_OUTPUT,
+    ScriptedModel,
+)
+from stages import CONTEXT, TASK, TASK_DESCRIPTION, screenshot  # noqa: E402
+
+from action.base import History  # noqa: E402
+from action.qwen_action import AtlasActionmodel, QwenVLActionModel  # noqa: E402
+from models.scheduler import InferenceScheduler  # noqa: E402
+from planner.qwen_planner import QwenVLPlanner  # noqa: E402
+from prompting import take_action  # noqa: E402
+
+
+def run(sessions: int, steps: int, scheduler: Optional[InferenceScheduler], args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Runs the sessions to completion
+
+    @returns wall time, actions per second and the stats of the scheduler
+    """
+
+    def scripted(output: str) -> ScriptedModel:
+        return ScriptedModel(
+            output,
+            prefill_seconds_per_token=args.prefill_seconds_per_token,
+            decode_seconds_per_token=args.decode_seconds_per_token,
+        )
+
+    middleman_backend, atlas_backend = scripted(ACTION_OUTPUT), scripted(GROUNDING_OUTPUT)
+    image = screenshot(1280, 720)
+    plan = QwenVLPlanner("scripted-planner").parse_plan([], PLAN_OUTPUT)
+    errors: List[Exception] = []
+
+    def session() -> None:
+        middle_model = QwenVLActionModel("scripted-middleman", backend=middleman_backend, scheduler=scheduler)
+        action_model = AtlasActionmodel("scripted-atlas", backend=atlas_backend, scheduler=scheduler)
+        history = History()
+        try:
+            for _ in range(steps):
+                take_action(
+                    plan.steps[0],
+                    history,
+                    image,
+                    TASK,
+                    plan,
+                    CONTEXT,
+                    TASK_DESCRIPTION,
+                    middle_model=middle_model,
+                    action_model=action_model,
+                )
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    return {
+        "sessions": sessions,
+        "scheduled": scheduler is not None,
+        "seconds": seconds,
+        "actions_per_second": sessions * steps / seconds,
+        "errors": len(errors),
+        "lanes": [{"role": key.role, **stats} for key, stats in scheduler.stats().items()] if scheduler else [],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16], help="Concurrent sessions to measure")
+    parser.add_argument("--steps", type=int, default=5, help="Actions taken by every session")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Largest batch of the scheduler")
+    parser.add_argument("--batch-window", type=float, default=0.01, help="Seconds a lane waits to fill a batch")
+    parser.add_argument("--prefill-seconds-per-token", type=float, default=0.00001, help="Fake prefill time")
+    parser.add_argument("--decode-seconds-per-token", type=float, default=0.002, help="Fake decode time")
+    args = parser.parse_args()
+
+    results = []
+    for sessions in args.sessions:
+        results.append(run(sessions, args.steps, None, args))
+        results.append(run(sessions, args.steps, InferenceScheduler(args.max_batch_size, args.batch_window), args))
+    print(json.dumps(results, indent=2))
+    return 1 if any(r["errors"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
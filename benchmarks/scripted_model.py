@@ -0,0 +1,147 @@
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pydantic import PrivateAttr
+
+from models.models import GenerationRequest, ModelInterface
+from models.tracing import bind, record, span
+
+# Outputs in the formats expected by the parsers of every role
+PLAN_OUTPUT = """<|reasoning_begin|>
+1. What is the current state of the screen?
+- The Odoo contacts list is open
+2. What is needed to complete the task?
+- Create a new contact with the given email and password
+<|reasoning_end|>
+<|steps_begin|>Click on New, Type the email, Type the password, Click on Save<|steps_end|>"""
+
+ACTION_OUTPUT = """<|context_analysis_begin|>
+1. The contacts list is open
+2. The New button creates a contact
+<|context_analysis_end|>
+<|action_begin|>CLICK<|action_end|> [New button]
+"""
+
+GROUNDING_OUTPUT = "<|object_ref_start|>New button<|object_ref_end|><|box_start|>(120,80),(180,110)<|box_end|>"
+
+
+class ScriptedModel(ModelInterface):
+    """
+    Deterministic stand-in for a model, to be used as the backend of the QwenVL models in benchmarks.
+
+    Every generation returns the same canned output, streamed in pieces of chars_per_token characters. Loading,
+    prefill and decoding take the configured fake delays and are recorded as the same stages as a real model. A batch
+    decodes its requests in lockstep, so it takes about as long as a single request.
+    """
+
+    output: str = ""
+    chars_per_token: int = 4
+    load_seconds: float = 0.0
+    prefill_seconds_per_token: float = 0.0
+    decode_seconds_per_token: float = 0.0
+    _loaded: bool = PrivateAttr(default=False)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _device: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, output: str, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, output=output, **kwargs)
+        self.model_name = "scripted"
+
+    def load_model(self) -> Tuple[Any, ...]:
+        with self._lock:
+            if not self._loaded:
+                with span("model.load", model_name=self.model_name):
+                    time.sleep(self.load_seconds)
+                self._loaded = True
+        return ()
+
+    def prompt_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        tokens = 0
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                tokens += self.count_tokens(content)
+                continue
+            for element in content:
+                if "image" in element:
+                    tokens += self.image_tokens(element["image"])
+                else:
+                    tokens += self.count_tokens(element.get("text", ""))
+        return tokens
+
+    def generate_text(
+        self, requests: List[GenerationRequest], on_text: Optional[Callable[[str], None]] = None
+    ) -> List[str]:
+        """
+        Streams the canned output for every request of the batch in lockstep, like a batched generation on a GPU, each
+        ending early when it matches the stop pattern of its request. Batches run one at a time, as on a single device
+
+        @param on_text: Called with each new piece of decoded text of the first request
+        """
+        self.load_model()
+        with self._device:
+            prompt_tokens = [self.prompt_tokens(request.messages) for request in requests]
+            with span("prefill", batch=len(requests), prompt_tokens=sum(prompt_tokens)):
+                time.sleep(self.prefill_seconds_per_token * max(prompt_tokens))
+
+            stops = [re.compile(r.stop_pattern) if r.stop_pattern else None for r in requests]
+            texts = ["" for _ in requests]
+            active = [True for _ in requests]
+            new_tokens = 0
+            start = time.perf_counter()
+            for step, i in enumerate(range(0, len(self.output), self.chars_per_token)):
+                active = [a and step < r.max_tokens for a, r in zip(active, requests)]
+                if not any(active):
+                    break
+                time.sleep(self.decode_seconds_per_token)
+                piece = self.output[i : i + self.chars_per_token]
+                for n, stop in enumerate(stops):
+                    if not active[n]:
+                        continue
+                    new_tokens += 1
+                    texts[n] += piece
+                    if n == 0 and on_text is not None:
+                        on_text(piece)
+                    if stop is not None and stop.search(texts[n]):
+                        active[n] = False
+            end = time.perf_counter()
+        record(
+            "decode",
+            start,
+            end,
+            batch=len(requests),
+            new_tokens=new_tokens,
+            tokens_per_second=new_tokens / max(end - start, 1e-9),
+        )
+        return texts
+
+    def dispatch(self, requests: List[GenerationRequest]) -> List[str]:
+        return self.generate_text(requests)
+
+    def submit(self, requests: List[GenerationRequest], on_text: Optional[Callable[[str], None]] = None) -> Future:
+        future: Future = Future()
+
+        def run() -> None:
+            try:
+                future.set_result(self.generate_text(requests, on_text if len(requests) == 1 else None))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=bind(run), daemon=True).start()
+        return future
+
+    def _call(
+        self,
+        sys_prompt: str,
+        user_prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[Any] = None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
+        messages = [{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}]
+        return messages, self.dispatch([GenerationRequest(messages)])
@@ -0,0 +1,198 @@
+"""
+Per-stage latency of plan_task and take_action.
+
+Every iteration plans a task and takes an action on a synthetic screenshot, recording the stages of both calls:
+prompt building, model load, processor encoding, vision preprocessing, prefill, decode, output decoding, parsing and
+waiting for the grounding. Results are printed as JSON and can be compared against a previous run.
+
+With --model scripted (the default) the models are served by deterministic stand-ins with fake delays, which
+measures the overhead of the pipeline itself and runs anywhere. Any other value is a checkpoint run on the CPU in
+the current process for every role, such as the tiny random Qwen2-VL checkpoint. Its outputs do not parse, failed
+calls are counted and their stages are still reported.
+
+    python benchmarks/stages.py --iterations 20 --output stages.json
+    python benchmarks/stages.py --baseline stages.json --max-regression 0.25
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripted_model import (  # noqa: E402
+    ACTION_OUTPUT,
+    GROUNDING_OUTPUT,
+    PLAN_OUTPUT,
+    ScriptedModel,
+)
+
+from action.base import History  # noqa: E402
+from action.qwen_action import AtlasActionmodel, QwenVLActionModel  # noqa: E402
+from models.tracing import Span, collect, record  # noqa: E402
+from planner.qwen_planner import QwenVLPlanner  # noqa: E402
+from prompting import plan_task, take_action  # noqa: E402
+
+TASK = 'Register a client with email "example@email.com" and password "password123"'
+CONTEXT = """
+- The organization operates in a legal advisory setting.
+- Users are registered in the Odoo system.
+"""
+TASK_DESCRIPTION = """
+- Register the user in Odoo
+- Send email back to user confirming registration
+"""
+
+
+def screenshot(width: int, height: int) -> Any:
+    """
+    Synthetic screenshot with a few window-like blocks
+    """
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for i in range(8):
+        draw.rectangle((40 + i * 150, 60 + i * 70, 160 + i * 150, 100 + i * 70), fill=(30 * i, 120, 200))
+    return image
+
+
+def build_models(args: argparse.Namespace) -> Tuple[QwenVLPlanner, QwenVLActionModel, AtlasActionmodel]:
+    if args.model == "scripted":
+
+        def scripted(output: str) -> ScriptedModel:
+            return ScriptedModel(
+                output,
+                load_seconds=args.load_seconds,
+                prefill_seconds_per_token=args.prefill_seconds_per_token,
+                decode_seconds_per_token=args.decode_seconds_per_token,
+            )
+
+        return (
+            QwenVLPlanner("scripted-planner", backend=scripted(PLAN_OUTPUT)),
+            QwenVLActionModel("scripted-middleman", backend=scripted(ACTION_OUTPUT)),
+            AtlasActionmodel("scripted-atlas", backend=scripted(GROUNDING_OUTPUT)),
+        )
+
+    settings = {"execution_mode": "inline", "device": "cpu", "max_new_tokens": args.max_tokens}
+    return (
+        QwenVLPlanner(args.model, **settings),
+        QwenVLActionModel(args.model, **settings),
+        AtlasActionmodel(args.model, **settings),
+    )
+
+
+def summarize(spans: List[Span]) -> Dict[str, Dict[str, float]]:
+    """
+    Count, mean, p50, p95 and total seconds of every stage
+    """
+    durations: Dict[str, List[float]] = defaultdict(list)
+    for span in spans:
+        durations[span.name].append(span.seconds)
+
+    summary: Dict[str, Dict[str, float]] = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        summary[name] = {
+            "count": len(values),
+            "mean": statistics.mean(values),
+            "p50": values[len(values) // 2],
+            "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+            "total": sum(values),
+        }
+    return summary
+
+
+def regressions(current: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """
+    Stages whose mean got slower than the baseline by more than the given fraction, ignoring sub-millisecond changes
+    """
+    slower = []
+    for name, stage in baseline["stages"].items():
+        mean = current["stages"].get(name, {}).get("mean")
+        if mean is None:
+            continue
+        if mean > stage["mean"] * (1 + max_regression) and mean - stage["mean"] > 1e-3:
+            slower.append(f"{name}: {stage['mean'] * 1000:.1f}ms -> {mean * 1000:.1f}ms")
+    return slower
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="scripted", help='"scripted" or a checkpoint run on the CPU')
+    parser.add_argument("--iterations", type=int, default=10, help="Measured plan_task and take_action calls")
+    parser.add_argument("--warmup", type=int, default=1, help="Iterations run before measuring")
+    parser.add_argument("--width", type=int, default=1280, help="Width of the synthetic screenshot")
+    parser.add_argument("--height", type=int, default=720, help="Height of the synthetic screenshot")
+    parser.add_argument("--max-tokens", type=int, default=32, help="Generation budget of a checkpoint")
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="Fake load time of the scripted models")
+    parser.add_argument("--prefill-seconds-per-token", type=float, default=0.0, help="Fake prefill time")
+    parser.add_argument("--decode-seconds-per-token", type=float, default=0.001, help="Fake decode time")
+    parser.add_argument("--output", help="File the results are written to")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed slowdown of a stage")
+    args = parser.parse_args()
+
+    planner, middle_model, action_model = build_models(args)
+    image = screenshot(args.width, args.height)
+    # take_action is measured against the same plan whatever the planner produced
+    plan = planner.parse_plan([], PLAN_OUTPUT)
+
+    failures = 0
+    spans: List[Span] = []
+    for iteration in range(args.warmup + args.iterations):
+        with collect() as iteration_spans:
+            for name, run in (
+                ("plan_task", lambda: plan_task(TASK, image, CONTEXT, TASK_DESCRIPTION, planner=planner)),
+                (
+                    "take_action",
+                    lambda: take_action(
+                        plan.steps[0],
+                        History(),
+                        image,
+                        TASK,
+                        plan,
+                        CONTEXT,
+                        TASK_DESCRIPTION,
+                        middle_model=middle_model,
+                        action_model=action_model,
+                    ),
+                ),
+            ):
+                start = time.perf_counter()
+                try:
+                    run()
+                except Exception:
+                    failures += iteration >= args.warmup
+                record(name, start, time.perf_counter())
+        if iteration >= args.warmup:
+            spans.extend(iteration_spans)
+
+    results = {
+        "model": args.model,
+        "iterations": args.iterations,
+        "screenshot": [args.width, args.height],
+        "failures": failures,
+        "stages": summarize(spans),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.max_regression)
+        for line in slower:
+            print(f"Regression in {line}", file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
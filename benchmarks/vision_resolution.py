@@ -0,0 +1,79 @@
+"""
+Grounding latency against accuracy at several image resolutions.
+
+Every sample of the dataset is grounded by OS-Atlas with the screenshot resized within each max_pixels setting. A
+grounding is correct when its point falls inside the labelled bbox, given in pixels of the original screenshot.
+
+    python benchmarks/vision_resolution.py --dataset grounding.jsonl --max-pixels 401408 1003520 2007040 0
+
+The dataset has one {"image": path, "target": description, "bbox": [x1, y1, x2, y2]} object per line. A max_pixels
+of 0 keeps the default bounds of qwen_vl_utils.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from action.qwen_action import AtlasActionmodel  # noqa: E402
+from prompting import grounding_prompt  # noqa: E402
+
+
+def load_dataset(path: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def measure(model: AtlasActionmodel, samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Grounds every sample with the given model
+
+    @returns max_pixels, image tokens, latency percentiles in seconds and accuracy
+    """
+    latencies: List[float] = []
+    correct = 0
+    for sample in samples:
+        start = time.perf_counter()
+        grounding = model.action(None, grounding_prompt(sample["target"]), image=sample["image"])
+        latencies.append(time.perf_counter() - start)
+
+        x1, y1, x2, y2 = sample["bbox"]
+        if grounding.coords is not None and x1 <= grounding.coords[0] <= x2 and y1 <= grounding.coords[1] <= y2:
+            correct += 1
+
+    latencies.sort()
+    return {
+        "max_pixels": model.max_pixels,
+        "image_tokens": statistics.mean(model.image_tokens(sample["image"]) for sample in samples),
+        "p50_seconds": latencies[len(latencies) // 2],
+        "p95_seconds": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+        "accuracy": correct / len(samples),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", required=True, help="JSONL file of labelled groundings")
+    parser.add_argument("--model", default="OS-Copilot/OS-Atlas-Base-7B", help="Grounding model")
+    parser.add_argument("--max-pixels", type=int, nargs="+", default=[401408, 1003520, 2007040, 0])
+    parser.add_argument("--warmup", type=int, default=2, help="Samples grounded before measuring each setting")
+    args = parser.parse_args()
+
+    samples = load_dataset(args.dataset)
+    results = []
+    for max_pixels in args.max_pixels:
+        model = AtlasActionmodel(args.model, max_pixels=max_pixels or None)
+        measure(model, samples[: args.warmup])
+        results.append(measure(model, samples))
+
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import logging
+from typing import Callable, Dict, List, NamedTuple, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+TRUNCATION_MARK = " [...]"
+
+
+def approximate_tokens(text: str) -> int:
+    """
+    Rough token count of a text, about 4 characters per token for the tokenizers in use
+    """
+    return (len(text) + 3) // 4
+
+
+class PromptSection(NamedTuple):
+    name: str
+    # Text of the section, or a function rendering it within the given token budget (None if unbounded)
+    content: Union[str, Callable[[Optional[int]], str]]
+    # Sections with the lowest priority are trimmed first
+    priority: int = 0
+
+
+def compress(text: str) -> str:
+    """
+    Drops the indentation, trailing spaces and blank lines of a text
+    """
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def truncate_tokens(text: str, max_tokens: int, count_tokens: Callable[[str], int] = approximate_tokens) -> str:
+    """
+    Longest prefix of the text that fits in the given number of tokens, marked as truncated
+
+    @param text: Text to truncate
+    @param max_tokens: Token budget of the result, mark included
+    @param count_tokens: Function counting the tokens of a text
+
+    @returns the text itself if it fits, a truncated prefix otherwise, or an empty string if not even the mark fits
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    if count_tokens(TRUNCATION_MARK) > max_tokens:
+        return ""
+
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle] + TRUNCATION_MARK) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + TRUNCATION_MARK
+
+
+def fit_sections(
+    sections: List[PromptSection],
+    max_tokens: Optional[int] = None,
+    count_tokens: Callable[[str], int] = approximate_tokens,
+) -> Dict[str, str]:
+    """
+    Renders the sections of a prompt so that together they fit in a token budget.
+
+    Sections are rendered in full if they fit. Otherwise they are compressed and then trimmed, lowest priority first,
+    until the budget is met. Every section that had to be reduced is logged.
+
+    @param sections: Sections of the prompt
+    @param max_tokens: Token budget of all the sections together, unbounded if None
+    @param count_tokens: Function counting the tokens of a text
+
+    @returns rendered text of every section by name
+    """
+    rendered = {s.name: s.content if isinstance(s.content, str) else s.content(None) for s in sections}
+    if max_tokens is None:
+        return rendered
+
+    max_tokens = max(max_tokens, 0)
+    counts = {name: count_tokens(text) for name, text in rendered.items()}
+    for section in sorted(sections, key=lambda s: s.priority):
+        excess = sum(counts.values()) - max_tokens
+        if excess <= 0:
+            break
+
+        allowed = max(counts[section.name] - excess, 0)
+        if isinstance(section.content, str):
+            text = truncate_tokens(compress(rendered[section.name]), allowed, count_tokens)
+        else:
+            text = section.content(allowed)
+
+        logger.info(
+            "Prompt section %s reduced from %d to %d tokens to fit a budget of %d",
+            section.name,
+            counts[section.name],
+            count_tokens(text),
+            max_tokens,
+        )
+        rendered[section.name] = text
+        counts[section.name] = count_tokens(text)
+
+    if sum(counts.values()) > max_tokens:
+        logger.warning("Prompt sections take %d tokens over a budget of %d", sum(counts.values()), max_tokens)
+    return rendered
@@ -0,0 +1,199 @@
+import asyncio
+import concurrent.futures
+from contextlib import asynccontextmanager, contextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+from langchain_core.callbacks import AsyncCallbackManager, CallbackManager
+from langchain_core.callbacks.manager import ahandle_event, handle_event
+from langchain_core.outputs import Generation, LLMResult
+
+from models import tracing
+
+if TYPE_CHECKING:
+    from langchain_core.callbacks import (
+        AsyncCallbackManagerForLLMRun,
+        CallbackManagerForLLMRun,
+    )
+
+    from models.models import ModelInterface
+
+# Name of the custom event carrying the stages of a call to the LangChain callback handlers
+TRACE_EVENT = "model_trace"
+
+
+class CallbackRun:
+    """
+    A model call reported to LangChain callback handlers. Tokens are forwarded as they are generated and the stages of
+    the call are sent as a custom event once it is done
+    """
+
+    def __init__(self, run_manager: Any, on_token: Callable[[str], None], owned: bool = False):
+        self.run_manager = run_manager
+        self.on_text = on_token
+        # Whether the run was started here rather than by LangChain, and is to be ended here as well
+        self.owned = owned
+        self.outputs: List[str] = []
+        # Stages of the call, collected while it runs
+        self.spans: List[tracing.Span] = []
+
+    def end(self, model: "ModelInterface", error: Optional[BaseException] = None) -> None:
+        """
+        Sends the stages of the call to the handlers, and ends the run when it is owned
+        """
+        if error is not None:
+            if self.owned:
+                self.run_manager.on_llm_error(error)
+            return
+
+        data = _trace_data(model, self.spans)
+        handle_event(
+            self.run_manager.handlers,
+            "on_custom_event",
+            "ignore_custom_event",
+            TRACE_EVENT,
+            data,
+            run_id=self.run_manager.run_id,
+            tags=self.run_manager.tags,
+            metadata=self.run_manager.metadata,
+        )
+        if self.owned:
+            self.run_manager.on_llm_end(_result(model, self.outputs, data))
+
+
+def prompt_text(messages: List[Dict[str, Any]]) -> str:
+    """
+    Text of the prompt messages, the format handed to on_llm_start
+    """
+    parts = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(element["text"] for element in content if "text" in element)
+    return "\n".join(parts)
+
+
+def _serialized(model: "ModelInterface") -> Dict[str, Any]:
+    return {"name": model._llm_type, "model_name": model.model_name, "kwargs": dict(model._identifying_params)}
+
+
+def _result(model: "ModelInterface", outputs: List[str], data: Dict[str, Any]) -> LLMResult:
+    return LLMResult(
+        generations=[[Generation(text=output) for output in outputs]],
+        llm_output={"token_usage": data["token_usage"], "model_name": model.model_name},
+    )
+
+
+def _trace_data(model: "ModelInterface", spans: List[tracing.Span]) -> Dict[str, Any]:
+    return {
+        "model_name": model.model_name,
+        "spans": [s.to_dict() for s in spans],
+        "token_usage": tracing.token_usage(spans),
+    }
+
+
+def start_run(model: "ModelInterface", messages: List[Dict[str, Any]]) -> Optional[CallbackRun]:
+    """
+    Starts a run on the callbacks of the model for a call that outlives the frame starting it, such as a streamed one.
+    The caller collects the stages of the call into run.spans and ends the run once the call is done
+
+    @returns the run, None when the model has no callbacks
+    """
+    if not model.callbacks:
+        return None
+    manager = CallbackManager.configure(model.callbacks, None, model.verbose, model.tags, None, model.metadata)
+    run_manager = manager.on_llm_start(_serialized(model), [prompt_text(messages)])[0]
+    return CallbackRun(run_manager, lambda token: run_manager.on_llm_new_token(token) if token else None, owned=True)
+
+
+@contextmanager
+def callback_run(
+    model: "ModelInterface",
+    messages: List[Dict[str, Any]],
+    run_manager: Optional["CallbackManagerForLLMRun"] = None,
+) -> Iterator[Optional[CallbackRun]]:
+    """
+    Reports a call of the model to the run manager given by LangChain or, when called directly, to the callbacks of
+    the model. The run is started and ended here in the latter case.
+
+    Yields None when nothing listens, so that calls without callbacks take no extra work. Otherwise the caller streams
+    the generated text to run.on_text and sets run.outputs. Only the stages of this call are reported, including those
+    run in worker threads and processes, calls running at the same time in other sessions are left out.
+    """
+    if run_manager is None:
+        run = start_run(model, messages)
+        if run is None:
+            yield None
+            return
+    else:
+        manager_run: "CallbackManagerForLLMRun" = run_manager
+        run = CallbackRun(manager_run, lambda token: manager_run.on_llm_new_token(token) if token else None)
+
+    with tracing.collect(run.spans):
+        try:
+            yield run
+        except BaseException as e:
+            run.end(model, e)
+            raise
+    run.end(model)
+
+
+@asynccontextmanager
+async def acallback_run(
+    model: "ModelInterface",
+    messages: List[Dict[str, Any]],
+    run_manager: Optional["AsyncCallbackManagerForLLMRun"] = None,
+) -> AsyncIterator[Optional[CallbackRun]]:
+    """
+    Async version of callback_run. Tokens generated in worker threads are handed to the handlers on the event loop
+    """
+    owned = run_manager is None
+    if run_manager is None:
+        if not model.callbacks:
+            yield None
+            return
+        manager = AsyncCallbackManager.configure(model.callbacks, None, model.verbose, model.tags, None, model.metadata)
+        run_manager = (await manager.on_llm_start(_serialized(model), [prompt_text(messages)]))[0]
+
+    manager_run: "AsyncCallbackManagerForLLMRun" = run_manager
+    loop = asyncio.get_running_loop()
+    tokens: List[concurrent.futures.Future] = []
+
+    def on_token(token: str) -> None:
+        if token:
+            tokens.append(asyncio.run_coroutine_threadsafe(manager_run.on_llm_new_token(token), loop))
+
+    run = CallbackRun(manager_run, on_token)
+    with tracing.collect(run.spans):
+        try:
+            yield run
+        except BaseException as e:
+            if owned:
+                await manager_run.on_llm_error(e)
+            raise
+        finally:
+            await asyncio.gather(*(asyncio.wrap_future(t) for t in tokens), return_exceptions=True)
+
+    data = _trace_data(model, run.spans)
+    await ahandle_event(
+        manager_run.handlers,
+        "on_custom_event",
+        "ignore_custom_event",
+        TRACE_EVENT,
+        data,
+        run_id=manager_run.run_id,
+        tags=manager_run.tags,
+        metadata=manager_run.metadata,
+    )
+    if owned:
+        await manager_run.on_llm_end(_result(model, run.outputs, data))
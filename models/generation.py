@@ -0,0 +1,73 @@
+import re
+import time
+from typing import Any, Callable, List, Optional
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria, TextStreamer
+
+# Helpers that need torch and transformers at import time. Only imported from the inference path
+
+
+class PatternStoppingCriteria(StoppingCriteria):
+    """
+    Stops each sequence of a batch once its generated text matches the stop pattern of its request
+    """
+
+    def __init__(self, tokenizer: Any, prompt_len: int, patterns: List[Optional[str]]):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.patterns = [re.compile(p, re.DOTALL) if p else None for p in patterns]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+        done = [
+            pattern is not None and pattern.search(self.tokenizer.decode(ids[self.prompt_len :])) is not None
+            for ids, pattern in zip(input_ids, self.patterns)
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class CallbackStreamer(TextStreamer):
+    """
+    Hands every piece of decoded text to a callback instead of printing it
+    """
+
+    def __init__(self, tokenizer: Any, on_text: Callable[[str], None], **decode_kwargs: Any):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        self.on_text(text)
+
+
+class FirstTokenTimer(LogitsProcessor):
+    """
+    Notes when the logits of the first new token are ready, which is when the prefill of the prompt ends
+    """
+
+    def __init__(self) -> None:
+        self.first_token_at: Optional[float] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return scores
+
+
+def mean_logprobs(model: Any, generation: Any, prompt_len: int, pad_token_id: Optional[int]) -> List[float]:
+    """
+    Mean log probability of the tokens generated for each conversation of a batch, padding left out
+
+    @param model: Model that generated, with return_dict_in_generate and output_scores
+    @param generation: Output of generate, with the sequences and the scores of every step
+    @param prompt_len: Length of the padded prompts, the generated tokens follow it
+    @param pad_token_id: Token filling the conversations that finished before the rest of the batch
+
+    @returns mean log probability of each conversation, -inf when nothing was generated
+    """
+    transition = model.compute_transition_scores(generation.sequences, generation.scores, normalize_logits=True)
+    generated = generation.sequences[:, prompt_len:]
+    means: List[float] = []
+    for ids, scores in zip(generated, transition):
+        kept = scores[ids != pad_token_id] if pad_token_id is not None else scores
+        means.append(float(kept.mean()) if kept.numel() else float("-inf"))
+    return means
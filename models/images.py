@@ -0,0 +1,224 @@
+import base64
+import hashlib
+import math
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, TypeGuard, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image
+
+# Encoded bytes, array of pixels, PIL image or pixels in shared memory
+InMemoryImage = Union[bytes, "np.ndarray", "Image.Image", "SharedImage"]
+# Path or url, or any in-memory image
+ImageInput = Union[str, InMemoryImage]
+
+# Resize rules of qwen_vl_utils: both sides become multiples of IMAGE_FACTOR and the pixels are kept within the bounds
+IMAGE_FACTOR = 28
+MIN_PIXELS = 4 * 28 * 28
+MAX_PIXELS = 16384 * 28 * 28
+
+
+class SharedImage:
+    """
+    RGB pixels placed in shared memory, so they can be handed to another process without being pickled.
+
+    The process that creates it owns the memory and must call unlink once the other side is done with it.
+    """
+
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def from_image(cls, image: "ImageInput") -> "SharedImage":
+        import numpy as np
+
+        array = np.ascontiguousarray(np.asarray(to_pil(image).convert("RGB")))
+        shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        shared = cls(shm.name, array.shape, str(array.dtype))
+        shm.close()
+        return shared
+
+    def to_array(self) -> "np.ndarray":
+        """
+        Copies the pixels out of shared memory
+        """
+        import numpy as np
+
+        shm = shared_memory.SharedMemory(name=self.name)
+        # Attaching registers the memory with the tracker of this process, which would unlink it on exit
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+        try:
+            return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+
+    def unlink(self) -> None:
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def to_pil(image: "ImageInput") -> "Image.Image":
+    """
+    Decodes an in-memory image. Paths and urls are left for qwen_vl_utils to load
+
+    @param image: Encoded bytes, array of pixels, PIL image or shared image
+    """
+    from PIL import Image
+
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, SharedImage):
+        return Image.fromarray(image.to_array())
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return Image.open(BytesIO(image))
+    if hasattr(image, "__array_interface__"):
+        return Image.fromarray(image)  # type: ignore[arg-type]
+    raise TypeError(f"Unsupported in-memory image type {type(image).__name__}")
+
+
+def open_image(image: "ImageInput") -> "Image.Image":
+    """
+    Opens an image given in any of the supported forms. Files are read lazily, opening one only reads its header
+
+    @param image: Path, url or in-memory image
+    """
+    from PIL import Image
+
+    if not isinstance(image, str):
+        return to_pil(image)
+    if image.startswith("data:image"):
+        return Image.open(BytesIO(base64.b64decode(image.split("base64,", 1)[1])))
+    if image.startswith(("http://", "https://")):
+        import requests
+
+        return Image.open(BytesIO(requests.get(image, timeout=30).content))
+    return Image.open(image[7:] if image.startswith("file://") else image)
+
+
+def image_size(image: "ImageInput") -> Tuple[int, int]:
+    """
+    Size of an image as given, before any resizing by the processor
+
+    @param image: Path, url or in-memory image
+
+    @returns width and height in pixels
+    """
+    # Arrays of pixels and shared images are sized from their shape, without being decoded into a PIL image
+    if hasattr(image, "shape"):
+        return image.shape[1], image.shape[0]
+    return open_image(image).size
+
+
+def resized_size(
+    width: int,
+    height: int,
+    min_pixels: Optional[int] = None,
+    max_pixels: Optional[int] = None,
+) -> Tuple[int, int]:
+    """
+    Size of an image once resized by the processor, the smart_resize arithmetic of qwen_vl_utils without importing it
+    nor decoding the image
+
+    @param width: Width of the image as given
+    @param height: Height of the image as given
+    @param min_pixels: Lower bound on the pixels once resized, the default of qwen_vl_utils when None
+    @param max_pixels: Upper bound on the pixels once resized, the default of qwen_vl_utils when None
+
+    @returns width and height in pixels once resized
+    """
+    min_pixels = MIN_PIXELS if min_pixels is None else min_pixels
+    max_pixels = MAX_PIXELS if max_pixels is None else max_pixels
+    resized_width = max(IMAGE_FACTOR, round(width / IMAGE_FACTOR) * IMAGE_FACTOR)
+    resized_height = max(IMAGE_FACTOR, round(height / IMAGE_FACTOR) * IMAGE_FACTOR)
+    if resized_width * resized_height > max_pixels:
+        beta = math.sqrt(width * height / max_pixels)
+        resized_width = math.floor(width / beta / IMAGE_FACTOR) * IMAGE_FACTOR
+        resized_height = math.floor(height / beta / IMAGE_FACTOR) * IMAGE_FACTOR
+    elif resized_width * resized_height < min_pixels:
+        beta = math.sqrt(min_pixels / (width * height))
+        resized_width = math.ceil(width * beta / IMAGE_FACTOR) * IMAGE_FACTOR
+        resized_height = math.ceil(height * beta / IMAGE_FACTOR) * IMAGE_FACTOR
+    return resized_width, resized_height
+
+
+def is_in_memory(image: Any) -> TypeGuard[InMemoryImage]:
+    return not isinstance(image, str)
+
+
+def image_digest(image: "ImageInput") -> str:
+    """
+    Hash of the content of an image
+
+    @param image: Local path, file:// url, base64 data url, remote url or any in-memory image
+
+    @returns hex digest of the image content, or of the url itself for remote images
+    """
+    if isinstance(image, SharedImage):
+        image = image.to_array()
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image).hexdigest()
+    # PIL images expose __array_interface__ as well, arrays are told apart by their shape
+    if hasattr(image, "shape"):
+        return hashlib.sha256(f"{image.shape}{image.dtype}".encode() + image.tobytes()).hexdigest()  # type: ignore
+    if not isinstance(image, str):
+        return hashlib.sha256(f"{image.size}{image.mode}".encode() + image.tobytes()).hexdigest()
+    if not image.startswith(("http://", "https://", "data:image")):
+        with open(image[7:] if image.startswith("file://") else image, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    return hashlib.sha256(image.encode()).hexdigest()
+
+
+def decode_images(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Copy of the messages where in-memory images are turned into PIL images, the only in-memory type understood by
+    qwen_vl_utils
+    """
+    return [
+        (
+            {
+                **message,
+                "content": [
+                    {**e, "image": to_pil(e["image"])} if is_in_memory(e.get("image", "")) else e
+                    for e in message["content"]
+                ],
+            }
+            if isinstance(message["content"], list)
+            else message
+        )
+        for message in messages
+    ]
+
+
+def share_images(messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[SharedImage]]:
+    """
+    Copy of the messages where decoded images are moved to shared memory. Encoded bytes are small enough to be
+    pickled and are left as they are
+
+    @returns messages to send and shared images to unlink once the other process has answered
+    """
+    shared: List[SharedImage] = []
+
+    def share(element: Dict[str, Any]) -> Dict[str, Any]:
+        image = element.get("image")
+        if image is None or not is_in_memory(image) or isinstance(image, (bytes, bytearray, SharedImage)):
+            return element
+        shared.append(SharedImage.from_image(image))
+        return {**element, "image": shared[-1]}
+
+    return [
+        (
+            {**message, "content": [share(e) for e in message["content"]]}
+            if isinstance(message["content"], list)
+            else message
+        )
+        for message in messages
+    ], shared
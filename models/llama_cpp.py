@@ -0,0 +1,290 @@
+import base64
+import functools
+import re
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from io import BytesIO
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+
+from models import tracing
+from models.callbacks import callback_run
+from models.images import is_in_memory, open_image
+from models.memory import peak_memory_mb
+from models.models import GenerationRequest, ModelInterface
+
+# llama_cpp loads its shared library on import, it is only imported when a model is loaded
+if TYPE_CHECKING:
+    from langchain_core.callbacks import CallbackManagerForLLMRun
+    from llama_cpp import Llama
+
+# Loaded GGUF models, shared by every LlamaCppModel of the process with the same settings. Weights are memory mapped,
+# so processes on the same host share the pages of the file as well
+_LLAMAS: Dict[Tuple[Any, ...], "Llama"] = {}
+_LLAMAS_LOCK = threading.Lock()
+# A llama.cpp context serves one generation at a time
+_GENERATION_LOCKS: Dict[Tuple[Any, ...], threading.Lock] = {}
+
+
+@contextmanager
+def render_special_tokens(llm: "Llama", enabled: bool) -> Iterator[None]:
+    """
+    Makes llama.cpp keep control tokens such as <|box_start|> in the decoded text, like skip_special_tokens=False does
+    for transformers. The parsers of the planner and action models rely on them
+    """
+    if not enabled:
+        yield
+        return
+
+    llm.detokenize = functools.partial(type(llm).detokenize, llm, special=True)  # type: ignore[method-assign]
+    try:
+        yield
+    finally:
+        del llm.detokenize
+
+
+def image_url(image: Any, max_pixels: Optional[int] = None) -> str:
+    """
+    Url of an image element for the chat handler of llama.cpp, local and in-memory images are inlined as data urls
+
+    @param image: Path, url or in-memory image
+    @param max_pixels: Images above this number of pixels are downscaled, keeping their aspect ratio
+    """
+    if not is_in_memory(image) and image.startswith(("http://", "https://", "data:image")) and max_pixels is None:
+        return image
+
+    img = open_image(image).convert("RGB")
+    if max_pixels is not None and img.width * img.height > max_pixels:
+        scale = (max_pixels / (img.width * img.height)) ** 0.5
+        img = img.resize((max(int(img.width * scale), 1), max(int(img.height * scale), 1)))
+
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+class LlamaCppModel(ModelInterface):
+    """
+    Model served by llama.cpp from a quantized GGUF file, for hosts without a GPU.
+
+    The vision side is handled by the multimodal projector given as clip_model_path. It can be used on its own or as
+    the backend of a QwenVLModel, which then hands it every generation instead of running transformers.
+    """
+
+    capabilities: List[str] = ["image", "text"]
+    # Multimodal projector of the model, text only if None
+    clip_model_path: Optional[str] = None
+    # Name of the chat handler of llama_cpp.llama_chat_format matching the model
+    chat_handler: str = "Qwen25VLChatHandler"
+    n_ctx: int = 8192
+    # Threads used for generation, all physical cores if None
+    n_threads: Optional[int] = None
+    # Layers offloaded to a GPU when llama.cpp was built with one, 0 keeps everything on the CPU
+    n_gpu_layers: int = 0
+    use_mmap: bool = True
+    max_new_tokens: int = 512
+    stop_pattern: Optional[str] = None
+
+    def __init__(
+        self,
+        model_path: str,
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.model_name: str = model_path
+
+    @property
+    def cache_key(self) -> Tuple[Any, ...]:
+        return self.model_name, self.clip_model_path, self.chat_handler, self.n_ctx, self.n_threads, self.n_gpu_layers
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        return {
+            **super()._identifying_params,
+            "clip_model_path": self.clip_model_path,
+            "chat_handler": self.chat_handler,
+            "n_ctx": self.n_ctx,
+        }
+
+    def load_model(self) -> Tuple["Llama"]:
+        """
+        Loads the GGUF model and its projector, once per process
+        """
+        with _LLAMAS_LOCK:
+            if self.cache_key not in _LLAMAS:
+                from llama_cpp import Llama, llama_chat_format
+
+                handler = None
+                if self.clip_model_path is not None:
+                    handler = getattr(llama_chat_format, self.chat_handler)(
+                        clip_model_path=self.clip_model_path, verbose=False
+                    )
+                _LLAMAS[self.cache_key] = Llama(
+                    model_path=self.model_name,
+                    chat_handler=handler,
+                    n_ctx=self.n_ctx,
+                    n_threads=self.n_threads,
+                    n_gpu_layers=self.n_gpu_layers,
+                    use_mmap=self.use_mmap,
+                    verbose=False,
+                )
+                _GENERATION_LOCKS[self.cache_key] = threading.Lock()
+            return (_LLAMAS[self.cache_key],)
+
+    def count_tokens(self, text: str) -> int:
+        (llm,) = self.load_model()
+        return len(llm.tokenize(text.encode(), add_bos=False, special=True))
+
+    def build_messages(self, sys_prompt: Optional[str], user_prompt: str, **kwargs: Any) -> List[Dict[str, Any]]:
+        """
+        Builds the chat messages for an inference, in the same format as QwenVLModel
+        """
+        messages: List[Dict[str, Any]] = []
+        if sys_prompt:
+            messages.append({"role": "system", "content": sys_prompt})
+        messages.append(
+            {
+                "role": "user",
+                "content": [
+                    *[{"type": t, t: val} for t, val in kwargs.items() if t in self.capabilities],
+                    {"type": "text", "text": user_prompt},
+                ],
+            }
+        )
+        return messages
+
+    def chat_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Converts messages in the qwen_vl_utils format to the OpenAI format understood by llama.cpp
+        """
+
+        def convert(element: Dict[str, Any]) -> Dict[str, Any]:
+            if "image" not in element:
+                return element
+            return {"type": "image_url", "image_url": {"url": image_url(element["image"], element.get("max_pixels"))}}
+
+        return [
+            {**m, "content": [convert(e) for e in m["content"]]} if isinstance(m["content"], list) else m
+            for m in messages
+        ]
+
+    def generate_text(self, request: GenerationRequest, on_text: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Runs a single request, ending as soon as the output matches its stop pattern
+
+        @param request: Messages and generation settings
+        @param on_text: Called with each new piece of decoded text
+
+        @returns decoded output of the model
+        """
+        (llm,) = self.load_model()
+        stop = re.compile(request.stop_pattern) if request.stop_pattern else None
+        text = ""
+        new_tokens = 0
+        with _GENERATION_LOCKS[self.cache_key], render_special_tokens(llm, not request.skip_special_tokens):
+            start = first_token_at = time.perf_counter()
+            chunks = llm.create_chat_completion(
+                messages=self.chat_messages(request.messages),  # type: ignore[arg-type]
+                max_tokens=request.max_tokens,
+                # llama.cpp still samples at low temperatures, only 0 decodes greedily
+                temperature=0.0 if self.greedy else self.temperature,
+                top_p=self.top_p,
+                stream=True,
+            )
+            for chunk in chunks:
+                piece = chunk["choices"][0]["delta"].get("content") or ""  # type: ignore[index, union-attr]
+                if not new_tokens:
+                    first_token_at = time.perf_counter()
+                # llama.cpp streams one token per chunk
+                new_tokens += 1
+                text += piece
+                if on_text is not None:
+                    on_text(piece)
+                if stop is not None and stop.search(text):
+                    chunks.close()  # type: ignore[union-attr]
+                    break
+            end = time.perf_counter()
+
+        if tracing.enabled():
+            tracing.record("prefill", start, first_token_at, batch=1)
+            tracing.record(
+                "decode",
+                first_token_at,
+                end,
+                batch=1,
+                new_tokens=new_tokens,
+                tokens_per_second=new_tokens / max(end - first_token_at, 1e-9),
+                peak_memory_mb=peak_memory_mb("cpu"),
+            )
+        return text
+
+    def dispatch(self, requests: List[GenerationRequest]) -> List[str]:
+        """
+        Runs the requests one after the other, llama.cpp does not batch multimodal prompts
+        """
+        return self.run_cached(requests, lambda misses: [self.generate_text(request) for request in misses])
+
+    def submit(self, requests: List[GenerationRequest], on_text: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        Starts running the requests without waiting for the result
+
+        @param on_text: Called with each new piece of decoded text. Only supported for a single request
+
+        @returns future resolved with the decoded output of the model for each request, in order
+        """
+        future: Future = Future()
+
+        def run() -> None:
+            try:
+                if on_text is not None and len(requests) == 1:
+                    future.set_result(
+                        self.run_cached(requests, lambda misses: [self.generate_text(misses[0], on_text)], on_text)
+                    )
+                else:
+                    future.set_result(self.dispatch(requests))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=tracing.bind(run), daemon=True).start()
+        return future
+
+    def _call(
+        self,
+        sys_prompt: str,
+        user_prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional["CallbackManagerForLLMRun"] = None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Performs an inference with the GGUF model, reported to the run manager or to the callbacks of the model
+
+        @returns prompt messages and response
+        """
+        messages = self.build_messages(sys_prompt, user_prompt, **kwargs)
+        patterns = [p for p in (self.stop_pattern, *(re.escape(s) for s in stop or [])) if p]
+        request = GenerationRequest(
+            messages,
+            max_tokens or self.max_new_tokens,
+            self.skip_special_tokens,
+            "|".join(f"(?:{p})" for p in patterns) or None,
+        )
+        with callback_run(self, messages, run_manager) as run:
+            if run is None:
+                return messages, self.dispatch([request])
+            run.outputs = [self.generate_text(request, run.on_text)]
+            return messages, run.outputs
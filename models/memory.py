@@ -0,0 +1,117 @@
+import ctypes
+import ctypes.util
+import gc
+import sys
+from types import TracebackType
+from typing import Optional, Type
+
+
+def _cuda_ready() -> bool:
+    # torch is only imported once something else imported it, measuring memory never pulls it in
+    torch = sys.modules.get("torch")
+    return torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized()
+
+
+def rss_mb() -> float:
+    """
+    Resident memory of the current process, in MB
+    """
+    import psutil
+
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def memory_usage_mb(device: Optional[str] = None) -> float:
+    """
+    Memory held by the current process, in MB. CUDA reserved memory when a GPU is in use, RSS otherwise
+
+    @param device: "cpu" to measure RSS even when a GPU is in use
+    """
+    if device != "cpu" and _cuda_ready():
+        import torch
+
+        return torch.cuda.memory_reserved() / 2**20
+    return rss_mb()
+
+
+def allocated_mb(device: str) -> float:
+    """
+    Memory currently held by tensors on the device, RSS on the CPU where allocations cannot be told apart, in MB
+    """
+    if device != "cpu" and _cuda_ready():
+        import torch
+
+        return torch.cuda.memory_allocated() / 2**20
+    return rss_mb()
+
+
+def peak_memory_mb(device: str) -> float:
+    """
+    Peak memory of the current process on the device, in MB. CUDA allocated memory since the last reset of the peak
+    statistics on a GPU, peak RSS over the lifetime of the process otherwise
+    """
+    if device != "cpu" and _cuda_ready():
+        import torch
+
+        return torch.cuda.max_memory_allocated() / 2**20
+
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def release_memory() -> None:
+    """
+    Gives the memory of dropped objects back to the system. Collects reference cycles, empties the CUDA caching
+    allocator and trims the heap of glibc, which otherwise keeps freed CPU tensors mapped and RSS high
+    """
+    gc.collect()
+    if _cuda_ready():
+        import torch
+
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+    libc = ctypes.util.find_library("c")
+    if libc is not None and sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL(libc).malloc_trim(0)
+        except (OSError, AttributeError):
+            # Not glibc, such as musl
+            pass
+
+
+class MemoryMeter:
+    """
+    Measures the memory taken by the work done in a block on a device, on top of what was already held.
+
+    On a GPU the peak statistics of the allocator are reset on entry, so the peak is exact. On the CPU the peak RSS of
+    the process only grows, the activation size is known when the block pushes it higher and 0 otherwise.
+    """
+
+    def __init__(self, device: str):
+        self.device = device
+        self.start_mb = 0.0
+        self.peak_mb = 0.0
+        self.activation_mb = 0.0
+
+    def __enter__(self) -> "MemoryMeter":
+        self._cuda = self.device != "cpu" and _cuda_ready()
+        if self._cuda:
+            import torch
+
+            torch.cuda.reset_peak_memory_stats()
+        self._peak_before = peak_memory_mb(self.device)
+        self.start_mb = allocated_mb(self.device)
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.peak_mb = peak_memory_mb(self.device)
+        if self._cuda or self.peak_mb > self._peak_before:
+            self.activation_mb = max(self.peak_mb - self.start_mb, 0.0)
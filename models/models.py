@@ -1,13 +1,111 @@
-import gc
+import asyncio
+import copy
+import functools
+import hashlib
+import json
+import queue
+import re
+import threading
+import time
 from abc import ABC, abstractmethod
-from multiprocessing import Process, Queue
-from typing import Any, Dict, List, Mapping, Optional, Tuple
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from multiprocessing import Queue
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from langchain_core.language_models.llms import LLM
+
+from models import tracing
+from models.budget import approximate_tokens
+from models.callbacks import acallback_run, callback_run, start_run
+from models.images import (
+    SharedImage,
+    decode_images,
+    image_size,
+    is_in_memory,
+    resized_size,
+    share_images,
+    to_pil,
+)
+from models.memory import MemoryMeter
+from models.prefix_cache import PREFIX_CACHE
+from models.recording import TraceRecorder, prompt_digest
+from models.registry import REGISTRY, RegistryKey
+from models.response_cache import DETERMINISTIC_TEMPERATURE, ResponseCache
+from models.scheduler import InferenceScheduler
+from models.streaming import TextStream
+from models.vision_cache import VISION_CACHE
+from models.worker import CONTEXT, WORKERS
+
+# torch, transformers and qwen_vl_utils take seconds to import, they are only imported on the first inference
+if TYPE_CHECKING:
+    import torch
+    from langchain_core.callbacks import (
+        AsyncCallbackManagerForLLMRun,
+        CallbackManagerForLLMRun,
+    )
+    from transformers import (
+        AutoProcessor,
+        PreTrainedTokenizerBase,
+        Qwen2VLForConditionalGeneration,
+    )
+
+REGISTRY.on_evict.append(PREFIX_CACHE.invalidate)
+REGISTRY.derived_mb.append(PREFIX_CACHE.memory_mb)
+
+# Every image token of Qwen2-VL stands for a merged 2x2 block of 14x14 patches
+IMAGE_TOKEN_PIXELS = 28 * 28
+
+#######
+# BASE TYPES
+#######
+
+
+class GenerationRequest(NamedTuple):
+    """
+    Everything a loaded model needs to serve one inference, kept picklable so it can cross process boundaries
+    """
+
+    messages: List[Dict[str, Any]]
+    max_tokens: int = 512
+    skip_special_tokens: bool = False
+    # Generation ends as soon as the output matches this pattern
+    stop_pattern: Optional[str] = None
+    # Whether the output is returned as a ScoredText, carrying the mean log probability of its tokens
+    scores: bool = False
+
+
+class ScoredText(str):
+    """
+    Decoded output along with the mean log probability of its tokens, a measure of the confidence of the model.
+
+    Only returned for requests asking for scores, and only by the transformers path. Outputs coming from the response
+    cache or from other backends are plain strings.
+    """
+
+    logprob: float
+
+    def __new__(cls, text: str, logprob: float) -> "ScoredText":
+        scored = super().__new__(cls, text)
+        scored.logprob = logprob
+        return scored
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Outputs are pickled back from the worker processes
+        return ScoredText, (str(self), self.logprob)
 
-import torch
-from langchain.callbacks.manager import CallbackManagerForLLMRun
-from langchain.llms.base import LLM
-from qwen_vl_utils import process_vision_info
-from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
 
 #######
 # INTERFACES
@@ -22,6 +120,11 @@ class ModelInterface(LLM, ABC):
     temperature: float = 0.01
     top_p: float = 0.9
     history_len: int = 0
+    # Token budget of the history rendered in the prompts, unbounded if None
+    history_max_tokens: Optional[int] = None
+    # Serves requests identical to earlier ones from this persistent cache when given. Only used when the model
+    # decodes greedily, up to DETERMINISTIC_TEMPERATURE, so that the output depends on the inputs alone
+    response_cache: Optional[ResponseCache] = None
 
     @property
     def _llm_type(self) -> str:
@@ -31,6 +134,13 @@ class ModelInterface(LLM, ABC):
     def _history_len(self) -> int:
         return self.history_len
 
+    @property
+    def greedy(self) -> bool:
+        """
+        Whether generations decode greedily, their output then only depends on the inputs and can be cached
+        """
+        return self.temperature <= DETERMINISTIC_TEMPERATURE
+
     @property
     def _identifying_params(self) -> Mapping[str, Any]:
         """Get the identifying parameters."""
@@ -39,10 +149,20 @@ class ModelInterface(LLM, ABC):
             "temperature": self.temperature,
             "top_p": self.top_p,
             "history_len": self.history_len,
+            "history_max_tokens": self.history_max_tokens,
         }
 
     @abstractmethod
-    def _call(self, sys_prompt: str, user_prompt: str, *args: Any, **kwargs: Any) -> Tuple[List[Dict[str, Any]], str]:
+    def _call(
+        self,
+        sys_prompt: str,
+        user_prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional["CallbackManagerForLLMRun"] = None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
         """
         Performs an inference using qwen-vl based models
 
@@ -57,26 +177,206 @@ class ModelInterface(LLM, ABC):
         """
         pass
 
-    def unload(self, *args: Any) -> None:
+    def count_tokens(self, text: str) -> int:
+        """
+        Number of tokens the text takes in a prompt of the model
+        """
+        return approximate_tokens(text)
+
+    def image_tokens(self, image: Any) -> int:
+        """
+        Number of tokens the image takes in a prompt of the model, one per 28x28 block of pixels as in Qwen2-VL
+        """
+        width, height = image_size(image)
+        return width * height // IMAGE_TOKEN_PIXELS
+
+    def response_key(self, request: GenerationRequest) -> str:
+        """
+        Stable digest of everything a deterministic output depends on: the model, its identifying parameters, the
+        prompt with the content of its images and the generation settings of the request
+        """
+        prompt, _, _ = prompt_digest(request.messages)
+        inputs = {
+            "model": [self._llm_type, self.model_name],
+            "params": dict(self._identifying_params),
+            "prompt": prompt,
+            "max_tokens": request.max_tokens,
+            "skip_special_tokens": request.skip_special_tokens,
+            "stop": request.stop_pattern,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _cache_lookup(self, requests: List[GenerationRequest]) -> Optional[Tuple[List[str], List[Optional[str]]]]:
+        """
+        @returns cache key and cached output of each request, None if the responses of the model are not cached
+        """
+        if self.response_cache is None or not self.greedy:
+            return None
+        keys = [self.response_key(request) for request in requests]
+        return keys, [self.response_cache.get(key) for key in keys]
+
+    def _merge_cached(self, keys: List[str], cached: List[Optional[str]], generated: List[str]) -> List[str]:
+        """
+        Fills the misses with the generated outputs, in order, and stores them in the cache
+        """
+        assert self.response_cache is not None
+        outputs = iter(generated)
+        merged = []
+        for key, output in zip(keys, cached):
+            if output is None:
+                output = next(outputs)
+                self.response_cache.put(key, output)
+            merged.append(output)
+        return merged
+
+    def run_cached(
+        self,
+        requests: List[GenerationRequest],
+        run: Callable[[List[GenerationRequest]], List[str]],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> List[str]:
+        """
+        Serves the requests found in the response cache and generates the others with run
+
+        @param run: Generates the outputs of the requests it is given, in order
+        @param on_text: Called with the cached output of a single request, run is expected to stream it otherwise
+
+        @returns output of each request, in order
+        """
+        lookup = self._cache_lookup(requests)
+        if lookup is None:
+            return run(requests)
+        keys, cached = lookup
+        misses = [request for request, output in zip(requests, cached) if output is None]
+        if not misses and on_text is not None and len(requests) == 1:
+            on_text(cached[0])  # type: ignore[arg-type]
+        return self._merge_cached(keys, cached, run(misses) if misses else [])
+
+    def submit_cached(
+        self,
+        requests: List[GenerationRequest],
+        on_text: Optional[Callable[[str], None]],
+        submit: Callable[[List[GenerationRequest], Optional[Callable[[str], None]]], Future],
+    ) -> Future:
+        """
+        Serves the requests found in the response cache and starts generating the others with submit
+
+        @returns future resolved with the output of each request, in order
+        """
+        lookup = self._cache_lookup(requests)
+        if lookup is None:
+            return submit(requests, on_text)
+        keys, cached = lookup
+        future: Future = Future()
+        misses = [request for request, output in zip(requests, cached) if output is None]
+        if not misses:
+            if on_text is not None and len(requests) == 1:
+                on_text(cached[0])  # type: ignore[arg-type]
+            future.set_result(cached)
+            return future
+
+        def merge(generated: Future) -> None:
+            try:
+                future.set_result(self._merge_cached(keys, cached, generated.result()))
+            except Exception as e:
+                future.set_exception(e)
+
+        submit(misses, on_text).add_done_callback(merge)
+        return future
+
+    @abstractmethod
+    def dispatch(self, requests: List[GenerationRequest]) -> List[str]:
+        """
+        Runs the requests as a single batch
+
+        @param requests: Messages and generation settings of every conversation in the batch
+
+        @returns decoded output of the model for each request, in order
+        """
+        pass
+
+    @abstractmethod
+    def submit(self, requests: List[GenerationRequest], on_text: Optional[Callable[[str], None]] = None) -> Future:
         """
-        Unloads the given items and extras from cuda memory
+        Starts running the requests as a single batch without waiting for the result
+
+        @returns future resolved with the decoded output of the model for each request, in order
         """
-        try:
-            for arg in args:
-                del arg
-            gc.collect()
-            torch.cuda.empty_cache()
-        except Exception:
-            pass
+        pass
 
 
 #######
 # IMPLEMENTATION
 #######
 
+# Tokenizers used to size the prompts, in the calling process for inline models and in the worker process otherwise
+_TOKENIZERS: Dict[str, "PreTrainedTokenizerBase"] = {}
+_TOKENIZERS_LOCK = threading.Lock()
+
+
+def load_tokenizer(model_name: str) -> "PreTrainedTokenizerBase":
+    """
+    Tokenizer of the model, loaded once per process
+    """
+    with _TOKENIZERS_LOCK:
+        if model_name not in _TOKENIZERS:
+            from transformers import AutoTokenizer
+
+            _TOKENIZERS[model_name] = AutoTokenizer.from_pretrained(model_name)
+        return _TOKENIZERS[model_name]
+
+
+def token_count(model_name: str, text: str) -> int:
+    """
+    Number of tokens of the text for the tokenizer of the model, without special tokens
+    """
+    return len(load_tokenizer(model_name)(text, add_special_tokens=False)["input_ids"])
+
+
+# Role markers, vision delimiters and generation prompt added by the chat template
+TEMPLATE_OVERHEAD_TOKENS = 32
+
 
 class QwenVLModel(ModelInterface):
     capabilities: List[str] = ["image", "text"]
+    # "worker" keeps the model resident in a long lived process shared by the models of every role, "process" spawns a
+    # new one per inference and "inline" runs it in the current process through the shared model registry
+    execution_mode: str = "worker"
+    # "auto" places the model on the GPUs when there are any and on the CPU otherwise, "cuda" or "cpu" force either
+    device: str = "auto"
+    dtype: str = "auto"
+    # On the CPU, "bf16" runs a float32 model under bfloat16 autocast, "int8" quantizes its linear layers dynamically
+    # and "fp32" runs it as is
+    cpu_precision: str = "bf16"
+    # Threads used by torch on the CPU, the torch default if None
+    num_threads: Optional[int] = None
+    # The worker is restarted when a request of the model finds it has served this many requests or its memory above
+    # the threshold (in MB)
+    worker_max_requests: Optional[int] = 100
+    worker_max_memory_mb: Optional[float] = None
+    # Memory in MB the models of the process running the inferences may take, weights, cached prefixes and activations
+    # included. In worker mode it covers the models of every role, all served by the same worker. Idle models are
+    # unloaded to stay within it, the budget of the registry is left as is if None
+    memory_budget_mb: Optional[float] = None
+    # Reuse the key values of the system prompt across inferences instead of encoding it on every call
+    prefix_caching: bool = True
+    # Default generation budget, and pattern marking the end of what the parser of the model needs
+    max_new_tokens: int = 512
+    stop_pattern: Optional[str] = None
+    # Bounds on the pixels of the images once resized, every 28x28 block is an image token. The defaults of
+    # qwen_vl_utils are used when None
+    min_pixels: Optional[int] = None
+    max_pixels: Optional[int] = None
+    # Serves the generations instead of transformers when given, such as a LlamaCppModel on hosts without a GPU
+    backend: Optional[ModelInterface] = None
+    # Role of the model in the agent, such as planner, middleman or grounding. Requests of different roles are
+    # scheduled apart
+    role: Optional[str] = None
+    # Batches the requests of concurrent sessions with those of other instances of the same role and model when given,
+    # such as the shared SCHEDULER
+    scheduler: Optional[InferenceScheduler] = None
+    # Appends every call and parsed result to a trace when given, to be replayed offline with a ReplayModel
+    recorder: Optional[TraceRecorder] = None
 
     def __init__(
         self,
@@ -90,16 +390,110 @@ class QwenVLModel(ModelInterface):
     def set_history_len(self, history_len: int = 10) -> None:
         self.history_len = history_len
 
-    def inference(
-        self,
-        sys_prompt: str,
-        user_prompt: str,
-        max_tokens: int = 512,
-        *args: Any,
-        **kwargs: Any,
-    ) -> None:
-        model, processor = self.load_model()
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        return {
+            **super()._identifying_params,
+            "dtype": self.dtype,
+            "cpu_precision": self.cpu_precision,
+            "backend": None if self.backend is None else [self.backend._llm_type, self.backend.model_name],
+        }
+
+    @property
+    def registry_key(self) -> RegistryKey:
+        return RegistryKey(self.model_name, self.dtype, self.device, self.cpu_precision)
+
+    @property
+    def greedy(self) -> bool:
+        # Generations run with the sampling settings of the backend when there is one
+        return self.backend.greedy if self.backend is not None else super().greedy
+
+    def generation_config(self) -> Hashable:
+        """
+        Every setting a batch of requests runs with besides the requests themselves. Batches of instances with the same
+        config give the same outputs whichever of them runs it
+        """
+        return (
+            self._llm_type,
+            self.registry_key,
+            self.execution_mode,
+            self.temperature,
+            self.top_p,
+            self.prefix_caching,
+            self.num_threads,
+            self.memory_budget_mb,
+            self.worker_max_requests,
+            self.worker_max_memory_mb,
+            id(self.backend) if self.backend is not None else None,
+        )
+
+    def __getstate__(self) -> Dict[Any, Any]:
+        state = super().__getstate__()
+        # Copies sent to worker processes run their batches directly, the calls are reported, recorded and cached by
+        # the instance that submitted them. The scheduler, callbacks, recorder and caches may hold threads, locks and
+        # open files that cannot be pickled
+        unsent = [
+            "scheduler",
+            "callbacks",
+            "callback_manager",
+            "recorder",
+            "response_cache",
+            "cache",
+            "custom_get_token_ids",
+        ]
+        state["__dict__"] = {**state["__dict__"], **{name: None for name in unsent if name in state["__dict__"]}}
+        return state
+
+    @contextmanager
+    def lease(self) -> Iterator[Tuple["Qwen2VLForConditionalGeneration", "AutoProcessor"]]:
+        """
+        Gives access to the model and processor shared by every instance with the same registry key
+        """
+        if self.memory_budget_mb is not None:
+            REGISTRY.memory_budget_mb = self.memory_budget_mb
+        with REGISTRY.lease(self.registry_key, self.load_model) as loaded:
+            yield loaded
+
+    def resolved_device(self) -> str:
+        """
+        Device the model runs on, with "auto" resolved according to the GPUs available
+        """
+        import torch
+
+        if self.device == "auto":
+            return "cuda" if torch.cuda.is_available() else "cpu"
+        return self.device
+
+    @contextmanager
+    def precision(self, model: "Qwen2VLForConditionalGeneration") -> Iterator[None]:
+        """
+        Runs the enclosed computations without autograd and, on the CPU, with the configured precision
+        """
+        import torch
+
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
 
+        on_cpu = model.device.type == "cpu"
+        with (
+            torch.inference_mode(),
+            torch.autocast("cpu", dtype=torch.bfloat16, enabled=on_cpu and self.cpu_precision == "bf16"),
+        ):
+            yield
+
+    def build_messages(self, sys_prompt: Optional[str], user_prompt: str, **kwargs: Any) -> List[Dict[str, Any]]:
+        """
+        Builds the chat messages for an inference
+
+        @param sys_prompt: The system prompt to give to the model
+        @param user_prompt: User textual prompt for the model
+
+        @returns list of messages in the chat template format
+
+        Extra kwargs whose name is one of the model capabilities are added as user content, such as an image. Images
+        can be given as a path or url, encoded bytes, a NumPy array or a PIL image, they are resized within the
+        min_pixels and max_pixels of the model.
+        """
         messages: List[Dict[str, Any]] = []
         if sys_prompt:
             messages.append({"role": "system", "content": sys_prompt})
@@ -112,6 +506,7 @@ class QwenVLModel(ModelInterface):
                         {
                             "type": t,
                             t: val,
+                            **(self.image_bounds() if t == "image" else {}),
                         }
                         for t, val in kwargs.items()
                         if t in self.capabilities
@@ -120,70 +515,616 @@ class QwenVLModel(ModelInterface):
                 ],
             },
         )
+        return messages
+
+    def tokenizer(self) -> "PreTrainedTokenizerBase":
+        """
+        Tokenizer of the model, loaded once per process
+        """
+        return load_tokenizer(self.model_name)
+
+    def count_tokens(self, text: str) -> int:
+        if self.backend is not None:
+            return self.backend.count_tokens(text)
+        if self.execution_mode == "worker":
+            # Counted by the worker process serving the model, the caller never imports transformers
+            return WORKERS.count_tokens(self, text).result()
+        return token_count(self.model_name, text)
 
-        text: str = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    def image_bounds(self) -> Dict[str, int]:
+        """
+        Resize bounds added to the image elements of the messages, understood by qwen_vl_utils
+        """
+        bounds = {"min_pixels": self.min_pixels, "max_pixels": self.max_pixels}
+        return {name: value for name, value in bounds.items() if value is not None}
+
+    def image_tokens(self, image: Any) -> int:
+        """
+        Number of tokens the image takes in the prompt once resized by the processor, computed from its size alone
+        """
+        if self.backend is not None:
+            return self.backend.image_tokens(image)
+        width, height = resized_size(*image_size(image), self.min_pixels, self.max_pixels)
+        return width * height // IMAGE_TOKEN_PIXELS
+
+    def prompt_budget(self, sys_prompt: Optional[str], **kwargs: Any) -> int:
+        """
+        Tokens left for the user prompt text, once the system prompt, the images and the generated tokens are
+        accounted for within max_token
 
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
+        @param sys_prompt: The system prompt that will be given to the model
+        @param kwargs: Extra user content, as given to build_messages
+
+        @returns token budget of the user prompt
+        """
+        budget = self.max_token - self.max_new_tokens - TEMPLATE_OVERHEAD_TOKENS
+        if sys_prompt:
+            budget -= self.count_tokens(sys_prompt)
+        if "image" in self.capabilities and kwargs.get("image") is not None:
+            budget -= self.image_tokens(kwargs["image"])
+        return max(budget, 0)
+
+    def generation_request(
+        self,
+        messages: List[Dict[str, Any]],
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> GenerationRequest:
+        """
+        Builds the request for the given messages with the generation settings of the model
+
+        @param messages: Prompt messages
+        @param max_tokens: Maximum number of new tokens, defaults to the budget of the model
+        @param stop: Extra strings that end the generation
+
+        @returns GenerationRequest object
+        """
+        patterns = [p for p in [self.stop_pattern, *map(re.escape, stop or [])] if p]
+        return GenerationRequest(
+            messages,
+            max_tokens or self.max_new_tokens,
+            self.skip_special_tokens,
+            "|".join(f"(?:{p})" for p in patterns) or None,
         )
-        inputs = inputs.to("cuda")
+
+    def run_inference(
+        self,
+        model: "Qwen2VLForConditionalGeneration",
+        processor: "AutoProcessor",
+        requests: List[GenerationRequest],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> List[str]:
+        """
+        Runs a batched generation on an already loaded model
+
+        @param model: Loaded model
+        @param processor: Processor paired with the model
+        @param requests: Messages and generation settings of every conversation in the batch
+        @param on_text: Called with each new piece of decoded text. Only supported for a single request
+
+        @returns decoded output of the model for each request, in order
+        """
+        import torch
+        from transformers import LogitsProcessorList, StoppingCriteriaList
+
+        from models.generation import (
+            CallbackStreamer,
+            FirstTokenTimer,
+            PatternStoppingCriteria,
+            mean_logprobs,
+        )
+
+        inputs = self.encode_inputs(processor, requests)
+        inputs = inputs.to(model.device)
+
+        timer = FirstTokenTimer()
+        generation_kwargs: Dict[str, Any] = {
+            "max_new_tokens": max(request.max_tokens for request in requests),
+            "logits_processor": LogitsProcessorList([timer]),
+            # Set explicitly so that the generation config of the checkpoint does not decide between sampling and
+            # greedy decoding, the response cache relies on greedy meaning deterministic
+            "do_sample": not self.greedy,
+        }
+        if not self.greedy:
+            generation_kwargs.update(temperature=self.temperature, top_p=self.top_p)
+        if any(request.stop_pattern for request in requests):
+            generation_kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [
+                    PatternStoppingCriteria(
+                        processor.tokenizer,
+                        inputs.input_ids.shape[1],
+                        [request.stop_pattern for request in requests],
+                    )
+                ]
+            )
+        if on_text is not None and len(requests) == 1:
+            generation_kwargs["streamer"] = CallbackStreamer(
+                processor.tokenizer,
+                on_text,
+                skip_special_tokens=requests[0].skip_special_tokens,
+                clean_up_tokenization_spaces=False,
+            )
+        scored = any(request.scores for request in requests)
+        if scored:
+            generation_kwargs.update(output_scores=True, return_dict_in_generate=True)
 
         # Inference: Generation of the output
-        with torch.no_grad():
-            generated_ids = model.generate(**inputs, max_new_tokens=max_tokens)
+        start = time.perf_counter()
+        with self.precision(model), MemoryMeter(model.device.type) as meter:
+            generated_ids = None
+            if self.prefix_caching and len(requests) == 1 and not scored:
+                generated_ids = self._generate_from_prefix(model, processor, inputs, requests[0], **generation_kwargs)
+            if generated_ids is None:
+                generated_ids = model.generate(**inputs, **generation_kwargs)
+        end = time.perf_counter()
+        logprobs: List[float] = []
+        if scored:
+            generation, generated_ids = generated_ids, generated_ids.sequences
+            logprobs = mean_logprobs(model, generation, inputs.input_ids.shape[1], processor.tokenizer.pad_token_id)
+        REGISTRY.record_activation(self.registry_key, meter.activation_mb)
 
-        generated_ids_trimmed: List[torch.Tensor] = [
+        generated_ids_trimmed: List["torch.Tensor"] = [
             out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
         ]
+        if tracing.enabled():
+            prefill_end = timer.first_token_at or end
+            grid = inputs.get("image_grid_thw")
+            new_tokens = sum(int(ids.shape[0]) for ids in generated_ids_trimmed)
+            tracing.record(
+                "prefill",
+                start,
+                prefill_end,
+                batch=len(requests),
+                prompt_tokens=int(inputs.attention_mask.sum()),
+                # The vision encoder merges every 2x2 block of patches into one token
+                image_tokens=int(grid.prod(-1).sum()) // 4 if grid is not None else 0,
+            )
+            tracing.record(
+                "decode",
+                prefill_end,
+                end,
+                batch=len(requests),
+                new_tokens=new_tokens,
+                tokens_per_second=new_tokens / max(end - prefill_end, 1e-9),
+                peak_memory_mb=meter.peak_mb,
+                activation_mb=meter.activation_mb,
+            )
+
+        # Conversations that finish earlier than the rest of the batch are filled with padding
+        pad_token_id = processor.tokenizer.pad_token_id
+        with tracing.span("output.decode"):
+            processed_output_text: List[str] = [
+                processor.decode(
+                    ids[ids != pad_token_id] if len(requests) > 1 else ids,
+                    skip_special_tokens=request.skip_special_tokens,
+                    clean_up_tokenization_spaces=False,
+                )
+                for ids, request in zip(generated_ids_trimmed, requests)
+            ]
+        if scored:
+            processed_output_text = [
+                ScoredText(text, logprob) if request.scores else text
+                for text, logprob, request in zip(processed_output_text, logprobs, requests)
+            ]
+
+        inputs = generated_ids = generated_ids_trimmed = generation = None  # type: ignore
+        return processed_output_text
+
+    @tracing.traced("processor.encode")
+    def encode_inputs(self, processor: "AutoProcessor", requests: List[GenerationRequest]) -> Any:
+        """
+        Tokenizes the prompts and preprocesses their images, reusing the images found in the vision cache
+
+        @param processor: Processor paired with the model
+        @param requests: Messages of every conversation in the batch
+
+        @returns model inputs for the whole batch
+        """
+        import torch
+        from qwen_vl_utils import extract_vision_info, fetch_image, process_vision_info
+
+        texts: List[str] = [
+            processor.apply_chat_template(request.messages, tokenize=False, add_generation_prompt=True)
+            for request in requests
+        ]
+        # Generation continues from the end of every prompt, so shorter prompts must be padded on the left
+        processor.tokenizer.padding_side = "left"
+
+        conversations = [request.messages for request in requests]
+        vision_infos = extract_vision_info(conversations)
+        if any("image" not in element for element in vision_infos):
+            with tracing.span("vision.preprocess"):
+                image_inputs, video_inputs = process_vision_info(
+                    [decode_images(messages) for messages in conversations]
+                )
+            return processor(
+                text=texts,
+                images=image_inputs,
+                videos=video_inputs,
+                padding=True,
+                return_tensors="pt",
+            )
 
-        processed_output_text: str = processor.batch_decode(
-            generated_ids_trimmed,
-            skip_special_tokens=self.skip_special_tokens,
-            clean_up_tokenization_spaces=False,
+        pixel_values: List["torch.Tensor"] = []
+        grids: List["torch.Tensor"] = []
+        for element in vision_infos:
+            if isinstance(element["image"], SharedImage):
+                element = {**element, "image": element["image"].to_array()}
+            key = VISION_CACHE.key(element, processor.image_processor)
+            cached = VISION_CACHE.get(key)
+            if cached is None:
+                with tracing.span("vision.preprocess"):
+                    if is_in_memory(element["image"]):
+                        element = {**element, "image": to_pil(element["image"])}
+                    features = processor.image_processor(images=[fetch_image(element)], return_tensors="pt")
+                cached = features["pixel_values"], features["image_grid_thw"]
+                VISION_CACHE.put(key, *cached)
+            pixel_values.append(cached[0])
+            grids.append(cached[1])
+
+        # Every image pad token stands for one merged patch, same expansion as the one done by the processor
+        merge_length = processor.image_processor.merge_size**2
+        image_sizes = iter([int(grid.prod()) // merge_length for grid in grids])
+        for i, text in enumerate(texts):
+            parts = text.split("<|image_pad|>")
+            texts[i] = parts[0] + "".join("<|image_pad|>" * next(image_sizes) + part for part in parts[1:])
+
+        inputs = processor.tokenizer(texts, padding=True, return_tensors="pt")
+        if pixel_values:
+            inputs["pixel_values"] = torch.cat(pixel_values)
+            inputs["image_grid_thw"] = torch.cat(grids)
+        return inputs
+
+    def _generate_from_prefix(
+        self,
+        model: "Qwen2VLForConditionalGeneration",
+        processor: "AutoProcessor",
+        inputs: Any,
+        request: GenerationRequest,
+        **generation_kwargs: Any,
+    ) -> Optional["torch.Tensor"]:
+        """
+        Generates continuing from the cached key values of the system prompt
+
+        @returns generated ids, or None when the prompt has no cacheable prefix
+        """
+        import torch
+        from transformers import DynamicCache
+
+        system = [message for message in request.messages[:1] if message["role"] == "system"]
+        if not system:
+            return None
+
+        prefix: str = processor.apply_chat_template(system, tokenize=False, add_generation_prompt=False)
+        prefix_ids = processor.tokenizer(prefix, return_tensors="pt").input_ids.to(inputs.input_ids.device)
+        input_ids = inputs.input_ids
+        prefix_len, end = prefix_ids.shape[1], input_ids.shape[1] - 1
+        if end <= prefix_len or not torch.equal(input_ids[0, :prefix_len], prefix_ids[0]):
+            return None
+
+        key = PREFIX_CACHE.key(self.registry_key, prefix)
+        cached = PREFIX_CACHE.get(key)
+        if cached is None:
+            # The system prompt is text only, so its rope positions are the same on its own as in the full prompt
+            cached = DynamicCache()
+            model(input_ids=prefix_ids, past_key_values=cached, use_cache=True)
+            PREFIX_CACHE.put(key, cached)
+
+        # Generation extends the cache in place
+        past_key_values = copy.deepcopy(cached)
+
+        # Prefill everything but the last prompt token with the 3D rope positions of the whole prompt, generate then
+        # processes the remaining token and continues decoding from the filled cache
+        position_ids, rope_deltas = model.get_rope_index(
+            input_ids,
+            inputs.get("image_grid_thw"),
+            inputs.get("video_grid_thw"),
+            inputs.attention_mask,
+        )
+        model(
+            input_ids=input_ids[:, prefix_len:end],
+            attention_mask=inputs.attention_mask[:, :end],
+            position_ids=position_ids[:, :, prefix_len:end],
+            past_key_values=past_key_values,
+            pixel_values=inputs.get("pixel_values"),
+            pixel_values_videos=inputs.get("pixel_values_videos"),
+            image_grid_thw=inputs.get("image_grid_thw"),
+            video_grid_thw=inputs.get("video_grid_thw"),
+            cache_position=torch.arange(prefix_len, end, device=input_ids.device),
+            use_cache=True,
+        )
+        model.rope_deltas = rope_deltas
+
+        return model.generate(
+            **inputs,
+            past_key_values=past_key_values,
+            rope_deltas=rope_deltas,
+            **generation_kwargs,
         )
 
-        model = processor = inputs = generated_ids = generated_ids_trimmed = None  # type: ignore
-        self.unload(model, processor, inputs, generated_ids, generated_ids_trimmed)
+    def inference(self, requests: List[GenerationRequest], result_queue: Queue, trace: bool = False) -> None:
+        """
+        Loads the model, serves the requests and releases everything. Meant to be run in a throwaway process
 
-        kwargs["result_queue"].put((messages, processed_output_text))
+        @param trace: Whether the stages are sent back along with the output
+        """
+        with ExitStack() as stack:
+            spans = stack.enter_context(tracing.collect()) if trace else []
+            with self.lease() as (model, processor):
+                processed_output_text = self.run_inference(model, processor, requests)
+
+        model = processor = None  # type: ignore
+        REGISTRY.evict(self.registry_key)
+
+        result_queue.put((processed_output_text, spans))
+
+    def dispatch(self, requests: List[GenerationRequest]) -> List[str]:
+        """
+        Runs the requests as a single batch according to the execution mode of the model
+
+        @param requests: Messages and generation settings of every conversation in the batch
+
+        @returns decoded output of the model for each request, in order
+        """
+        if self.scheduler is not None:
+            return self.submit(requests).result()
+
+        start = time.perf_counter()
+        if self.backend is not None:
+            return self._record(requests, self.run_cached(requests, self.backend.dispatch), start)
+
+        if self.execution_mode == "inline":
+
+            def run(misses: List[GenerationRequest]) -> List[str]:
+                with self.lease() as (model, processor):
+                    return self.run_inference(model, processor, misses)
+
+            return self._record(requests, self.run_cached(requests, run), start)
+
+        return self.submit(requests).result()
+
+    def submit(self, requests: List[GenerationRequest], on_text: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        Starts running the requests without waiting for the result. Those in the response cache of the model are
+        answered from it, the others are queued in the scheduler of the model when it has one, to be batched with the
+        requests of other sessions, and run as a single batch otherwise
+
+        @param requests: Messages and generation settings of every conversation in the batch
+        @param on_text: Called with each new piece of decoded text. Only supported for a single request
+
+        @returns future resolved with the decoded output of the model for each request, in order
+        """
+        start = time.perf_counter()
+        # Cached requests are answered before being queued, only the others wait for a batch
+        if self.scheduler is not None:
+            future = self.submit_cached(requests, on_text, functools.partial(self.scheduler.submit, self))
+        else:
+            future = self.submit_cached(requests, on_text, self.execute)
+
+        if self.recorder is not None:
+            future.add_done_callback(lambda f: f.exception() is None and self._record(requests, f.result(), start))
+        return future
+
+    def _record(self, requests: List[GenerationRequest], outputs: List[str], start: float) -> List[str]:
+        """
+        Appends the calls to the trace of the model when it has a recorder
+        """
+        if self.recorder is not None:
+            self.recorder.record_calls(self.role, self.model_name, requests, outputs, time.perf_counter() - start)
+        return outputs
+
+    def execute(self, requests: List[GenerationRequest], on_text: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        Starts running the requests as a single batch according to the execution mode of the model
+
+        @param requests: Messages and generation settings of every conversation in the batch
+        @param on_text: Called with each new piece of decoded text. Only supported for a single request
+
+        @returns future resolved with the decoded output of the model for each request, in order
+        """
+        if self.backend is not None:
+            return self.backend.submit(requests, on_text)
+
+        future: Future = Future()
+
+        if self.execution_mode == "inline":
+
+            def run() -> None:
+                try:
+                    with self.lease() as (model, processor):
+                        future.set_result(self.run_inference(model, processor, requests, on_text))
+                except Exception as e:
+                    future.set_exception(e)
+
+            threading.Thread(target=tracing.bind(run), daemon=True).start()
+            return future
+
+        # Decoded screenshots go to the other process through shared memory instead of being pickled
+        shared: List[SharedImage] = []
+        sent: List[GenerationRequest] = []
+        for request in requests:
+            messages, request_shared = share_images(request.messages)
+            sent.append(request._replace(messages=messages))
+            shared.extend(request_shared)
+
+        start = time.perf_counter()
+
+        @tracing.bind
+        def release(_: Future) -> None:
+            for image in shared:
+                image.unlink()
+            # Time spent from sending the batch to getting its output back, including the queueing in the worker
+            tracing.record("worker.dispatch", start, time.perf_counter(), mode=self.execution_mode, batch=len(requests))
+
+        if self.execution_mode == "worker":
+            # The model stays loaded in a worker process that is recycled periodically to release its memory
+            future = WORKERS.submit(self, sent, on_text)
+            future.add_done_callback(release)
+            return future
+
+        # This is strictly necessary to ensure ALL memory held by torch is released when the inference is done
+        # Running the inference without this results in many dangling tensors for some reason
+        result_queue: Queue = CONTEXT.Queue()
+        p = CONTEXT.Process(target=self.inference, args=(sent, result_queue, tracing.enabled()))
+        p.start()
+
+        def wait() -> None:
+            try:
+                # The result must be taken out of the queue before joining, a process does not exit until everything
+                # it put in a queue has been consumed
+                while True:
+                    try:
+                        outputs, spans = result_queue.get(timeout=1)
+                        break
+                    except queue.Empty:
+                        if not p.is_alive() and result_queue.empty():
+                            raise RuntimeError(f"Inference process for {self.model_name} exited without answering")
+                p.join()
+                tracing.replay(spans)
+                if on_text is not None and len(outputs) == 1:
+                    on_text(outputs[0])
+                future.set_result(outputs)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                release(future)
+
+        threading.Thread(target=tracing.bind(wait), daemon=True).start()
+        return future
 
     def _call(
         self,
         sys_prompt: str,
         user_prompt: str,
-        max_tokens: int = 512,
+        max_tokens: Optional[int] = None,
         stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        run_manager: Optional["CallbackManagerForLLMRun"] = None,
         *args: Any,
         **kwargs: Any,
-    ) -> Tuple[list[Dict[str, Any]], str]:
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
         """
-        Performs an inference using qwen-vl based models
+        Performs an inference using qwen-vl based models. The call is reported to the run manager or to the callbacks
+        of the model, along with its stages and token usage
         """
-        # This is strictly necessary to ensure ALL memory held by torch is released when the inference is done
-        # Running the inference without this results in many dangling tensors for some reason
-        result_queue: Queue = Queue()
-        kwargs["result_queue"] = result_queue
-        p = Process(
-            target=self.inference,
-            args=(sys_prompt, user_prompt, max_tokens, *args),
-            kwargs=kwargs,
-        )
-        p.start()
-        p.join()
+        messages = self.build_messages(sys_prompt, user_prompt, **kwargs)
+        request = self.generation_request(messages, max_tokens, stop)
+        with callback_run(self, messages, run_manager) as run:
+            if run is None:
+                return messages, self.dispatch([request])
+            run.outputs = self.submit([request], run.on_text).result()
+            return messages, run.outputs
 
-        # result_queue.get() function as a pop. Always save it to a variable or return it directly
-        return result_queue.get()
+    async def _acall(
+        self,
+        sys_prompt: str,
+        user_prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional["AsyncCallbackManagerForLLMRun"] = None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Tuple[list[Dict[str, Any]], List[str]]:
+        """
+        Performs an inference using qwen-vl based models without blocking the event loop
+        """
+        messages = self.build_messages(sys_prompt, user_prompt, **kwargs)
+        request = self.generation_request(messages, max_tokens, stop)
+        async with acallback_run(self, messages, run_manager) as run:
+            outputs = await asyncio.wrap_future(self.submit([request], run.on_text if run is not None else None))
+            if run is not None:
+                run.outputs = outputs
+        return messages, outputs
+
+    def stream_call(
+        self,
+        sys_prompt: Optional[str],
+        user_prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> TextStream:
+        """
+        Performs an inference delivering the output as it is generated. The call is reported to the callbacks of the
+        model like those of _call, its tokens as they are streamed and its stages and token usage once it is done
+
+        @param sys_prompt: The system prompt to give to the model
+        @param user_prompt: User textual prompt for the model
 
-    def load_model(self) -> Tuple[Qwen2VLForConditionalGeneration, AutoProcessor]:
+        @returns TextStream with the prompt messages, the chunks of generated text and the final response
+        """
+        messages = self.build_messages(sys_prompt, user_prompt, **kwargs)
+        request = self.generation_request(messages, max_tokens, stop)
+        stream = TextStream(messages)
+        run = start_run(self, messages)
+        if run is None:
+            return stream.bind(self.submit([request], stream.put))
+
+        def on_text(text: str) -> None:
+            stream.put(text)
+            run.on_text(text)
+
+        def end(generation: Future) -> None:
+            error = generation.exception()
+            run.outputs = generation.result() if error is None else []
+            run.end(self, error)
+
+        with tracing.collect(run.spans):
+            future = self.submit([request], on_text)
+        # Ended before the stream so that the run is complete once the stream is consumed
+        future.add_done_callback(end)
+        return stream.bind(future)
+
+    def batch_call(
+        self,
+        requests: List[Tuple[Optional[str], str, Any]],
+        max_tokens: Optional[int] = None,
+    ) -> List[Tuple[List[Dict[str, Any]], List[str]]]:
+        """
+        Performs several inferences in a single padded batch
+
+        @param requests: (sys_prompt, user_prompt, image) for every inference, image may be None
+        @param max_tokens: Maximum number of new tokens for each inference
+
+        @returns prompt messages and response for each request, in the same format and order as _call
+        """
+        batch: List[GenerationRequest] = []
+        for sys_prompt, user_prompt, image in requests:
+            media = {"image": image} if image is not None else {}
+            messages = self.build_messages(sys_prompt, user_prompt, **media)  # type: ignore[arg-type]
+            batch.append(self.generation_request(messages, max_tokens))
+
+        outputs = self.dispatch(batch) if batch else []
+        return [(request.messages, [output]) for request, output in zip(batch, outputs)]
+
+    def load_model(self) -> Tuple["Qwen2VLForConditionalGeneration", "AutoProcessor"]:
         """
         Loads and returns the model to make inferences on
         """
-        model = Qwen2VLForConditionalGeneration.from_pretrained(self.model_name, torch_dtype="auto", device_map="auto")
-        processor = AutoProcessor.from_pretrained(self.model_name)
+        import torch
+        from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+        device = self.resolved_device()
+        with tracing.span("model.load", model_name=self.model_name, device=device):
+            if device != "cpu":
+                model = Qwen2VLForConditionalGeneration.from_pretrained(
+                    self.model_name,
+                    torch_dtype=self.dtype,
+                    device_map=self.device,
+                )
+            else:
+                # Autocast and dynamic quantization both work from float32 weights
+                model = Qwen2VLForConditionalGeneration.from_pretrained(
+                    self.model_name,
+                    torch_dtype=torch.float32 if self.dtype == "auto" else self.dtype,
+                    device_map="cpu",
+                )
+                if self.cpu_precision == "int8":
+                    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            model.eval()
+
+        with tracing.span("processor.load", model_name=self.model_name):
+            processor = AutoProcessor.from_pretrained(self.model_name)
         return model, processor
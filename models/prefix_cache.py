@@ -0,0 +1,79 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+def cache_size_mb(value: Any) -> float:
+    """
+    Approximate memory taken by the tensors of a key value cache, in MB. Walks nested lists and tuples, the layers of
+    a transformers cache and its key_cache and value_cache lists
+    """
+    if value is None:
+        return 0.0
+    if hasattr(value, "numel"):
+        return value.numel() * value.element_size() / 2**20
+    if isinstance(value, (list, tuple)):
+        return sum(cache_size_mb(v) for v in value)
+    layers = getattr(value, "layers", None)
+    if layers is not None:
+        return sum(cache_size_mb([getattr(layer, "keys", None), getattr(layer, "values", None)]) for layer in layers)
+    return cache_size_mb([getattr(value, "key_cache", None), getattr(value, "value_cache", None)])
+
+
+class PrefixCache:
+    """
+    Bounded LRU store of the past key values computed for a prompt prefix, such as a rendered system prompt.
+
+    Entries are keyed by the model they were computed with and a hash of the prefix text. Cached values must never be
+    used directly for generation since it extends them in place, callers get a copy instead. The size of every entry
+    is kept so that the registry counts it along with the model it was computed with.
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Cached values and their size in MB
+        self._entries: "OrderedDict[Tuple[Hashable, str], Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_key: Hashable, prefix: str) -> Tuple[Hashable, str]:
+        return model_key, hashlib.sha256(prefix.encode()).hexdigest()
+
+    def get(self, key: Tuple[Hashable, str]) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Tuple[Hashable, str], value: Any) -> None:
+        size_mb = cache_size_mb(value)
+        with self._lock:
+            self._entries[key] = (value, size_mb)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def memory_mb(self, model_key: Optional[Hashable] = None) -> float:
+        """
+        Memory taken by the prefixes computed with the given model, or by every prefix if no model is given
+        """
+        with self._lock:
+            return sum(size_mb for k, (_, size_mb) in self._entries.items() if model_key is None or k[0] == model_key)
+
+    def invalidate(self, model_key: Optional[Hashable] = None) -> None:
+        """
+        Drops the prefixes computed with the given model, or every prefix if no model is given
+        """
+        with self._lock:
+            for key in [k for k in self._entries if model_key is None or k[0] == model_key]:
+                del self._entries[key]
+
+
+PREFIX_CACHE = PrefixCache()
@@ -0,0 +1,194 @@
+import functools
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    TypeVar,
+)
+
+from models.images import image_digest
+
+if TYPE_CHECKING:
+    from models.models import GenerationRequest
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Version of the trace format, written in every record
+TRACE_VERSION = 1
+# Hex digits kept from the sha256 digests, enough to never collide within a trace
+DIGEST_LENGTH = 32
+
+
+# Digests of the last encoded images seen, keyed by their bytes. A screenshot is hashed once for its call, its parse
+# and its replay instead of every time. Arrays and PIL images can be modified in place, they are hashed on every use
+_IMAGE_DIGESTS: "OrderedDict[bytes, str]" = OrderedDict()
+_IMAGE_DIGESTS_SIZE = 4
+_IMAGE_DIGESTS_LOCK = threading.Lock()
+
+
+def _digest(data: str) -> str:
+    return hashlib.sha256(data.encode()).hexdigest()[:DIGEST_LENGTH]
+
+
+def _image_digest(image: Any) -> str:
+    if not isinstance(image, bytes):
+        return image_digest(image)[:DIGEST_LENGTH]
+    with _IMAGE_DIGESTS_LOCK:
+        cached = _IMAGE_DIGESTS.get(image)
+        if cached is not None:
+            _IMAGE_DIGESTS.move_to_end(image)
+            return cached
+    digest = image_digest(image)[:DIGEST_LENGTH]
+    with _IMAGE_DIGESTS_LOCK:
+        _IMAGE_DIGESTS[image] = digest
+        while len(_IMAGE_DIGESTS) > _IMAGE_DIGESTS_SIZE:
+            _IMAGE_DIGESTS.popitem(last=False)
+    return digest
+
+
+def prompt_digest(messages: List[Dict[str, Any]]) -> Tuple[str, Optional[str], List[str]]:
+    """
+    Identity of a prompt that does not depend on how its images are held in memory
+
+    @returns digest of the whole prompt, digest of the system prompt if any, and digests of the images in order
+    """
+    images: List[str] = []
+    system: Optional[str] = None
+    canonical = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            elements = []
+            for element in content:
+                if "image" in element:
+                    images.append(_image_digest(element["image"]))
+                    element = {**element, "image": images[-1]}
+                elements.append(element)
+            content = elements
+        if message["role"] == "system":
+            system = _digest(json.dumps(content, sort_keys=True))
+        canonical.append({**message, "content": content})
+    return _digest(json.dumps(canonical, sort_keys=True, default=str)), system, images
+
+
+def parsed_fields(result: Any) -> Dict[str, Any]:
+    """
+    Fields of a parsed Plan or Action, without the prompt and raw output already in the trace
+    """
+    return {k: v for k, v in vars(result).items() if k not in ("prompt", "raw")}
+
+
+class TraceRecorder:
+    """
+    Appends every model call and parsed result to a file, one JSON record per line.
+
+    A call record holds the role and name of the model, the digests of the prompt, system prompt and images, the
+    generation settings, the raw output and the time it took. A parse record holds the parsed fields along with the
+    digest of the prompt it was parsed from. Records are only ever appended, a trace can be read while it is written.
+    Recorders can be pickled along with their models, the copy opens the file again on its first record.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: Optional[TextIO] = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_file"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps({"v": TRACE_VERSION, "time": time.time(), **record}, default=str)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(line + "\n")
+
+    def record_calls(
+        self,
+        role: Optional[str],
+        model_name: Optional[str],
+        requests: List["GenerationRequest"],
+        outputs: List[str],
+        seconds: float,
+    ) -> None:
+        """
+        Records the requests of a batch and their outputs. The time of the batch is given to each of its requests
+        """
+        for request, output in zip(requests, outputs):
+            prompt, system, images = prompt_digest(request.messages)
+            self._write(
+                {
+                    "type": "call",
+                    "role": role,
+                    "model": model_name,
+                    "prompt": prompt,
+                    "system": system,
+                    "images": images,
+                    "max_tokens": request.max_tokens,
+                    "stop": request.stop_pattern,
+                    "output": output,
+                    "seconds": round(seconds, 6),
+                    "batch": len(requests),
+                }
+            )
+
+    def record_parse(self, role: Optional[str], messages: List[Dict[str, Any]], result: Any) -> None:
+        """
+        Records the result parsed from the output of a call
+        """
+        prompt, _, _ = prompt_digest(messages)
+        self._write({"type": "parse", "role": role, "prompt": prompt, "result": parsed_fields(result)})
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def recorded_parse(function: F) -> F:
+    """
+    Decorator recording the results of a parse method of a model, such as parse_plan or parse_action, in the trace of
+    the model when it has a recorder
+    """
+
+    @functools.wraps(function)
+    def wrapper(self: Any, prompt: List[Dict[str, Any]], raw: str) -> Any:
+        result = function(self, prompt, raw)
+        if self.recorder is not None:
+            self.recorder.record_parse(self.role, prompt, result)
+        return result
+
+    return wrapper  # type: ignore[return-value]
+
+
+def read_trace(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Records of a trace in the order they were written, skipping a last line still being written
+    """
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            record = json.loads(line)
+            if record.get("v") != TRACE_VERSION:
+                raise ValueError(f"Unsupported trace version {record.get('v')} in {path}")
+            yield record
@@ -0,0 +1,217 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from models.memory import memory_usage_mb, release_memory
+
+logger = logging.getLogger(__name__)
+
+
+class RegistryKey(NamedTuple):
+    model_name: str
+    dtype: str
+    device: str
+    # Precision of the computations when the model runs on the CPU
+    cpu_precision: str = "bf16"
+
+
+class RegisteredModel:
+    """
+    A resident model with its processor, usage count, approximate size and the largest memory its inferences took on
+    top of the weights
+    """
+
+    def __init__(self, loaded: Tuple[Any, ...], size_mb: float, activation_mb: float = 0.0):
+        self.loaded = loaded
+        self.size_mb = size_mb
+        self.activation_mb = activation_mb
+        self.refs = 0
+        self.last_used = time.monotonic()
+        # Held while the model runs, generation keeps state on the modules such as the rope deltas of Qwen2-VL
+        self.generation_lock = threading.Lock()
+
+
+def model_size_mb(model: Any) -> float:
+    """
+    Approximate memory taken by the parameters and buffers of a torch model, in MB
+    """
+    tensors = [*model.parameters(), *model.buffers()]
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+class ModelRegistry:
+    """
+    Process wide store of loaded models, deduplicated by (model_name, dtype, device, cpu_precision).
+
+    Models in use are reference counted and never evicted. The budget covers the weights of every resident model, the
+    state derived from it such as cached prefixes, and the activations of the models in use. When loading or using a model would go above it, the least recently used
+    models that are not in use are unloaded first, and their memory is given back to the system before going on.
+    """
+
+    def __init__(self, memory_budget_mb: Optional[float] = None):
+        self.memory_budget_mb = memory_budget_mb
+        self._models: Dict[RegistryKey, RegisteredModel] = {}
+        # Sizes and activations of models seen before, used to make room before loading them again
+        self._known_sizes: Dict[RegistryKey, float] = {}
+        self._known_activations: Dict[RegistryKey, float] = {}
+        # Called with the key of every evicted model, so state derived from it can be dropped as well
+        self.on_evict: List[Callable[[RegistryKey], None]] = []
+        # Memory in MB of the state derived from a model, such as cached key values, counted with the model
+        self.derived_mb: List[Callable[[RegistryKey], float]] = []
+        self._lock = threading.RLock()
+
+    @property
+    def resident_mb(self) -> float:
+        """
+        Weights and derived state of the resident models, and activations of those in use
+        """
+        total = 0.0
+        for key, entry in self._models.items():
+            total += entry.size_mb + sum(derived(key) for derived in self.derived_mb)
+            total += entry.activation_mb if entry.refs else 0.0
+        return total
+
+    def acquire(self, key: RegistryKey, loader: Callable[[], Tuple[Any, ...]]) -> Tuple[Any, ...]:
+        """
+        Returns the loaded model for the key, loading it if needed. Every acquire must be paired with a release
+
+        @param key: Identity of the model
+        @param loader: Function loading the model and its processor
+
+        @returns whatever the loader returned
+        """
+        with self._lock:
+            entry = self._models.get(key)
+            activation_mb = self._known_activations.get(key, 0.0)
+            if entry is None:
+                self._make_room(self._known_sizes.get(key, 0.0) + activation_mb, key)
+                loaded = loader()
+                entry = RegisteredModel(loaded, model_size_mb(loaded[0]), activation_mb)
+                self._models[key] = entry
+                self._known_sizes[key] = entry.size_mb
+                # The size of a model loaded for the first time is only known now
+                self._make_room(activation_mb, key)
+            elif entry.refs == 0:
+                self._make_room(entry.activation_mb, key)
+            entry.refs += 1
+            entry.last_used = time.monotonic()
+            return entry.loaded
+
+    def release(self, key: RegistryKey) -> None:
+        """
+        Marks one user of the model as done with it
+        """
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                return
+            entry.refs = max(entry.refs - 1, 0)
+            entry.last_used = time.monotonic()
+            self._make_room(0.0)
+
+    def record_activation(self, key: RegistryKey, activation_mb: float) -> None:
+        """
+        Notes the memory an inference of the model took on top of its weights. The largest seen is reserved whenever
+        the model is used
+        """
+        with self._lock:
+            self._known_activations[key] = max(self._known_activations.get(key, 0.0), activation_mb)
+            entry = self._models.get(key)
+            if entry is not None:
+                entry.activation_mb = self._known_activations[key]
+
+    @contextmanager
+    def lease(self, key: RegistryKey, loader: Callable[[], Tuple[Any, ...]]) -> Iterator[Tuple[Any, ...]]:
+        """
+        Context manager version of acquire and release. Leases of the same model run one at a time, the model is shared
+        by every user of the key and cannot run concurrent generations
+        """
+        loaded = self.acquire(key, loader)
+        try:
+            # In use, so never evicted while waiting for the lock
+            with self._models[key].generation_lock:
+                yield loaded
+        finally:
+            loaded = None  # type: ignore
+            self.release(key)
+
+    def evict(self, key: RegistryKey) -> bool:
+        """
+        Unloads a model if it is not in use, returning its memory to the system before returning
+
+        @returns whether the model was unloaded
+        """
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None or entry.refs > 0:
+                return False
+            del self._models[key]
+            entry.loaded = ()
+        for callback in self.on_evict:
+            callback(key)
+        release_memory()
+        return True
+
+    def clear(self) -> List[RegistryKey]:
+        """
+        Unloads every model that is not in use
+
+        @returns keys of the unloaded models
+        """
+        with self._lock:
+            return [key for key in list(self._models) if self.evict(key)]
+
+    def stats(self) -> Dict[RegistryKey, Dict[str, Any]]:
+        """
+        Size, activations, users and last use of every resident model
+        """
+        with self._lock:
+            return {
+                key: {
+                    "size_mb": entry.size_mb,
+                    "activation_mb": entry.activation_mb,
+                    "refs": entry.refs,
+                    "last_used": entry.last_used,
+                }
+                for key, entry in self._models.items()
+            }
+
+    def memory(self) -> Dict[str, Any]:
+        """
+        Memory accounted for by the registry against what the process actually holds
+
+        @returns budget, accounted and process memory in MB, and the stats of every resident model
+        """
+        with self._lock:
+            return {
+                "budget_mb": self.memory_budget_mb,
+                "accounted_mb": self.resident_mb,
+                "process_mb": memory_usage_mb(),
+                "models": self.stats(),
+            }
+
+    def _make_room(self, incoming_mb: float, incoming: Optional[RegistryKey] = None) -> None:
+        """
+        Evicts idle models, least recently used first, until the incoming memory fits in the budget
+        """
+        if self.memory_budget_mb is None:
+            return
+
+        # Ties are broken by key so the same state always evicts the same models
+        idle = sorted((e.last_used, key) for key, e in self._models.items() if e.refs == 0 and key != incoming)
+        for _, key in idle:
+            if self.resident_mb + incoming_mb <= self.memory_budget_mb:
+                return
+            self.evict(key)
+        if self.resident_mb + incoming_mb > self.memory_budget_mb:
+            logger.warning(
+                "Models in use take %.0fMB, %.0fMB more does not fit in the budget of %.0fMB",
+                self.resident_mb,
+                incoming_mb,
+                self.memory_budget_mb,
+            )
+
+
+REGISTRY = ModelRegistry()
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from pydantic import PrivateAttr
+
+from models import tracing
+from models.models import GenerationRequest, ModelInterface
+from models.recording import prompt_digest, read_trace
+
+if TYPE_CHECKING:
+    from langchain_core.callbacks import CallbackManagerForLLMRun
+
+
+class ReplayModel(ModelInterface):
+    """
+    Serves the outputs recorded in a trace instead of running a model, to re-run flows offline and at CPU speed.
+
+    Outputs are looked up by the digest of the prompt, images included, so a flow given the same inputs as when it
+    was recorded gets the same outputs in the same order. It can be used as the backend of the planner and action
+    models, in place of the models they were recorded with.
+    """
+
+    trace_path: str = ""
+    # Only replays calls of this role when given, such as planner, middleman or grounding
+    role: Optional[str] = None
+    # A prompt that was not recorded raises a KeyError when True. Otherwise it gets the next recorded output with the
+    # same system prompt, which replays an incident whose screenshots were not kept
+    strict: bool = True
+    # Fraction of the recorded time each call takes, 0 answers at once and 1 reproduces the recorded latency
+    time_scale: float = 0.0
+    _by_prompt: Dict[str, Deque[Dict[str, Any]]] = PrivateAttr(default_factory=lambda: defaultdict(deque))
+    _by_system: Dict[Optional[str], Deque[Dict[str, Any]]] = PrivateAttr(default_factory=lambda: defaultdict(deque))
+    _served: set = PrivateAttr(default_factory=set)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, trace_path: str, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, trace_path=trace_path, **kwargs)
+        self.model_name = f"replay:{trace_path}"
+        self.load_model()
+
+    def load_model(self) -> Tuple[Any, ...]:
+        """
+        Indexes the calls of the trace
+        """
+        with self._lock:
+            self._by_prompt.clear()
+            self._by_system.clear()
+            self._served.clear()
+            for record in read_trace(self.trace_path):
+                if record["type"] != "call" or (self.role is not None and record["role"] != self.role):
+                    continue
+                self._by_prompt[record["prompt"]].append(record)
+                self._by_system[record["system"]].append(record)
+        return ()
+
+    def _next(self, request: GenerationRequest) -> Dict[str, Any]:
+        prompt, system, _ = prompt_digest(request.messages)
+        with self._lock:
+            for queue in (self._by_prompt[prompt], self._by_system[system] if not self.strict else deque()):
+                while queue and id(queue[0]) in self._served:
+                    queue.popleft()
+                if queue:
+                    record = queue.popleft()
+                    self._served.add(id(record))
+                    return record
+        raise KeyError(f"No recorded output left for prompt {prompt} in {self.trace_path}")
+
+    def generate_text(self, request: GenerationRequest, on_text: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Gives the recorded output of the request, in one piece
+        """
+        record = self._next(request)
+        if self.time_scale:
+            time.sleep(record["seconds"] * self.time_scale)
+        if on_text is not None:
+            on_text(record["output"])
+        return record["output"]
+
+    def dispatch(self, requests: List[GenerationRequest]) -> List[str]:
+        return [self.generate_text(request) for request in requests]
+
+    def submit(self, requests: List[GenerationRequest], on_text: Optional[Callable[[str], None]] = None) -> Future:
+        future: Future = Future()
+
+        def run() -> None:
+            try:
+                if on_text is not None and len(requests) == 1:
+                    future.set_result([self.generate_text(requests[0], on_text)])
+                else:
+                    future.set_result(self.dispatch(requests))
+            except Exception as e:
+                future.set_exception(e)
+
+        # Answers at once unless the recorded latency is reproduced
+        if self.time_scale:
+            threading.Thread(target=tracing.bind(run), daemon=True).start()
+        else:
+            run()
+        return future
+
+    def _call(
+        self,
+        sys_prompt: str,
+        user_prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional["CallbackManagerForLLMRun"] = None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Replays the output recorded for a prompt built like the one of QwenVLModel without image bounds
+
+        @returns prompt messages and response
+        """
+        content: List[Dict[str, Any]] = [{"type": t, t: v} for t, v in kwargs.items() if t in ("image", "text")]
+        messages: List[Dict[str, Any]] = [
+            *([{"role": "system", "content": sys_prompt}] if sys_prompt else []),
+            {"role": "user", "content": [*content, {"type": "text", "text": user_prompt}]},
+        ]
+        return messages, self.dispatch([GenerationRequest(messages)])
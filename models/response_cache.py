@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# Temperatures up to this one are treated as greedy decoding, whose output only depends on the inputs
+DETERMINISTIC_TEMPERATURE = 0.01
+# Seconds the access time of an entry may lag behind, hits within it are plain reads
+ACCESS_RESOLUTION = 1.0
+
+
+class ResponseCache:
+    """
+    Persistent cache of model outputs in a SQLite file, shared by every process using the same path.
+
+    Entries expire after the TTL and the least recently used ones are evicted once the outputs go above max_bytes.
+    The database is in WAL mode and writes take an immediate lock, so worker processes can read and write it at the
+    same time. Lookups are plain reads that never wait for the lock, they only write back an expired entry or an
+    access time older than ACCESS_RESOLUTION. Hit and miss counts are kept per process.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 2**28, ttl_seconds: Optional[float] = 7 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connections: Dict[Any, sqlite3.Connection] = {}
+        self._lock = threading.Lock()
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses"
+                " (key TEXT PRIMARY KEY, output TEXT NOT NULL, size INTEGER NOT NULL, created REAL, accessed REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Models holding the cache are pickled to worker processes, connections are opened again on first use there
+        state = self.__dict__.copy()
+        state["_connections"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared across threads nor survive a fork
+        owner = os.getpid(), threading.get_ident()
+        with self._lock:
+            db = self._connections.get(owner)
+            if db is None:
+                db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                self._connections[owner] = db
+            return db
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self._connection())
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        @returns the cached output for the key, None if missing or expired
+        """
+        now = time.time()
+        query = "SELECT output, created, accessed FROM responses WHERE key = ?"
+        row = self._connection().execute(query, (key,)).fetchone()
+        if row is not None and self.ttl_seconds is not None and row[1] < now - self.ttl_seconds:
+            with self._transaction() as db:
+                # Unless another process stored a fresh output in the meantime
+                db.execute("DELETE FROM responses WHERE key = ? AND created = ?", (key, row[1]))
+            row = None
+        elif row is not None and row[2] < now - ACCESS_RESOLUTION:
+            # The access time only orders evictions, it is kept roughly up to date rather than written on every hit
+            with self._transaction() as db:
+                db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, key: str, output: str) -> None:
+        """
+        Stores an output, evicting the least recently used ones when the cache goes above its size
+        """
+        now = time.time()
+        size = len(output.encode())
+        evicted = 0
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, output, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, output, size, now, now),
+            )
+            if self.ttl_seconds is not None:
+                evicted += db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,)).rowcount
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = db.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 64").fetchall()
+                if not oldest:
+                    break
+                for old_key, old_size in oldest:
+                    if total <= self.max_bytes:
+                        break
+                    db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= old_size
+                    evicted += 1
+        with self._lock:
+            self.evictions += evicted
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Hits, misses and evictions of this process, and entries and bytes held by the cache
+        """
+        entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM responses")
+
+
+class _Transaction:
+    """
+    Write transaction taking the database lock up front, so concurrent writers wait instead of failing to upgrade
+    """
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
@@ -0,0 +1,256 @@
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+from models import tracing
+
+if TYPE_CHECKING:
+    from models.models import GenerationRequest, QwenVLModel
+
+
+class SchedulingOptions(NamedTuple):
+    # Higher priorities are batched first
+    priority: int = 0
+    # Seconds a request may wait in the queue before failing with a TimeoutError, unbounded if None
+    timeout: Optional[float] = None
+
+
+class LaneKey(NamedTuple):
+    role: Optional[str]
+    # Every setting the batches of the lane run with besides the requests, see QwenVLModel.generation_config
+    config: Hashable
+
+
+# Options of the requests submitted from the current thread or task, set by InferenceScheduler.options
+_OPTIONS: ContextVar[SchedulingOptions] = ContextVar("scheduling_options", default=SchedulingOptions())
+
+
+class ScheduledRequest:
+    """
+    A generation request waiting in a lane, with the future its output is delivered to
+    """
+
+    def __init__(
+        self,
+        request: "GenerationRequest",
+        on_text: Optional[Callable[[str], None]],
+        priority: int,
+        deadline: Optional[float],
+        seq: int,
+    ):
+        self.request = request
+        self.on_text = on_text
+        self.priority = priority
+        self.deadline = deadline
+        self.seq = seq
+        self.submitted = time.monotonic()
+        self.future: Future = Future()
+        # Collectors of the call that submitted the request, the stages of its batch are reported to them
+        self.collectors = tracing.active()
+
+    @property
+    def order(self) -> tuple:
+        # Highest priority first, then earliest deadline, then first come
+        return -self.priority, self.deadline if self.deadline is not None else float("inf"), self.seq
+
+
+class Lane:
+    """
+    Queue of the requests of one role on one model, served by a thread running one batch at a time. Requests that
+    arrive while a batch runs are admitted in the next one. Batches run through the first model instance of the lane,
+    every instance sharing the lane has the same generation config
+    """
+
+    def __init__(self, model: "QwenVLModel", scheduler: "InferenceScheduler"):
+        self.model = model
+        self.scheduler = scheduler
+        self.batches = 0
+        self.served = 0
+        self.expired = 0
+        self._queue: List[ScheduledRequest] = []
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def put(self, item: ScheduledRequest) -> None:
+        with self._condition:
+            self._queue.append(item)
+            self._condition.notify()
+
+    def _take(self) -> List[ScheduledRequest]:
+        """
+        Waits for requests and takes the most urgent ones as a batch. Requests past their deadline are failed instead
+        """
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            # Gives other sessions a moment to join the batch when it is not full yet
+            window_end = time.monotonic() + self.scheduler.batch_window
+            while len(self._queue) < self.scheduler.max_batch_size and time.monotonic() < window_end:
+                self._condition.wait(window_end - time.monotonic())
+
+            now = time.monotonic()
+            for item in [i for i in self._queue if i.deadline is not None and i.deadline < now]:
+                self._queue.remove(item)
+                self.expired += 1
+                item.future.set_exception(TimeoutError(f"Request waited {now - item.submitted:.2f}s in the queue"))
+
+            self._queue.sort(key=lambda i: i.order)
+            batch = self._queue[: self.scheduler.max_batch_size]
+            self._queue = self._queue[self.scheduler.max_batch_size :]
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take()
+            if not batch:
+                continue
+            # The text of a batch cannot be streamed, streamed requests batched with others get it in one piece
+            on_text = batch[0].on_text if len(batch) == 1 else None
+            # A batch is shared by the calls of several sessions, its stages are reported to each of them
+            collectors = tuple({id(c): c for item in batch for c in item.collectors}.values())
+            try:
+                execute = tracing.bind(self.model.execute, collectors)
+                outputs = execute([i.request for i in batch], on_text).result()
+            except Exception as e:
+                for item in batch:
+                    item.future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.served += len(batch)
+            for item, output in zip(batch, outputs):
+                if item.on_text is not None and on_text is None:
+                    item.on_text(output)
+                item.future.set_result(output)
+
+
+class InferenceScheduler:
+    """
+    Central queue for the inferences of many concurrent sessions.
+
+    Requests are tagged with the role of the model they are for, such as planner, middleman or grounding. Requests of
+    the same role on models with the same generation config are compatible and go to the same lane, which batches them
+    by priority and deadline. A lane runs one batch at a time and admits new requests between batches, so concurrent
+    sessions share batches instead of running one after the other.
+    """
+
+    def __init__(self, max_batch_size: int = 8, batch_window: float = 0.01):
+        # Maximum number of requests in a batch
+        self.max_batch_size = max_batch_size
+        # Seconds a lane waits for more requests before running a batch that is not full
+        self.batch_window = batch_window
+        self._lanes: Dict[LaneKey, Lane] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    @contextmanager
+    def options(priority: int = 0, timeout: Optional[float] = None) -> Iterator[None]:
+        """
+        Priority and queueing timeout of the requests submitted from the enclosed block, in the current thread or task
+        """
+        token = _OPTIONS.set(SchedulingOptions(priority, timeout))
+        try:
+            yield
+        finally:
+            _OPTIONS.reset(token)
+
+    def lane_key(self, model: "QwenVLModel") -> LaneKey:
+        return LaneKey(model.role, model.generation_config())
+
+    def submit(
+        self,
+        model: "QwenVLModel",
+        requests: List["GenerationRequest"],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Future:
+        """
+        Queues the requests in the lane of the model
+
+        @param model: Model the requests are for, its role and settings select the lane
+        @param requests: Messages and generation settings of every conversation
+        @param on_text: Called with each new piece of decoded text. Only supported for a single request
+
+        @returns future resolved with the decoded output of the model for each request, in order
+        """
+        options = _OPTIONS.get()
+        deadline = time.monotonic() + options.timeout if options.timeout is not None else None
+        key = self.lane_key(model)
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = Lane(model, self)
+
+        items = [
+            ScheduledRequest(
+                request, on_text if len(requests) == 1 else None, options.priority, deadline, next(self._seq)
+            )
+            for request in requests
+        ]
+        for item in items:
+            lane.put(item)
+        return gather([item.future for item in items])
+
+    def stats(self) -> Dict[LaneKey, Dict[str, Any]]:
+        """
+        Batches run, requests served and expired, mean batch size and queued requests of every lane
+        """
+        with self._lock:
+            return {
+                key: {
+                    "batches": lane.batches,
+                    "served": lane.served,
+                    "expired": lane.expired,
+                    "mean_batch_size": lane.served / lane.batches if lane.batches else 0.0,
+                    "queued": lane.queued,
+                }
+                for key, lane in self._lanes.items()
+            }
+
+
+def gather(futures: List[Future]) -> Future:
+    """
+    Future resolved with the results of all the futures in order, or with the first error among them
+    """
+    result: Future = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_: Future) -> None:
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] or result.done():
+                return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            result.set_exception(errors[0])
+        else:
+            result.set_result([f.result() for f in futures])
+
+    if not futures:
+        result.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    return result
+
+
+SCHEDULER = InferenceScheduler()
@@ -0,0 +1,45 @@
+import queue
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List
+
+_DONE = object()
+
+
+class TextStream:
+    """
+    Text of a generation delivered as it is decoded.
+
+    Iterating yields the new chunks of text until the generation ends, then raises any error it had. The full decoded
+    output is available through result once the generation is done.
+    """
+
+    def __init__(self, messages: List[Dict[str, Any]]):
+        self.messages = messages
+        self.future: Future = Future()
+        self._chunks: queue.Queue = queue.Queue()
+
+    def put(self, text: str) -> None:
+        if text:
+            self._chunks.put(text)
+
+    def bind(self, future: Future) -> "TextStream":
+        """
+        Ties the stream to the future of the generation, ending the iteration when it completes
+        """
+        self.future = future
+        future.add_done_callback(lambda _: self._chunks.put(_DONE))
+        return self
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            chunk = self._chunks.get()
+            if chunk is _DONE:
+                break
+            yield chunk
+        self.future.result()
+
+    def result(self) -> List[str]:
+        """
+        @returns decoded outputs of the model, in the same format as _call
+        """
+        return self.future.result()
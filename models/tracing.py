@@ -0,0 +1,260 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Tuple,
+    TypeVar,
+)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Span(NamedTuple):
+    """
+    Timed stage of an inference, such as the vision preprocessing or the decoding of the output
+    """
+
+    name: str
+    start: float
+    end: float
+    attributes: Dict[str, Any]
+
+    @property
+    def seconds(self) -> float:
+        return self.end - self.start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "start": self.start, "seconds": self.seconds, **self.attributes}
+
+
+class Exporter(Protocol):
+    def export(self, span: Span) -> None:
+        """
+        Receives every stage recorded in the process
+        """
+
+
+# Span lists of the collectors active in the current thread or task. Work handed to other threads is run with the
+# collectors of the call it belongs to through bind, so concurrent calls only collect their own stages
+_collectors: ContextVar[Tuple[List[Span], ...]] = ContextVar("tracing_collectors", default=())
+# Exporters receive the stages of every call in the process
+_exporters: List[Exporter] = []
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    """
+    Whether anything is listening to the stages. Callers only compute costly attributes when it is the case
+    """
+    return bool(_collectors.get() or _exporters)
+
+
+def record(name: str, start: float, end: float, **attributes: Any) -> None:
+    """
+    Records a stage timed by the caller, with times given by time.perf_counter
+    """
+    collectors = _collectors.get()
+    if not (collectors or _exporters):
+        return
+    span = Span(name, start, end, attributes)
+    with _lock:
+        for spans in collectors:
+            spans.append(span)
+        for exporter in _exporters:
+            exporter.export(span)
+
+
+def replay(spans: Iterable[Span]) -> None:
+    """
+    Records stages received from a worker process. perf_counter is system wide on Linux, so their times line up with
+    the stages of the calling process
+    """
+    for span in spans:
+        record(span.name, span.start, span.end, **span.attributes)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    """
+    Times the enclosed block as a stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter(), **attributes)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """
+    Decorator timing every call of the function as a stage
+    """
+
+    def decorator(function: F) -> F:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+@contextmanager
+def collect(spans: Optional[List[Span]] = None) -> Iterator[List[Span]]:
+    """
+    Gathers the stages of the calls made in the enclosed block, including those run in worker threads and processes
+
+    @param spans: List the stages are appended to, a new one if None
+    """
+    spans = [] if spans is None else spans
+    token = _collectors.set((*_collectors.get(), spans))
+    try:
+        yield spans
+    finally:
+        _collectors.reset(token)
+
+
+def active() -> Tuple[List[Span], ...]:
+    """
+    Span lists of the collectors active in the current thread or task
+    """
+    return _collectors.get()
+
+
+def bind(function: F, collectors: Optional[Tuple[List[Span], ...]] = None) -> F:
+    """
+    Wraps a function handed to another thread, such as a thread target or a future callback, so the stages it records
+    go to the collectors of the call it belongs to
+
+    @param collectors: Span lists the stages go to, those active in the current thread or task if None
+    """
+    bound = _collectors.get() if collectors is None else collectors
+    if not bound:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = _collectors.set(bound)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _collectors.reset(token)
+
+    return wrapper  # type: ignore[return-value]
+
+
+def add_exporter(exporter: Exporter) -> None:
+    """
+    Sends every stage recorded from now on to the exporter
+    """
+    with _lock:
+        _exporters.append(exporter)
+
+
+def remove_exporter(exporter: Exporter) -> None:
+    with _lock:
+        _exporters[:] = [e for e in _exporters if e is not exporter]
+
+
+def token_usage(spans: Iterable[Span]) -> Dict[str, int]:
+    """
+    Tokens processed by the generations among the stages, in the format of the llm_output of LangChain
+    """
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "image_tokens": 0}
+    for s in spans:
+        if s.name == "prefill":
+            usage["prompt_tokens"] += s.attributes.get("prompt_tokens", 0)
+            usage["image_tokens"] += s.attributes.get("image_tokens", 0)
+        elif s.name == "decode":
+            usage["completion_tokens"] += s.attributes.get("new_tokens", 0)
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    return usage
+
+
+class JsonlExporter:
+    """
+    Appends every stage to a file as a line of JSON
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+
+    def export(self, span: Span) -> None:
+        self._file.write(json.dumps({"pid": os.getpid(), **span.to_dict()}, default=str) + "\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class OpenMetricsExporter:
+    """
+    Aggregates the stages into metrics in the OpenMetrics text format, to be scraped from a file or served as is.
+
+    Every stage gives a summary of its duration. Prefill and decode also count the tokens they processed, and decode
+    keeps the highest peak memory it saw.
+    """
+
+    # Attributes counted as tokens, with the kind they are reported as
+    TOKEN_ATTRIBUTES = {"prompt_tokens": "prompt", "image_tokens": "image", "new_tokens": "completion"}
+
+    def __init__(self, prefix: str = "bada"):
+        self.prefix = prefix
+        self._count: Dict[str, int] = defaultdict(int)
+        self._seconds: Dict[str, float] = defaultdict(float)
+        self._tokens: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._peak_memory_mb: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self._count[span.name] += 1
+            self._seconds[span.name] += span.seconds
+            for attribute, kind in self.TOKEN_ATTRIBUTES.items():
+                if attribute in span.attributes:
+                    self._tokens[span.name, kind] += int(span.attributes[attribute])
+            if "peak_memory_mb" in span.attributes:
+                peak = max(self._peak_memory_mb.get(span.name, 0.0), span.attributes["peak_memory_mb"])
+                self._peak_memory_mb[span.name] = peak
+
+    def render(self) -> str:
+        p = self.prefix
+        with self._lock:
+            lines = [f"# TYPE {p}_stage_seconds summary", f"# UNIT {p}_stage_seconds seconds"]
+            for name in sorted(self._count):
+                lines.append(f'{p}_stage_seconds_count{{stage="{name}"}} {self._count[name]}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{name}"}} {self._seconds[name]:.6f}')
+            lines.append(f"# TYPE {p}_tokens counter")
+            for (name, kind), tokens in sorted(self._tokens.items()):
+                lines.append(f'{p}_tokens_total{{stage="{name}",kind="{kind}"}} {tokens}')
+            lines.append(f"# TYPE {p}_peak_memory_megabytes gauge")
+            lines.append(f"# UNIT {p}_peak_memory_megabytes megabytes")
+            for name, peak in sorted(self._peak_memory_mb.items()):
+                lines.append(f'{p}_peak_memory_megabytes{{stage="{name}"}} {peak:.1f}')
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Writes the metrics to the file, replacing it atomically so a scraper never reads a partial file
+        """
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from models.images import image_digest
+
+
+class VisionCache:
+    """
+    LRU store of preprocessed images, bounded by the memory taken by their pixel tensors.
+
+    Entries hold the pixel values and grid size produced by the image processor for a given image content and
+    processor settings, so each screenshot is decoded and resized only once no matter how many models look at it.
+    """
+
+    def __init__(self, max_bytes: int = 2**30):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(element: Dict[str, Any], image_processor: Any) -> Hashable:
+        """
+        Key of an image element of a message for the given image processor
+
+        @param element: Message content with the image and its optional resize bounds
+        @param image_processor: Processor that will produce the pixel values
+        """
+        return (
+            image_digest(element["image"]),
+            element.get("min_pixels"),
+            element.get("max_pixels"),
+            image_processor.min_pixels,
+            image_processor.max_pixels,
+            image_processor.patch_size,
+            image_processor.merge_size,
+            image_processor.temporal_patch_size,
+        )
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, Any]]:
+        """
+        @returns pixel values and grid size, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key: Hashable, pixel_values: Any, grid_thw: Any) -> None:
+        size = pixel_values.numel() * pixel_values.element_size()
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= self._entries.pop(key)[2]
+            self._entries[key] = (pixel_values, grid_thw, size)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                self.size_bytes -= self._entries.popitem(last=False)[1][2]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+
+VISION_CACHE = VisionCache()
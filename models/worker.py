@@ -0,0 +1,333 @@
+import atexit
+import contextlib
+import itertools
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing import Queue
+from multiprocessing.reduction import ForkingPickler
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from models import tracing
+from models.memory import memory_usage_mb
+
+if TYPE_CHECKING:
+    from models.models import GenerationRequest, QwenVLModel
+
+# Workers are spawned rather than forked, a fork would copy the threads, locks and CUDA state of the caller
+CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _count(counts: Queue, results: Queue) -> None:
+    """
+    Token counting loop of the worker process, run next to the inferences so that sizing a prompt does not wait for
+    them. The tokenizer is only loaded on the first count
+    """
+    from models.models import token_count
+
+    while True:
+        request_id, model_name, text = counts.get()
+        payload: Any
+        try:
+            payload = token_count(model_name, text)
+        except Exception as e:
+            payload = e
+        results.put((request_id, "tokens", payload, None, None))
+
+
+def _serve(requests: Queue, results: Queue, counts: Queue) -> None:
+    """
+    Worker process loop. The models stay resident in the registry of the worker process and serve requests until a
+    None sentinel is received. Every job carries the model instance it was submitted with, so requests of instances
+    sharing the weights but not the generation settings, such as the planner and the middleman, run with their own
+    """
+    threading.Thread(target=_count, args=(counts, results), daemon=True).start()
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+
+        request_id, job, stream, trace = item
+
+        def on_text(text: str) -> None:
+            results.put((request_id, "chunk", text, None, None))
+
+        # The stages are only gathered when the caller is tracing, and sent back with the result
+        payload: Any
+        with contextlib.ExitStack() as stack:
+            spans = stack.enter_context(tracing.collect()) if trace else []
+            try:
+                model, batch = ForkingPickler.loads(job)
+                with model.lease() as (loaded_model, processor):
+                    payload = model.run_inference(loaded_model, processor, batch, on_text if stream else None)
+                status = "ok"
+            except Exception as e:
+                status, payload = "error", e
+        results.put((request_id, status, payload, memory_usage_mb(), spans))
+
+    results.put(None)
+
+
+class ModelWorker:
+    """
+    A process with resident models serving inference requests over a queue. Every model runs in the registry of the
+    process, so they share its memory budget and least recently used eviction.
+
+    A worker is never reused once retired, the pool replaces it with a fresh process so that all the memory held by
+    the previous one is given back to the system. The replacement queues requests right away but only starts its
+    process once the previous one has exited, two workers loading the same weights would double the peak memory.
+    """
+
+    def __init__(
+        self,
+        max_requests: Optional[int] = None,
+        max_memory_mb: Optional[float] = None,
+        previous: Optional["ModelWorker"] = None,
+    ):
+        self.max_requests = max_requests
+        self.max_memory_mb = max_memory_mb
+        self.served = 0
+        self.memory_mb = 0.0
+        self.retired = False
+
+        self._ids = itertools.count()
+        self._pending: Dict[int, Future] = {}
+        self._streams: Dict[int, Callable[[str], None]] = {}
+        # Replays the stages of each request to the collectors of the call that submitted it
+        self._replays: Dict[int, Callable[[List[tracing.Span]], None]] = {}
+        # Token counts being computed, they are not requests and do not count towards max_requests
+        self._counting: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._requests: Queue = CONTEXT.Queue()
+        self._results: Queue = CONTEXT.Queue()
+        self._counts: Queue = CONTEXT.Queue()
+
+        self._process = CONTEXT.Process(target=_serve, args=(self._requests, self._results, self._counts), daemon=True)
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._starter = threading.Thread(target=self._start, args=(previous,), daemon=True)
+        self._starter.start()
+
+    @property
+    def submitted(self) -> int:
+        return self.served + len(self._pending)
+
+    def should_recycle(self) -> bool:
+        """
+        Whether the worker has reached its request or memory limits
+        """
+        # A worker waiting for the one it replaces has not started yet, it has not exited either
+        if self.retired or self._process.exitcode is not None:
+            return True
+        if self.max_requests is not None and self.submitted >= self.max_requests:
+            return True
+        return self.max_memory_mb is not None and self.memory_mb >= self.max_memory_mb
+
+    def submit(
+        self,
+        model: "QwenVLModel",
+        batch: List["GenerationRequest"],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Future:
+        """
+        Queues a batch of requests on the worker
+
+        @param model: Model the batch is for, its settings are sent along with the batch
+        @param batch: Messages and generation settings of every conversation in the batch
+        @param on_text: Called from a background thread with each new piece of decoded text of a single request batch
+
+        @returns future resolved with the decoded output of the model for each request
+        """
+        future: Future = Future()
+        # Pickled here rather than by the feeder thread of the queue, which drops the items it fails to pickle and
+        # would leave the future pending forever
+        try:
+            job = bytes(ForkingPickler.dumps((model, batch)))
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        with self._lock:
+            if self.retired:
+                raise RuntimeError("Model worker has been retired")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            if on_text is not None:
+                self._streams[request_id] = on_text
+            self._replays[request_id] = tracing.bind(tracing.replay)
+        self._requests.put((request_id, job, on_text is not None, tracing.enabled()))
+        return future
+
+    def count_tokens(self, model_name: str, text: str) -> Future:
+        """
+        Counts the tokens of a text with the tokenizer of the model, loaded in the worker process
+
+        @returns future resolved with the number of tokens, without special tokens
+        """
+        future: Future = Future()
+        with self._lock:
+            if self.retired:
+                raise RuntimeError("Model worker has been retired")
+            request_id = next(self._ids)
+            self._counting[request_id] = future
+        self._counts.put((request_id, model_name, text))
+        return future
+
+    def retire(self) -> None:
+        """
+        Stops the worker once all the queued requests have been served
+        """
+        with self._lock:
+            if self.retired:
+                return
+            self.retired = True
+        self._requests.put(None)
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        self._starter.join(timeout)
+        if self._process.pid is not None:
+            self._process.join(timeout)
+
+    def exited(self) -> bool:
+        return self._process.exitcode is not None
+
+    def _start(self, previous: Optional["ModelWorker"]) -> None:
+        if previous is not None:
+            previous.join()
+        try:
+            self._process.start()
+        except Exception as e:
+            self._fail_pending(e)
+            return
+        self._reader.start()
+
+    def _read_results(self) -> None:
+        while True:
+            try:
+                item = self._results.get(timeout=1)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+                self._fail_pending(RuntimeError("Model worker exited unexpectedly"))
+                return
+
+            if item is None:
+                self._fail_pending(RuntimeError("Model worker stopped before answering"))
+                return
+
+            request_id, status, payload, memory_mb, spans = item
+            if status == "chunk":
+                on_text = self._streams.get(request_id)
+                if on_text is not None:
+                    on_text(payload)
+                continue
+            if status == "tokens":
+                with self._lock:
+                    counted = self._counting.pop(request_id, None)
+                if counted is None:
+                    continue
+                if isinstance(payload, Exception):
+                    counted.set_exception(payload)
+                else:
+                    counted.set_result(payload)
+                continue
+
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+                self._streams.pop(request_id, None)
+                replay = self._replays.pop(request_id, tracing.replay)
+                self.served += 1
+                self.memory_mb = memory_mb
+            replay(spans)
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(payload)
+            else:
+                future.set_exception(payload)
+
+    def _fail_pending(self, error: Exception) -> None:
+        with self._lock:
+            self.retired = True
+            pending, self._pending = [*self._pending.values(), *self._counting.values()], {}
+            self._streams, self._replays, self._counting = {}, {}, {}
+        for future in pending:
+            future.set_exception(error)
+
+
+class WorkerPool:
+    """
+    A long lived worker serving every model, recycled after a number of requests or above a memory threshold. This
+    gives the same memory release guarantee as a process per inference without reloading on every call, and keeps the
+    models of all the roles under a single registry so that the budget and eviction cover all of them
+    """
+
+    def __init__(self):
+        self._current: Optional[ModelWorker] = None
+        self._retired: List[ModelWorker] = []
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        model: "QwenVLModel",
+        batch: List["GenerationRequest"],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Future:
+        """
+        Sends a batch to the worker, starting or recycling it when needed
+
+        @param model: Model the batch is for, its worker limits decide whether the worker is recycled first
+        @param batch: Messages and generation settings of every conversation in the batch
+        @param on_text: Called with each new piece of decoded text of a single request batch
+
+        @returns future resolved with the decoded output of the model for each request
+        """
+        with self._lock:
+            return self._worker(model).submit(model, batch, on_text)
+
+    def count_tokens(self, model: "QwenVLModel", text: str) -> Future:
+        """
+        Counts the tokens of a text in the worker, so that the callers sizing prompts never load a tokenizer
+        themselves. The worker is started without loading the model when needed
+
+        @returns future resolved with the number of tokens, without special tokens
+        """
+        with self._lock:
+            return self._worker(model).count_tokens(model.model_name, text)
+
+    def _worker(self, model: "QwenVLModel") -> ModelWorker:
+        # Called with the lock held
+        worker = self._current
+        if worker is None or worker.should_recycle():
+            if worker is not None:
+                worker.retire()
+                self._retired.append(worker)
+            worker = ModelWorker(model.worker_max_requests, model.worker_max_memory_mb, previous=worker)
+            self._current = worker
+        self._retired = [w for w in self._retired if not w.exited()]
+        return worker
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Requests served and last reported memory of the live worker
+        """
+        with self._lock:
+            worker = self._current
+            if worker is None:
+                return {}
+            return {"served": worker.served, "pending": len(worker._pending), "memory_mb": worker.memory_mb}
+
+    def shutdown(self, timeout: Optional[float] = 30) -> None:
+        """
+        Retires every worker and waits for them to finish the queued requests
+        """
+        with self._lock:
+            workers = [*([self._current] if self._current is not None else []), *self._retired]
+            self._current, self._retired = None, []
+        for worker in workers:
+            worker.retire()
+        for worker in workers:
+            worker.join(timeout)
+
+
+WORKERS = WorkerPool()
+atexit.register(WORKERS.shutdown)
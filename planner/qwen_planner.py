@@ -1,14 +1,93 @@
 import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from models.models import QwenVLModel
+from models.recording import recorded_parse
+from models.streaming import TextStream
+from models.tracing import traced
 from planner.base import Plan, PlannerInterface
 
+STEPS_BEGIN = "<|steps_begin|>"
+STEPS_END = "<|steps_end|>"
+
+
+class StepStreamParser:
+    """
+    Incrementally extracts the steps of a plan from generated text, a step is complete once the comma after it or the
+    end of the steps is generated
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.steps: List[str] = []
+        self._complete = 0
+
+    def feed(self, chunk: str) -> List[str]:
+        """
+        @param chunk: New piece of generated text
+
+        @returns steps completed by the chunk
+        """
+        self.text += chunk
+        begin = self.text.find(STEPS_BEGIN)
+        if begin < 0:
+            return []
+
+        body = self.text[begin + len(STEPS_BEGIN) :]
+        end = body.find(STEPS_END)
+        parts = body[:end].split(",") if end >= 0 else body.split(",")[:-1]
+
+        new = [part.strip() for part in parts[self._complete :]]
+        self._complete = len(parts)
+        self.steps.extend(new)
+        return new
+
+
+class PlanStream:
+    """
+    Steps of a plan yielded as soon as they are generated. The whole plan is available in plan once iterated
+    """
+
+    def __init__(self, planner: "QwenVLPlanner", stream: TextStream):
+        self.planner = planner
+        self.stream = stream
+        self.parser = StepStreamParser()
+        self.plan: Optional[Plan] = None
+
+    def __iter__(self) -> Iterator[str]:
+        for chunk in self.stream:
+            yield from self.parser.feed(chunk)
+
+        output = next(iter(self.stream.result()), None)
+        if not output:
+            raise RuntimeError("Something went wrong while generating the plan and no output was given by the model")
+        self.plan = self.planner.parse_plan(self.stream.messages, output)
+
+    @property
+    def partial_plan(self) -> Plan:
+        """
+        Plan with the steps generated so far. The reasoning comes before the steps, so it is complete once the first
+        step is available
+        """
+        return Plan(
+            self.stream.messages,
+            self.parser.text,
+            list(self.parser.steps),
+            reasoning=self.planner.parse_reasoning(self.parser.text),
+        )
+
 
 class QwenVLPlanner(PlannerInterface, QwenVLModel):
     """
     Planner implentation for QwenVL based models. It also supports derivatives such as OSAtlas
     """
 
+    role: Optional[str] = "planner"
+    # parse_plan needs nothing after the steps, which come after the reasoning
+    stop_pattern: Optional[str] = r"<\|steps_end\|>"
+    # Planning does not need full resolution, about 1036x582 pixels or 768 image tokens
+    max_pixels: Optional[int] = 768 * 28 * 28
+
     def __init__(self, model_name: str, *args, **kwargs):
         super().__init__(model_name, *args, **kwargs)
 
@@ -22,23 +101,84 @@ class QwenVLPlanner(PlannerInterface, QwenVLModel):
 
         return self.parse_plan(messages, processed_output_text)
 
+    async def aplan(self, sys_prompt, user_prompt, *args, **kwargs) -> Plan:
+        """
+        Async version of plan, the event loop is not blocked while the model generates
+        """
+        messages, outputs = await self._acall(sys_prompt, user_prompt, *args, **kwargs)
+
+        processed_output_text: Optional[str] = next(iter(outputs), None)
+
+        if not processed_output_text:
+            raise RuntimeError("Something went wrong while generating the plan and no output was given by the model")
+
+        return self.parse_plan(messages, processed_output_text)
+
+    def stream_plan(self, sys_prompt, user_prompt, *args, **kwargs) -> PlanStream:
+        """
+        Creates a plan yielding each step as soon as it is generated
+
+        @param sys_prompt: The system prompt to give to the model
+        @param user_prompt: User textual prompt for the model
+
+        @returns PlanStream object
+        """
+        return PlanStream(self, self.stream_call(sys_prompt, user_prompt, *args, **kwargs))
+
+    def batch_plan(self, requests: List[Tuple[Optional[str], str, Any]], *args, **kwargs) -> List[Plan]:
+        """
+        Creates several plans in a single batched inference
+
+        @param requests: (sys_prompt, user_prompt, image) for every plan, image may be None
+
+        @returns Plan objects in the same order as the requests
+        """
+        plans: List[Plan] = []
+        for messages, processed_output_text in self.batch_call(requests, *args, **kwargs):
+            output = next(iter(processed_output_text), None)
+            if not output:
+                raise RuntimeError(
+                    "Something went wrong while generating the plan and no output was given by the model"
+                )
+            plans.append(self.parse_plan(messages, output))
+        return plans
+
+    @traced("parse.plan")
+    @recorded_parse
     def parse_plan(self, prompt: list[dict[str, str]], plan: str) -> Plan:
-        reasoning_pattern = r"<\|reasoning_begin\|>(.*?)<\|reasoning_end\|>"
         steps_pattern = r"<\|steps_begin\|>(.*?)<\|steps_end\|>"
 
-        reasoning_match = re.search(reasoning_pattern, plan, re.DOTALL)
         steps_match = re.search(steps_pattern, plan, re.DOTALL)
 
-        reasoning_content = reasoning_match.group(1).strip() if reasoning_match else None
         steps_content = steps_match.group(1).strip() if steps_match else None
 
         if type(steps_content) is not str:
             raise RuntimeError("No steps were found in the plan")
         steps: list[str] = list(map(lambda x: x.strip(), steps_content.split(",")))
 
-        if reasoning_content is None:
+        reasoning_dict = self.parse_reasoning(plan)
+        if reasoning_dict is None:
             return Plan(prompt, plan, steps)
 
+        return Plan(prompt, plan, steps, reasoning=reasoning_dict)
+
+    def parse_reasoning(self, plan: str) -> Optional[Dict[str, List[str]]]:
+        """
+        Extracts the answers to the reasoning questions of the plan
+
+        @param plan: Output of the model, complete or partial
+
+        @returns answers keyed by question, or None if the reasoning is missing or not finished
+        """
+        reasoning_pattern = r"<\|reasoning_begin\|>(.*?)<\|reasoning_end\|>"
+
+        reasoning_match = re.search(reasoning_pattern, plan, re.DOTALL)
+
+        reasoning_content = reasoning_match.group(1).strip() if reasoning_match else None
+
+        if reasoning_content is None:
+            return None
+
         reasoning_dict = {}
         sections = re.split(r"\n\d+\.\s", reasoning_content)
 
@@ -48,4 +188,4 @@ class QwenVLPlanner(PlannerInterface, QwenVLModel):
             values = [line.strip() for line in lines[1:]]
             reasoning_dict[key] = values
 
-        return Plan(prompt, plan, steps, reasoning=reasoning_dict)
+        return reasoning_dict
@@ -1,64 +1,344 @@
+import asyncio
+import functools
+import warnings
+from concurrent.futures import Future
+from typing import Any, Callable, Optional, Sequence, Tuple, TypeVar
+
 from action.base import Action, ActionResult, History
-from action.qwen_action import AtlasActionmodel, QwenVLActionModel
+from action.grounding_cache import GroundingCache
+from action.qwen_action import AtlasActionmodel, QwenVLActionModel, TargetStreamParser
+from models.budget import PromptSection, approximate_tokens, fit_sections
+from models.images import ImageInput
+from models.tracing import span
 from planner.base import Plan
-from planner.qwen_planner import QwenVLPlanner
+from planner.qwen_planner import PlanStream, QwenVLPlanner
 from prompts.action_prompts import SYS_PROMPT_MID as MIDDLEMAN
 from prompts.planner_prompts import SYS_PROMPT_COT as PLANNER_COT
 
+# Shared across steps so that targets already grounded on the same screen are not grounded again
+GROUNDING_CACHE = GroundingCache()
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def renamed_arguments(**renames: str) -> Callable[[F], F]:
+    """
+    Keeps accepting the former names of renamed keyword arguments, warning that they are deprecated
+
+    @param renames: New name of each former name
+    """
+
+    def decorator(function: F) -> F:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            for old, new in renames.items():
+                if old not in kwargs:
+                    continue
+                if new in kwargs:
+                    raise TypeError(f"{function.__name__}() got both {old} and {new}")
+                warnings.warn(f"{old} is deprecated, use {new} instead", DeprecationWarning, stacklevel=2)
+                kwargs[new] = kwargs.pop(old)
+            return function(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+MIDDLEMAN_TEMPLATE = """
+    **task**: {task}
+    **plan**: {steps}.
+    **Plan reasoning**: {reasoning}
+
+    **history**:
+    {history}
+
+    **result of the last executed action**: {last_result}
+
+    **task description**:
+    {task_description}
+
+    **context description**:
+    {context}
+
+    **current subtask**: {subtask}
+    """
+
+
+def middleman_prompt(
+    subtask: str,
+    history: History,
+    task: str,
+    plan: Plan,
+    context: str,
+    task_description: str,
+    history_len: int = 0,
+    history_max_tokens: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    count_tokens: Callable[[str], int] = approximate_tokens,
+) -> str:
+    """
+    User prompt of the middleman model, see take_action for the parameters
+
+    @param history_len: Number of recent steps of the history given in full, older ones are summarized
+    @param history_max_tokens: Token budget of the history
+    @param max_tokens: Token budget of the whole prompt. The plan reasoning goes first, then the business context,
+    the task description and the history, the task, plan and subtask are trimmed last
+    @param count_tokens: Function counting the tokens of a text for the model
+    """
+
+    def render_history(budget: Optional[int]) -> str:
+        limits = [b for b in (budget, history_max_tokens) if b is not None]
+        return history.render(history_len, min(limits) if limits else None, count_tokens)
+
+    fixed = MIDDLEMAN_TEMPLATE.format(
+        task="",
+        steps="",
+        reasoning="",
+        history="",
+        last_result=history.last_result,
+        task_description="",
+        context="",
+        subtask="",
+    )
+    sections = fit_sections(
+        [
+            PromptSection("reasoning", str(plan.reasoning), 0),
+            PromptSection("context", context, 1),
+            PromptSection("task_description", task_description, 2),
+            PromptSection("history", render_history, 3),
+            PromptSection("steps", str(plan.steps), 4),
+            PromptSection("task", task, 5),
+            PromptSection("subtask", subtask, 6),
+        ],
+        max_tokens - count_tokens(fixed) if max_tokens is not None else None,
+        count_tokens,
+    )
+    return MIDDLEMAN_TEMPLATE.format(last_result=history.last_result, **sections)
+
+
+def grounding_prompt(action_target: str | None) -> str:
+    """
+    User prompt of the grounding model for the target given by the middleman
+    """
+    return f'In this UI screenshot, what is the position of the element corresponding to the command "{action_target}" (with bbox)?'
+
+
+def planner_prompt(task: str, task_description: str) -> str:
+    """
+    User prompt of the planner, see plan_task for the parameters
+    """
+    # prompt = """
+    # **Task Description**: Register a client with email \"example@email.com\" and password \"password123\".
+    # **Contextual Information**:
+    # - Users must have first sent an email to the company attaching their NIF, which must be included in the registration
+    # - Once registered, we respond back to the email sent by the user confirming that the registration was done correctly
+    # """
+
+    # This prompt now resembles a process description
+    return f"""
+    **Task Description**: {task}.
+    **Contextual Information**:
+    {task_description}
+    """
+
+
+def planner_prompts(
+    task: str,
+    context: str,
+    task_description: str,
+    max_tokens: Optional[int] = None,
+    count_tokens: Callable[[str], int] = approximate_tokens,
+) -> Tuple[str, str]:
+    """
+    System and user prompts of the planner, see plan_task for the parameters
+
+    @param max_tokens: Token budget of both prompts. The business context goes first, then the task description
+    @param count_tokens: Function counting the tokens of a text for the model
+
+    @returns system prompt and user prompt
+    """
+    fixed = count_tokens(PLANNER_COT.format(context="")) + count_tokens(planner_prompt("", ""))
+    sections = fit_sections(
+        [
+            PromptSection("context", context, 0),
+            PromptSection("task_description", task_description, 1),
+            PromptSection("task", task, 2),
+        ],
+        max_tokens - fixed if max_tokens is not None else None,
+        count_tokens,
+    )
+    return PLANNER_COT.format(context=sections["context"]), planner_prompt(
+        sections["task"], sections["task_description"]
+    )
+
+
+def sized_middleman_prompt(
+    middle_model: QwenVLActionModel,
+    subtask: str,
+    history: History,
+    task: str,
+    plan: Plan,
+    context: str,
+    task_description: str,
+    image: ImageInput,
+) -> str:
+    """
+    Middleman prompt fitted in the budget the model leaves once its system prompt and the screenshot are counted. It
+    counts tokens, possibly in the worker of the model, so the async entry points run it in a thread
+
+    @returns user prompt for the middleman
+    """
+    with span("prompt.build"):
+        return middleman_prompt(
+            subtask,
+            history,
+            task,
+            plan,
+            context,
+            task_description,
+            middle_model.history_len,
+            middle_model.history_max_tokens,
+            middle_model.prompt_budget(MIDDLEMAN, image=image),
+            middle_model.count_tokens,
+        )
+
+
+def sized_planner_prompts(
+    planner: QwenVLPlanner, task: str, context: str, task_description: str, image: ImageInput
+) -> Tuple[str, str]:
+    """
+    Planner prompts fitted in the budget the planner leaves once the screenshot is counted. It counts tokens, possibly
+    in the worker of the model, so the async entry points run it in a thread
+
+    @returns system and user prompts for the planner
+    """
+    with span("prompt.build"):
+        return planner_prompts(
+            task, context, task_description, planner.prompt_budget(None, image=image), planner.count_tokens
+        )
+
+
+def last_click(history: History) -> Optional[Tuple[float, float]]:
+    """
+    Coords of the last grounded action of the history, targets are often close to it. To be given as the roi of
+    take_action when the next target is expected near the previous one
+    """
+    return next((action.coords for action in reversed(history.actions) if action.coords is not None), None)
 
-# TODO: take image as bytes
+
+@renamed_arguments(image_path="image")
 def take_action(
     subtask: str,
     history: History,
-    image_path: str,
+    image: ImageInput,
     task: str,
     plan: Plan,
     context: str,
     task_description: str,
+    roi: Optional[Sequence[float]] = None,
+    middle_model: Optional[QwenVLActionModel] = None,
+    action_model: Optional[AtlasActionmodel] = None,
 ) -> None:
     """
     Performs an action on the current screen given an instruction
 
     @param subtask: Subtask at hand from the original plan
     @param history: Actions and results until this point
-    @image_path: Path to the image upon which the interaction will happen
+    @image: Image upon which the interaction will happen. A path, encoded bytes, a NumPy array or a PIL image. Also
+    accepted as image_path, its deprecated name
     @task: Objective
     @param plan: Plan layed out by the planner beforehand
     @context: Bussiness context
     @task_description: Detailed description of the task at hand, from a process POV
+    @param roi: Box or point where the target is expected, such as the active window or last_click(history). The
+    target is grounded on a crop around it first, and on the whole screenshot only when found near the crop border
+    @param middle_model: Model deciding on the action, the default middleman if None
+    @param action_model: Model grounding the action, the default OS-Atlas if None
     """
+    middle_model = middle_model or QwenVLActionModel("Qwen/Qwen2-VL-7B-Instruct-GPTQ-Int4")
+    action_model = action_model or AtlasActionmodel("OS-Copilot/OS-Atlas-Base-7B", grounding_cache=GROUNDING_CACHE)
 
-    middle_model = QwenVLActionModel("Qwen/Qwen2-VL-7B-Instruct-GPTQ-Int4")
+    prompt = sized_middleman_prompt(middle_model, subtask, history, task, plan, context, task_description, image)
 
-    prompt = f"""
-    **task**: {task}
-    **plan**: {plan.steps}.
-    **Plan reasoning**: {plan.reasoning}
+    # The grounding only needs the target, so it is dispatched as soon as the middleman closes it
+    stream = middle_model.stream_call(MIDDLEMAN, prompt, image=image)
+    parser = TargetStreamParser()
+    pending: Optional[Future] = None
+    for chunk in stream:
+        if pending is None and parser.feed(chunk) is not None:
+            pending = action_model.submit_action(
+                None, grounding_prompt(parser.target), image=image, action_target=parser.target, roi=roi
+            )
 
-    **history**:
-    {history}
+    output = next(iter(stream.result()), None)
+    if not output:
+        raise RuntimeError("Something went wrong while generating the action and no output was given by the model")
+    action: Action = middle_model.parse_action(stream.messages, output)
 
-    **result of the last executed action**: {history.last_result}
+    if pending is not None and parser.target == action.action_target:
+        with span("grounding.wait"):
+            grounding: Action = pending.result()
+    else:
+        # The target streamed early is not the one parsed in the end, its grounding is dropped
+        if pending is not None:
+            pending.cancel()
+        grounding = action_model.action(
+            None,
+            grounding_prompt(action.action_target),
+            image=image,
+            action_target=action.action_target,
+            roi=roi,
+        )
+    grounding.action = action.action
+    grounding.action_target = action.action_target
 
-    **task description**:
-    {task_description}
+    history.append(grounding, ActionResult.PENDING)
 
-    **context description**:
-    {context}
 
-    **current subtask**: {subtask}
+async def atake_action(
+    subtask: str,
+    history: History,
+    image: ImageInput,
+    task: str,
+    plan: Plan,
+    context: str,
+    task_description: str,
+    roi: Optional[Sequence[float]] = None,
+    middle_model: Optional[QwenVLActionModel] = None,
+    action_model: Optional[AtlasActionmodel] = None,
+) -> None:
+    """
+    Async version of take_action. Many sessions can be driven from a single event loop, the models run in their
+    workers while the loop waits
+
+    @param subtask: Subtask at hand from the original plan
+    @param history: Actions and results until this point
+    @image: Image upon which the interaction will happen. A path, encoded bytes, a NumPy array or a PIL image
+    @task: Objective
+    @param plan: Plan layed out by the planner beforehand
+    @context: Bussiness context
+    @task_description: Detailed description of the task at hand, from a process POV
+    @param roi: Box or point where the target is expected, such as the active window or last_click(history). The
+    target is grounded on a crop around it first, and on the whole screenshot only when found near the crop border
+    @param middle_model: Model deciding on the action, the default middleman if None
+    @param action_model: Model grounding the action, the default OS-Atlas if None
     """
-    action: Action = middle_model.action(
-        MIDDLEMAN,
-        prompt,
-        image=image_path,
+    middle_model = middle_model or QwenVLActionModel("Qwen/Qwen2-VL-7B-Instruct-GPTQ-Int4")
+    # Counting the tokens of the sections and the screenshot would otherwise block the event loop
+    prompt = await asyncio.to_thread(
+        sized_middleman_prompt, middle_model, subtask, history, task, plan, context, task_description, image
     )
 
-    action_model = AtlasActionmodel("OS-Copilot/OS-Atlas-Base-7B")
-    grounding: Action = action_model.action(
+    action: Action = await middle_model.aaction(MIDDLEMAN, prompt, image=image)
+
+    action_model = action_model or AtlasActionmodel("OS-Copilot/OS-Atlas-Base-7B", grounding_cache=GROUNDING_CACHE)
+    grounding: Action = await action_model.aaction(
         None,
-        f'In this UI screenshot, what is the position of the element corresponding to the command "{action.action_target}" (with bbox)?',
-        image=image_path,
+        grounding_prompt(action.action_target),
+        image=image,
+        action_target=action.action_target,
+        roi=roi,
     )
     grounding.action = action.action
     grounding.action_target = action.action_target
@@ -66,47 +346,100 @@ def take_action(
     history.append(grounding, ActionResult.PENDING)
 
 
+@renamed_arguments(image_path="image")
 def plan_task(
     task: str,
-    image_path: str,
+    image: ImageInput,
     context: str,
     task_description: str,
+    planner: Optional[QwenVLPlanner] = None,
 ) -> Plan:
     """
     Plans ahead the steps to carry out to complete the given task
 
     @param task: Task to complete on the user's computer
-    @image_path: Path to the image upon which the interaction will happen
+    @image: Image upon which the interaction will happen. A path, encoded bytes, a NumPy array or a PIL image. Also
+    accepted as image_path, its deprecated name
     @context: Bussiness context
     @task_description: Detailed description of the task at hand, from a process POV
+    @param planner: Planner to use, the default one if None
 
     @returns plan: Plan object
     """
-    # prompt = """
-    # **Task Description**: Register a client with email \"example@email.com\" and password \"password123\".
-    # **Contextual Information**:
-    # - Users must have first sent an email to the company attaching their NIF, which must be included in the registration
-    # - Once registered, we respond back to the email sent by the user confirming that the registration was done correctly
-    # """
+    planner = planner or QwenVLPlanner("Qwen/Qwen2-VL-7B-Instruct-GPTQ-Int4")
+    sys_prompt, user_prompt = sized_planner_prompts(planner, task, context, task_description, image)
 
-    # This prompt now resembles a process description
-    planner = QwenVLPlanner("Qwen/Qwen2-VL-7B-Instruct-GPTQ-Int4")
+    plan: Plan = planner.plan(
+        sys_prompt,
+        user_prompt,
+        image=image,
+    )
 
-    prompt = f"""
-    **Task Description**: {task}.
-    **Contextual Information**:
-    {task_description}
+    return plan
+
+
+async def aplan_task(
+    task: str,
+    image: ImageInput,
+    context: str,
+    task_description: str,
+    planner: Optional[QwenVLPlanner] = None,
+) -> Plan:
     """
+    Async version of plan_task
 
-    plan: Plan = planner.plan(
-        PLANNER_COT.format(context=context),
-        prompt,
-        image=image_path,
+    @param task: Task to complete on the user's computer
+    @image: Image upon which the interaction will happen. A path, encoded bytes, a NumPy array or a PIL image
+    @context: Bussiness context
+    @task_description: Detailed description of the task at hand, from a process POV
+    @param planner: Planner to use, the default one if None
+
+    @returns plan: Plan object
+    """
+    planner = planner or QwenVLPlanner("Qwen/Qwen2-VL-7B-Instruct-GPTQ-Int4")
+    # Counting the tokens of the sections and the screenshot would otherwise block the event loop
+    sys_prompt, user_prompt = await asyncio.to_thread(
+        sized_planner_prompts, planner, task, context, task_description, image
+    )
+
+    plan: Plan = await planner.aplan(
+        sys_prompt,
+        user_prompt,
+        image=image,
     )
 
     return plan
 
 
+def stream_plan_task(
+    task: str,
+    image: ImageInput,
+    context: str,
+    task_description: str,
+    planner: Optional[QwenVLPlanner] = None,
+) -> PlanStream:
+    """
+    Same as plan_task, but the steps are yielded as soon as they are generated so that the first ones can be acted
+    upon while the rest of the plan is still being decoded
+
+    @param task: Task to complete on the user's computer
+    @image: Image upon which the interaction will happen. A path, encoded bytes, a NumPy array or a PIL image
+    @context: Bussiness context
+    @task_description: Detailed description of the task at hand, from a process POV
+    @param planner: Planner to use, the default one if None
+
+    @returns PlanStream object, its partial_plan can be given to take_action while iterating
+    """
+    planner = planner or QwenVLPlanner("Qwen/Qwen2-VL-7B-Instruct-GPTQ-Int4")
+    sys_prompt, user_prompt = sized_planner_prompts(planner, task, context, task_description, image)
+
+    return planner.stream_plan(
+        sys_prompt,
+        user_prompt,
+        image=image,
+    )
+
+
 if __name__ == "__main__":
     task: str = 'Register a client with email "example@email.com" and password "password123"'
 
@@ -128,7 +461,7 @@ if __name__ == "__main__":
 
     plan = plan_task(
         task,
-        image_path=".resources/A_720p.png",
+        image=".resources/A_720p.png",
         context=context,
         task_description=task_description,
     )
@@ -136,7 +469,7 @@ if __name__ == "__main__":
     take_action(
         plan.steps[0],
         history,
-        image_path=".resources/A_720p.png",
+        image=".resources/A_720p.png",
         task=task,
         plan=plan,
         context=context,
@@ -0,0 +1,41 @@
+import numpy as np
+
+from models.memory import release_memory, rss_mb
+
+
+class ArrayWeights:
+    """
+    Stands in for a torch tensor, backed by a NumPy array whose pages are all touched so that they count in RSS
+    """
+
+    def __init__(self, size_mb: float):
+        self.array = np.ones(int(size_mb * 2**20), dtype=np.uint8)
+
+    def numel(self) -> int:
+        return self.array.size
+
+    def element_size(self) -> int:
+        return self.array.itemsize
+
+
+class ArrayModel:
+    """
+    Stands in for a torch model of the given size, loaded without any checkpoint
+    """
+
+    def __init__(self, size_mb: float):
+        self.weights = ArrayWeights(size_mb)
+
+    def parameters(self):
+        return [self.weights]
+
+    def buffers(self):
+        return []
+
+
+def settled_rss_mb() -> float:
+    """
+    Resident memory once the memory of dropped objects has been given back
+    """
+    release_memory()
+    return rss_mb()
@@ -0,0 +1,103 @@
+import threading
+import time
+
+from conftest import ArrayModel, ArrayWeights, settled_rss_mb
+
+from models.prefix_cache import PrefixCache
+from models.registry import ModelRegistry, RegistryKey
+
+PLANNER = RegistryKey("planner", "auto", "cpu")
+GROUNDING = RegistryKey("grounding", "auto", "cpu")
+MIDDLEMAN = RegistryKey("middleman", "auto", "cpu")
+
+
+def loader(size_mb: float):
+    return lambda: (ArrayModel(size_mb), None)
+
+
+def test_evict_returns_memory_to_baseline():
+    registry = ModelRegistry()
+    # A first cycle pays for the allocator warmup
+    with registry.lease(PLANNER, loader(128)):
+        pass
+    registry.evict(PLANNER)
+    baseline_mb = settled_rss_mb()
+
+    for _ in range(3):
+        with registry.lease(PLANNER, loader(128)):
+            assert settled_rss_mb() > baseline_mb + 96
+        # Released models stay resident until evicted
+        assert registry.stats()[PLANNER]["refs"] == 0
+        assert registry.evict(PLANNER)
+        assert settled_rss_mb() < baseline_mb + 32
+
+
+def test_models_in_use_are_not_evicted():
+    registry = ModelRegistry()
+    with registry.lease(PLANNER, loader(1)):
+        assert not registry.evict(PLANNER)
+        assert registry.clear() == []
+    assert registry.clear() == [PLANNER]
+    assert registry.stats() == {}
+
+
+def test_budget_evicts_least_recently_used():
+    registry = ModelRegistry(memory_budget_mb=80)
+    with registry.lease(PLANNER, loader(32)):
+        pass
+    with registry.lease(GROUNDING, loader(32)):
+        pass
+    with registry.lease(PLANNER, loader(32)):
+        pass
+
+    # The grounding model was used least recently, it makes room for the middleman
+    with registry.lease(MIDDLEMAN, loader(32)):
+        assert set(registry.stats()) == {PLANNER, MIDDLEMAN}
+    assert registry.resident_mb <= 80
+
+
+def test_budget_never_evicts_models_in_use():
+    registry = ModelRegistry(memory_budget_mb=48)
+    with registry.lease(PLANNER, loader(32)):
+        with registry.lease(GROUNDING, loader(32)):
+            assert set(registry.stats()) == {PLANNER, GROUNDING}
+        # Over the budget, the grounding model is unloaded as soon as it is idle
+        assert set(registry.stats()) == {PLANNER}
+
+
+def test_budget_counts_cached_prefixes():
+    registry = ModelRegistry(memory_budget_mb=80)
+    prefixes = PrefixCache()
+    registry.derived_mb.append(prefixes.memory_mb)
+    registry.on_evict.append(prefixes.invalidate)
+
+    with registry.lease(PLANNER, loader(32)):
+        prefixes.put(prefixes.key(PLANNER, "system prompt"), [ArrayWeights(16), ArrayWeights(16)])
+    assert registry.resident_mb == 64
+
+    # The weights alone would fit, the prefixes of the planner do not
+    with registry.lease(GROUNDING, loader(32)):
+        assert set(registry.stats()) == {GROUNDING}
+    assert prefixes.memory_mb() == 0
+
+
+def test_leases_of_a_model_run_one_at_a_time():
+    registry = ModelRegistry()
+    running = []
+    overlaps = []
+
+    def generate():
+        with registry.lease(PLANNER, loader(1)):
+            running.append(None)
+            overlaps.append(len(running))
+            time.sleep(0.01)
+            running.pop()
+
+    threads = [threading.Thread(target=generate) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(overlaps) == 1
+    assert registry.stats()[PLANNER]["refs"] == 0
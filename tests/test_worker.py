@@ -0,0 +1,78 @@
+import os
+import time
+from typing import Any, List, Optional, Tuple
+
+from conftest import ArrayModel
+
+from models.models import GenerationRequest, QwenVLModel
+from models.worker import WorkerPool
+
+
+class ArrayQwen(QwenVLModel):
+    """
+    Loads an array of the given size instead of a checkpoint and answers with the pid of the process serving it
+    """
+
+    weights_mb: float = 1
+    seconds_per_inference: float = 0
+
+    def load_model(self) -> Tuple[Any, Any]:
+        return ArrayModel(self.weights_mb), None
+
+    def run_inference(self, model: Any, processor: Any, requests: List[GenerationRequest], on_text: Optional[Any] = None) -> List[str]:
+        time.sleep(self.seconds_per_inference)
+        return [str(os.getpid()) for _ in requests]
+
+
+def batch() -> List[GenerationRequest]:
+    return [GenerationRequest([{"role": "user", "content": "hi"}], 1, False, None, False)]
+
+
+def test_recycled_worker_exits_before_its_replacement_starts():
+    pool = WorkerPool()
+    model = ArrayQwen("fake/planner", worker_max_requests=2, seconds_per_inference=0.5)
+    try:
+        first = [pool.submit(model, batch()) for _ in range(2)]
+        retired = pool._current
+        # The first worker has reached its request limit, the third request goes to a replacement
+        third = pool.submit(model, batch())
+        replacement = pool._current
+        assert replacement is not retired
+        assert replacement._process.pid is None
+
+        pids = {f.result(timeout=60)[0] for f in first}
+        assert pids == {str(retired._process.pid)}
+        assert third.result(timeout=60) == [str(replacement._process.pid)]
+        assert retired._process.exitcode == 0
+    finally:
+        pool.shutdown()
+
+
+def test_roles_share_the_budget_of_the_worker():
+    pool = WorkerPool()
+    settings = {"weights_mb": 192, "memory_budget_mb": 256}
+    planner = ArrayQwen("fake/planner", **settings)
+    grounding = ArrayQwen("fake/grounding", **settings)
+    try:
+        pool.submit(planner, batch()).result(timeout=60)
+        with_planner_mb = pool.stats()["memory_mb"]
+        # Both models run in the same process, the planner is evicted to make room for the grounding model
+        pool.submit(grounding, batch()).result(timeout=60)
+        assert pool.stats()["memory_mb"] < with_planner_mb + 96
+        assert pool.stats()["served"] == 2
+    finally:
+        pool.shutdown()
+
+
+def test_recycling_gives_the_memory_back():
+    pool = WorkerPool()
+    large = ArrayQwen("fake/planner", weights_mb=192, worker_max_requests=1)
+    small = ArrayQwen("fake/grounding", weights_mb=1, worker_max_requests=1)
+    try:
+        pool.submit(large, batch()).result(timeout=60)
+        with_large_mb = pool.stats()["memory_mb"]
+        # The worker holding the large model is replaced by a fresh process
+        pool.submit(small, batch()).result(timeout=60)
+        assert pool.stats()["memory_mb"] < with_large_mb - 96
+    finally:
+        pool.shutdown()